@@ -0,0 +1,74 @@
+"""
+Benchmark latency and accuracy of the duplicate frame detection against the full frame MSE.
+
+Usage:
+    python miyoka/benchmark-duplicate-detection.py <video-path> --frames 3000
+"""
+
+import argparse
+import logging
+import statistics
+import time
+import cv2 as cv
+from miyoka.libs.duplicate_detector import DuplicateDetector
+from miyoka.sf6.game_window_helper import GameWindowHelper
+
+
+def read_frames(path: str, max_frames: int):
+    vidcap = cv.VideoCapture(path)
+    frame_count = 0
+    while frame_count < max_frames:
+        success, frame = vidcap.read()
+        if not success:
+            break
+        frame_count += 1
+        yield frame
+    vidcap.release()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("path", help="Path to a round video")
+    parser.add_argument("--frames", type=int, default=3000)
+    args = parser.parse_args()
+
+    helper = GameWindowHelper(logging.getLogger("benchmark"), window_name="", extra={})
+    detector = DuplicateDetector()
+    latencies = {"full frame mse": [], "duplicate detector": []}
+    mismatches = {"missed": 0, "false": 0}
+    duplicates = 0
+    previous_frame = None
+
+    for frame in read_frames(args.path, args.frames):
+        started_at = time.perf_counter()
+        expected = previous_frame is not None and helper.mse(frame, previous_frame) < 5
+        latencies["full frame mse"].append((time.perf_counter() - started_at) * 1000)
+        previous_frame = frame
+        duplicates += expected
+
+        started_at = time.perf_counter()
+        actual = detector.is_duplicate(frame)
+        latencies["duplicate detector"].append(
+            (time.perf_counter() - started_at) * 1000
+        )
+
+        if expected and not actual:
+            mismatches["missed"] += 1
+        elif actual and not expected:
+            mismatches["false"] += 1
+
+    print(f"frames: {len(latencies['full frame mse'])} | duplicates: {duplicates}")
+
+    def print_latencies(name, values, suffix=""):
+        print(
+            f"{name:<20} mean: {statistics.mean(values):.3f} ms | "
+            f"median: {statistics.median(values):.3f} ms{suffix}"
+        )
+
+    print_latencies("full frame mse", latencies["full frame mse"])
+    print_latencies(
+        "duplicate detector",
+        latencies["duplicate detector"],
+        f" | missed duplicates: {mismatches['missed']}"
+        f" | false duplicates: {mismatches['false']}",
+    )
@@ -0,0 +1,109 @@
+"""
+Benchmark per-frame latency of the template matching in the replay analyzer.
+
+Usage:
+    python miyoka/benchmark-frame-analysis.py <video-or-image-path> --frames 300 --mode classic
+"""
+
+import argparse
+import logging
+import statistics
+import time
+import cv2 as cv
+from miyoka.libs.debug_image_capture import LEVELS, DebugImageCapture
+from miyoka.libs.template_bank import TemplateBank
+from miyoka.sf6.game_window_helper import GameWindowHelper
+
+
+def read_frames(path: str, max_frames: int):
+    if path.endswith((".jpeg", ".jpg", ".png")):
+        frame = cv.imread(path)
+        return [frame] * max_frames
+
+    frames = []
+    vidcap = cv.VideoCapture(path)
+    while len(frames) < max_frames:
+        success, frame = vidcap.read()
+        if not success:
+            break
+        frames.append(frame)
+    vidcap.release()
+    return frames
+
+
+def analyze_frame(helper: GameWindowHelper, frame, mode: str):
+    # Same template matching as RoundAnalyzer._analyze does per frame.
+    helper.is_replay_started(frame)
+    for player in ["p1", "p2"]:
+        helper.identify_replay_input_count(frame, player, row=0)
+        helper.get_all_rows_count(frame, 3, player)
+    helper.identify_replay_inputs(frame, {"p1": mode, "p2": mode})
+
+
+def benchmark(name: str, helper: GameWindowHelper, frames, mode: str):
+    height, width, _ = frames[0].shape
+    helper.current_screen_width = width
+    helper.current_screen_height = height
+
+    latencies = []
+    for frame_id, frame in enumerate(frames):
+        started_at = time.perf_counter()
+        helper.debug_image_capture.begin_frame(frame_id)
+        analyze_frame(helper, frame, mode)
+        latencies.append((time.perf_counter() - started_at) * 1000)
+
+    helper.debug_image_capture.wait()
+
+    print(
+        f"{name:<24} frames: {len(latencies)} | "
+        f"mean: {statistics.mean(latencies):.2f} ms | "
+        f"median: {statistics.median(latencies):.2f} ms | "
+        f"max: {max(latencies):.2f} ms"
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("path", help="Path to a round video or a frame image")
+    parser.add_argument("--frames", type=int, default=300)
+    parser.add_argument("--mode", choices=["classic", "modern"], default="classic")
+    parser.add_argument("--debug-images", choices=LEVELS, default="all")
+    args = parser.parse_args()
+
+    logger = logging.getLogger("benchmark")
+    frames = read_frames(args.path, args.frames)
+
+    benchmark(
+        "templates (no cache)",
+        GameWindowHelper(
+            logger,
+            window_name="",
+            extra={},
+            template_bank=TemplateBank(cache=False),
+            roi_cache_size=0,
+            debug_image_capture=DebugImageCapture(level=args.debug_images),
+        ),
+        frames,
+        args.mode,
+    )
+    benchmark(
+        "templates (bank)",
+        GameWindowHelper(
+            logger,
+            window_name="",
+            extra={},
+            roi_cache_size=0,
+            debug_image_capture=DebugImageCapture(level=args.debug_images),
+        ),
+        frames,
+        args.mode,
+    )
+
+    helper = GameWindowHelper(
+        logger,
+        window_name="",
+        extra={},
+        debug_image_capture=DebugImageCapture(level=args.debug_images),
+    )
+    benchmark("templates (roi cache)", helper, frames, args.mode)
+    print(f"roi cache: {helper.roi_cache.info()}")
@@ -0,0 +1,205 @@
+"""
+Benchmark the scene splitter per segmenter against the row-by-row (iterrows) implementation,
+and validate that the gap segmenter splits the same scenes as DBSCAN.
+
+Usage:
+    # Synthetic rounds e.g. a month of rounds
+    python miyoka/benchmark-scene-splitter.py --rounds 900 --frames 5400
+    # Real rounds in the frame dataset
+    python miyoka/benchmark-scene-splitter.py --mode classic --rounds 100
+"""
+
+import argparse
+import contextlib
+import io
+import random
+import statistics
+import time
+import numpy as np
+import pandas as pd
+from sklearn.cluster import DBSCAN
+from miyoka.sf6.constants import (
+    ARROWS,
+    CLASSIC_INPUTS,
+    NON_ACTION_LABEL,
+    ACTION_LABEL,
+    invert_arrow,
+)
+from miyoka.sf6.scene_splitter import SceneSplitter, SEGMENTERS, DBSCAN_SEGMENTER
+
+
+def generate_round(replay_id: str, round_id: int, frames: int) -> pd.DataFrame:
+    """Mostly arrows with bursts of attack inputs as in a real round."""
+    rows = {"replay_id": [], "round_id": [], "frame_id": []}
+
+    for p in ["p1", "p2"]:
+        inputs = []
+
+        while len(inputs) < frames:
+            arrow = random.choice(ARROWS)
+            inputs += [arrow] * random.randint(5, 90)
+
+            if random.random() < 0.5:
+                attack = " ".join(random.sample(CLASSIC_INPUTS, random.randint(1, 2)))
+                inputs += [f"{arrow} {attack}"] * random.randint(1, 6)
+
+        rows[f"{p}_input"] = inputs[:frames]
+        rows[f"{p}_character"] = [random.choice(["ryu", "ken", "jp"])] * frames
+
+    rows["replay_id"] = [replay_id] * frames
+    rows["round_id"] = [round_id] * frames
+    rows["frame_id"] = list(range(frames))
+    return pd.DataFrame(rows)
+
+
+def split_with_iterrows(splitter: SceneSplitter, round_rows: pd.DataFrame):
+    """The previous implementation without the logs, i.e. `iterrows` and `query` per scene."""
+    last_frame_id = round_rows.loc[round_rows["frame_id"].idxmax()]["frame_id"]
+
+    for p in ["p1", "p2"]:
+        input_mask = {arrow: None for arrow in ARROWS}
+        action_pos = np.array(
+            [
+                [
+                    row["frame_id"],
+                    (
+                        NON_ACTION_LABEL
+                        if row[f"{p}_input"] in input_mask
+                        else ACTION_LABEL
+                    ),
+                ]
+                for _, row in round_rows.iterrows()
+            ]
+        )
+        clustering = DBSCAN(
+            eps=splitter.CLUSTERING_DISTANCE,
+            min_samples=splitter.CLUSTERING_MIN_SAMPLES,
+        ).fit(action_pos)
+        labels = clustering.labels_
+        core_samples_mask = np.zeros_like(labels, dtype=bool)
+        core_samples_mask[clustering.core_sample_indices_] = True
+
+        for label in set(labels):
+            if label == -1:
+                continue
+
+            xy = action_pos[(labels == label) & core_samples_mask]
+
+            if set(xy[:, 1]) == {NON_ACTION_LABEL} or len(xy) == 0:
+                continue
+
+            min_frame_id = max(min(xy[:, 0]) - splitter.PREFIX_FRAME_SIZE, 0)
+            max_frame_id = min(
+                max(xy[:, 0]) + splitter.SUFFIX_FRAME_SIZE, last_frame_id
+            )
+            ranged_rows = round_rows.query(
+                f"frame_id >= {min_frame_id} & frame_id <= {max_frame_id}"
+            )
+            scene_inputs = [
+                row[f"{p}_input"] if p == "p1" else invert_arrow(row[f"{p}_input"])
+                for _, row in ranged_rows.iterrows()
+            ]
+
+            yield (range(min_frame_id, max_frame_id), scene_inputs)
+
+
+def iterate_synthetic_rounds(rounds: int, frames: int):
+    for round_id in range(rounds):
+        yield generate_round("synthetic", round_id, frames)
+
+
+def iterate_real_rounds(mode: str, rounds: int, character: str):
+    from miyoka.container import Container
+
+    frame_dataset = Container().frame_dataset()
+
+    for _, _, round_rows in frame_dataset.iterate_rounds(
+        mode=mode, limit=rounds, character=character, chunk_size=100_000
+    ):
+        yield round_rows
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--rounds", type=int, default=900, help="e.g. 30 rounds a day for 30 days"
+    )
+    parser.add_argument(
+        "--frames", type=int, default=5400, help="Frames per synthetic round"
+    )
+    parser.add_argument(
+        "--mode",
+        help="Use the real rounds of this mode (e.g. classic) in the frame dataset instead of synthetic rounds",
+    )
+    parser.add_argument("--character", help="Filter the real rounds by character")
+    parser.add_argument(
+        "--baseline-rounds",
+        type=int,
+        default=20,
+        help="Rounds measured with the iterrows implementation, because it is slow",
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+
+    if args.mode:
+        rounds = iterate_real_rounds(args.mode, args.rounds, args.character)
+    else:
+        rounds = iterate_synthetic_rounds(args.rounds, args.frames)
+
+    splitters = {
+        segmenter: SceneSplitter(segmenter=segmenter) for segmenter in SEGMENTERS
+    }
+    latencies = {"iterrows": []}
+    latencies.update({segmenter: [] for segmenter in SEGMENTERS})
+    mismatches = {segmenter: 0 for segmenter in SEGMENTERS}
+    baseline_mismatches = 0
+    scenes = 0
+    round_count = 0
+
+    for round_rows in rounds:
+        results = {}
+
+        for segmenter, splitter in splitters.items():
+            # The splitter logs every scene, which is not what is measured here.
+            with contextlib.redirect_stdout(io.StringIO()):
+                started_at = time.perf_counter()
+                results[segmenter] = [
+                    (scene.frame_range, scene.inputs)
+                    for scene in splitter.split(round_rows)
+                ]
+                latencies[segmenter].append((time.perf_counter() - started_at) * 1000)
+
+        # Scenes split differently from DBSCAN
+        for segmenter in SEGMENTERS:
+            mismatches[segmenter] += results[segmenter] != results[DBSCAN_SEGMENTER]
+
+        scenes += len(results[DBSCAN_SEGMENTER])
+
+        if round_count < args.baseline_rounds:
+            started_at = time.perf_counter()
+            expected = list(
+                split_with_iterrows(splitters[DBSCAN_SEGMENTER], round_rows)
+            )
+            latencies["iterrows"].append((time.perf_counter() - started_at) * 1000)
+            baseline_mismatches += results[DBSCAN_SEGMENTER] != expected
+
+        round_count += 1
+
+    print(
+        f"rounds: {round_count} | scenes: {scenes} "
+        f"| rounds mismatched with iterrows: {baseline_mismatches}/{min(round_count, args.baseline_rounds)}"
+    )
+
+    for name, values in latencies.items():
+        if values:
+            suffix = (
+                f" | rounds mismatched with dbscan: {mismatches[name]}"
+                if name in mismatches
+                else ""
+            )
+            print(
+                f"{name:<12} mean: {statistics.mean(values):.1f} ms/round | "
+                f"total for {round_count} rounds: {statistics.mean(values) * round_count / 1000:.1f} s{suffix}"
+            )
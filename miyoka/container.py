@@ -8,16 +8,20 @@ from miyoka.libs.storages import (
     init_storage_client,
 )
 from miyoka.libs.frame_splitter import FrameSplitter
+from miyoka.libs.duplicate_detector import DuplicateDetector
+from miyoka.libs.debug_image_capture import DebugImageCapture
 from miyoka.sf6.round_analyzer import RoundAnalyzer
 from miyoka.libs.bigquery import (
     FrameDataset,
     ReplayDataset,
     init_bq_client,
 )
+from miyoka.libs.parquet import ParquetFrameDataset
 from miyoka.libs.replay_analyzer import ReplayAnalyzer
 from miyoka.libs.cloud_run import CloudRun
 from miyoka.libs.scene_exporter import SceneExporter
 from miyoka.libs.scene_store import SceneStore
+from miyoka.libs.similarity_index import SimilarityIndex
 from miyoka.libs.replay_viewer_helper import ReplayViewerHelper
 from unittest.mock import Mock
 import importlib
@@ -101,14 +105,38 @@ class Container(containers.DeclarativeContainer):
         table_name=config.gcp.bigquery.replay_dataset.table_name,
         bq_client=bq_client,
         logger=logger,
+        index_path=config.gcp.bigquery.replay_dataset.index_path,
+        refresh_interval=config.gcp.bigquery.replay_dataset.refresh_interval,
     )
 
-    frame_dataset = providers.Singleton(
+    bq_frame_dataset = providers.Singleton(
         FrameDataset,
         dataset_name=config.gcp.bigquery.dataset_name,
         table_name=config.gcp.bigquery.frame_dataset.table_name,
         bq_client=bq_client,
         logger=logger,
+        write_mode=config.gcp.bigquery.frame_dataset.write_mode,
+        flush_rows=config.gcp.bigquery.frame_dataset.flush_rows,
+        flush_bytes=config.gcp.bigquery.frame_dataset.flush_bytes,
+        flush_interval=config.gcp.bigquery.frame_dataset.flush_interval,
+        index_path=config.gcp.bigquery.frame_dataset.index_path,
+        cache_dir=config.gcp.bigquery.frame_dataset.cache_dir,
+        cache_lookback_days=config.gcp.bigquery.frame_dataset.cache_lookback_days,
+    )
+
+    parquet_frame_dataset = providers.Singleton(
+        ParquetFrameDataset,
+        base_dir=config.replay_analyzer.frame_dataset_dir,
+        logger=logger,
+    )
+
+    frame_dataset = providers.Selector(
+        providers.Callable(
+            lambda backend: backend or "bigquery",
+            config.replay_analyzer.frame_dataset_backend,
+        ),
+        bigquery=bq_frame_dataset,
+        parquet=parquet_frame_dataset,
     )
 
     cloud_run = providers.Singleton(
@@ -126,6 +154,14 @@ class Container(containers.DeclarativeContainer):
         batch_size=config.replay_analyzer.batch_size,
         clear_per_batch=config.replay_analyzer.clear_per_batch,
         skip_split=config.replay_analyzer.skip_split,
+        seek_stride=config.replay_analyzer.seek_stride,
+    )
+
+    debug_image_capture = providers.Singleton(
+        DebugImageCapture,
+        level=config.replay_analyzer.debug_images.level,
+        sample_interval=config.replay_analyzer.debug_images.sample_interval,
+        buffer_size=config.replay_analyzer.debug_images.buffer_size,
     )
 
     game_window_helper = providers.Singleton(
@@ -135,11 +171,15 @@ class Container(containers.DeclarativeContainer):
         logger=logger,
         window_name=config.game.window.name,
         extra=config.game.extra,
+        debug_image_capture=debug_image_capture,
     )
 
+    duplicate_detector = providers.Factory(DuplicateDetector)
+
     round_analyzer = providers.Factory(
         RoundAnalyzer,
         game_window_helper=game_window_helper,
+        duplicate_detector=duplicate_detector,
         logger=logger,
         start_frame_at=config.replay_analyzer.start_frame_at,
         stop_frame_at=config.replay_analyzer.stop_frame_at,
@@ -160,6 +200,8 @@ class Container(containers.DeclarativeContainer):
         frame_dataset=frame_dataset,
         frame_splitter=frame_splitter,
         round_analyzer_factory=round_analyzer.provider,
+        workers=config.replay_analyzer.workers,
+        round_shards=config.replay_analyzer.round_shards,
     )
 
     replay_dataset_selector = providers.Selector(
@@ -228,10 +270,14 @@ class Container(containers.DeclarativeContainer):
         dynamic_import,
         game=config.game.name,
         klass_path="scene_splitter.SceneSplitter",
+        segmenter=config.scene_splitter.segmenter,
     )
 
     scene_exporter = providers.Factory(
         SceneExporter,
+        workers=config.scene_exporter.workers,
+        source=config.scene_exporter.source,
+        similarity_output=config.scene_exporter.similarity_output,
     )
 
     scene_vectorizer = providers.Factory(
@@ -240,6 +286,14 @@ class Container(containers.DeclarativeContainer):
         klass_path="scene_vectorizer.SceneVectorizer",
     )
 
+    similarity_index = providers.Factory(
+        SimilarityIndex,
+        method=config.scene_store.similarity_method,
+        top_k=config.scene_store.similarity_top_k,
+        block_size=config.scene_store.similarity_block_size,
+    )
+
     scene_store = providers.Factory(
         SceneStore,
+        similarity_index=similarity_index,
     )
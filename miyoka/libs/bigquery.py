@@ -3,10 +3,19 @@ from google.cloud.bigquery import Client
 from google.api_core.exceptions import Conflict
 from logging import Logger
 from datetime import datetime, timezone, timedelta
+import hashlib
 import os
+import time
 import pandas as pd
 from typing import Optional
 import json
+from miyoka.libs.frame_dataset import BaseFrameDataset
+from miyoka.libs.key_index import KeyIndex
+from miyoka.libs.rows_cache import RowsCache
+from miyoka.libs.utils import retry
+
+STREAM_WRITE_MODE = "stream"
+LOAD_WRITE_MODE = "load"
 
 
 def init_bq_client(project_id: str, location: str):
@@ -52,15 +61,28 @@ class BaseBqClient:
 
 
 class ReplayDataset(BaseBqClient):
+    """
+    Metadata of the recorded replays.
+
+    Existing replay IDs are kept in a local index refreshed incrementally by `recorded_at`,
+    at most every `refresh_interval` seconds. The IDs still not in the index are checked by a query,
+    e.g. the replays inserted by another recorder since the refresh. `index_path` persists the index across runs.
+    """
+
     def __init__(
         self,
         dataset_name: str,
         table_name: str,
         bq_client: Client,
         logger: Logger,
+        index_path: Optional[str] = None,
+        refresh_interval: float = 60,
     ):
         super().__init__(dataset_name, table_name, bq_client, logger)
 
+        self.index = KeyIndex(index_path)
+        self.refresh_interval = refresh_interval or 0
+
         schema = [
             bigquery.SchemaField("replay_id", "STRING", mode="REQUIRED"),
             bigquery.SchemaField("metadata", "JSON", mode="REQUIRED"),
@@ -70,13 +92,48 @@ class ReplayDataset(BaseBqClient):
         self.ensure_table(schema)
 
     def is_exists(self, replay_id):
+        return replay_id in self.existing_replay_ids([replay_id])
+
+    def existing_replay_ids(self, replay_ids: list[str]) -> set[str]:
+        """Return the replay IDs that exist. A query is made only when an ID is not in the index."""
+        if any(replay_id not in self.index for replay_id in replay_ids):
+            if self.index.is_stale(self.refresh_interval):
+                self.refresh_index()
+
+        unknown_replay_ids = sorted(
+            {replay_id for replay_id in replay_ids if replay_id not in self.index}
+        )
+
+        if unknown_replay_ids:
+            table_id = f"{self.bq_client.project}.{self.dataset_name}.{self.table_name}"
+            in_replay_ids = ", ".join(
+                f"'{replay_id}'" for replay_id in unknown_replay_ids
+            )
+            rows = self.bq_client.query(
+                f"SELECT DISTINCT replay_id FROM `{table_id}` WHERE replay_id IN ({in_replay_ids})"
+            ).result()
+            self.index.add(row.replay_id for row in rows)
+
+        return {replay_id for replay_id in replay_ids if replay_id in self.index}
+
+    def refresh_index(self):
+        """Fetch the replay IDs recorded since the last refresh."""
         table_id = f"{self.bq_client.project}.{self.dataset_name}.{self.table_name}"
-        query = (
-            f"SELECT COUNT(*) as cnt FROM {table_id} WHERE replay_id = '{replay_id}'"
+        query = f"SELECT replay_id, recorded_at FROM `{table_id}`"
+
+        if self.index.watermark:
+            # Inclusive, so that the rows recorded in the same second are not missed.
+            query += f" WHERE recorded_at >= '{self.index.watermark}'"
+
+        rows = list(self.bq_client.query(query).result())
+        self.index.add(
+            [row.replay_id for row in rows],
+            watermark=max((str(row.recorded_at) for row in rows), default=None),
+        )
+        self.index.mark_refreshed()
+        self.logger.info(
+            f"Refreshed the index of {table_id} with {len(rows)} rows. Total: {len(self.index)}"
         )
-        query_job = self.bq_client.query(query)
-        result = query_job.result()
-        return list(result)[0].cnt > 0
 
     def insert(self, replay_id, metadata: dict):
         data = [
@@ -93,6 +150,7 @@ class ReplayDataset(BaseBqClient):
 
         if errors == []:
             self.logger.info("New rows have been added.")
+            self.index.add([replay_id])
         else:
             self.logger.info(
                 "Encountered errors while inserting rows: {}".format(errors)
@@ -153,17 +211,48 @@ class ReplayDataset(BaseBqClient):
         return all_rows
 
 
-class FrameDataset(BaseBqClient):
+class FrameDataset(BaseBqClient, BaseFrameDataset):
+    """
+    Frame data of the analyzed rounds.
+
+    Inserted rows are buffered and written per `write_mode`:
+    - `stream` ... Streaming inserts flushed by `flush_rows`, `flush_bytes` or `flush_interval` seconds.
+      Each row has an insert ID, so that the rows retried or re-inserted are deduplicated by BigQuery.
+    - `load` ... Load jobs of Parquet (via Arrow) flushed per round by `flush`. The existing rows of the round
+      are replaced, so that re-analyzing a round doesn't duplicate the rows.
+
+    Analyzed `(replay_id, round_id)` pairs are kept in a local index. `index_path` persists it across runs.
+    """
+
     def __init__(
         self,
         dataset_name: str,
         table_name: str,
         bq_client: Client,
         logger: Logger,
+        write_mode: str = STREAM_WRITE_MODE,
+        flush_rows: int = 500,
+        flush_bytes: int = 5_000_000,
+        flush_interval: float = 10,
+        max_retries: int = 3,
+        index_path: Optional[str] = None,
+        cache_dir: str = "cache/frame_dataset",
+        cache_lookback_days: int = 3,
     ):
         super().__init__(dataset_name, table_name, bq_client, logger)
 
-        schema = [
+        self.index = KeyIndex(index_path)
+        self.cache_dir = cache_dir or "cache/frame_dataset"
+        self.cache_lookback_days = (
+            3 if cache_lookback_days is None else cache_lookback_days
+        )
+
+        if self.cache_lookback_days < 0:
+            raise ValueError(
+                f"cache_lookback_days must be 0 or more: {self.cache_lookback_days}"
+            )
+
+        self.schema = [
             bigquery.SchemaField("replay_id", "STRING", mode="REQUIRED"),
             bigquery.SchemaField("round_id", "INTEGER", mode="REQUIRED"),
             bigquery.SchemaField("frame_id", "INTEGER", mode="REQUIRED"),
@@ -171,81 +260,262 @@ class FrameDataset(BaseBqClient):
             bigquery.SchemaField("p2_input", "STRING", mode="REQUIRED"),
         ]
 
-        self.ensure_table(schema)
+        self.ensure_table(self.schema)
 
-    def is_exists(self, replay_id, round_id):
-        table_id = f"{self.bq_client.project}.{self.dataset_name}.{self.table_name}"
-        query = f"SELECT COUNT(*) as cnt FROM {table_id} WHERE replay_id = '{replay_id}' AND round_id = {round_id}"
-        query_job = self.bq_client.query(query)
-        result = query_job.result()
-        return list(result)[0].cnt > 0
+        write_mode = write_mode or STREAM_WRITE_MODE
+
+        if write_mode not in [STREAM_WRITE_MODE, LOAD_WRITE_MODE]:
+            raise ValueError(f"Unknown write mode: {write_mode}")
+
+        self.write_mode = write_mode
+        self.flush_rows = flush_rows or 500
+        self.flush_bytes = flush_bytes or 5_000_000
+        self.flush_interval = flush_interval or 10
+        self.max_retries = max_retries
+
+        self._rows = []
+        self._rows_bytes = 0
+        self._last_flushed_at = time.monotonic()
+        self._replaced_rounds = set()
+
+    @property
+    def table_id(self) -> str:
+        return f"{self.bq_client.project}.{self.dataset_name}.{self.table_name}"
+
+    def existing_rounds(self, keys: list[tuple[str, int]]) -> set[tuple[str, int]]:
+        """Return the `(replay_id, round_id)` pairs that exist. The keys not in the index are checked in one query."""
+        unknown_replay_ids = sorted(
+            {
+                replay_id
+                for replay_id, round_id in keys
+                if (replay_id, round_id) not in self.index
+            }
+        )
+
+        if unknown_replay_ids:
+            replay_ids = ", ".join(f"'{replay_id}'" for replay_id in unknown_replay_ids)
+            rows = self.bq_client.query(
+                f"SELECT DISTINCT replay_id, round_id FROM `{self.table_id}` WHERE replay_id IN ({replay_ids})"
+            ).result()
+            self.index.add((row.replay_id, row.round_id) for row in rows)
+
+        return {key for key in keys if key in self.index}
 
-    def insert(self, replay_id, round_id, frame_data: list[dict]):
+    def insert(
+        self,
+        replay_id,
+        round_id,
+        frame_data: list[dict],
+        metadata: Optional[dict] = None,
+    ):
+        """
+        Buffer the rows. Call `flush` when the round is done.
+
+        `metadata` of the replay is not stored, because it is in the replays table.
+        """
         if frame_data == []:
             self.logger.info("No rows to bigquery.")
             return
 
         for d in frame_data:
-            d["replay_id"] = replay_id
-            d["round_id"] = round_id
-            d["p1_input"] = " ".join(d["p1_input"])
-            d["p2_input"] = " ".join(d["p2_input"])
-
-        table_id = f"{self.bq_client.project}.{self.dataset_name}.{self.table_name}"
-        self.logger.info(f"Inserting data into {table_id}")
-        errors = self.bq_client.insert_rows_json(table_id, frame_data)
+            row = {
+                "replay_id": replay_id,
+                "round_id": round_id,
+                "frame_id": d["frame_id"],
+                "p1_input": " ".join(d["p1_input"]),
+                "p2_input": " ".join(d["p2_input"]),
+            }
+            self._rows.append(row)
+            self._rows_bytes += len(json.dumps(row))
+
+        if self.write_mode == STREAM_WRITE_MODE and (
+            len(self._rows) >= self.flush_rows
+            or self._rows_bytes >= self.flush_bytes
+            or time.monotonic() - self._last_flushed_at >= self.flush_interval
+        ):
+            self.flush()
+
+    def flush(self):
+        rows = self._rows
+        self._rows = []
+        self._rows_bytes = 0
+        self._last_flushed_at = time.monotonic()
+
+        if not rows:
+            return
 
-        if errors == []:
-            self.logger.info("New rows have been added.")
+        if self.write_mode == LOAD_WRITE_MODE:
+            self._load(rows)
         else:
+            for chunk in self._chunk(rows):
+                self._stream(chunk)
+
+    def _chunk(self, rows: list[dict]):
+        """Split the rows within the request size limit."""
+        chunk = []
+        chunk_bytes = 0
+
+        for row in rows:
+            row_bytes = len(json.dumps(row))
+
+            if chunk and (
+                len(chunk) >= self.flush_rows
+                or chunk_bytes + row_bytes > self.flush_bytes
+            ):
+                yield chunk
+                chunk = []
+                chunk_bytes = 0
+
+            chunk.append(row)
+            chunk_bytes += row_bytes
+
+        if chunk:
+            yield chunk
+
+    def _stream(self, rows: list[dict]):
+        self.logger.info(f"Inserting {len(rows)} rows into {self.table_id}")
+        keys = {(row["replay_id"], row["round_id"]) for row in rows}
+
+        for attempt in range(self.max_retries + 1):
+            errors = self.bq_client.insert_rows_json(
+                self.table_id,
+                rows,
+                row_ids=[self._row_id(row) for row in rows],
+            )
+
+            if errors == []:
+                self.logger.info("New rows have been added.")
+                self.index.add(keys)
+                return
+
+            self.logger.warning(
+                "Encountered errors while inserting rows: {}".format(errors[:10])
+            )
+
+            # Retry only the failed rows.
+            failed = sorted({error["index"] for error in errors})
+            rows = [rows[i] for i in failed]
+
+            if attempt < self.max_retries:
+                time.sleep(2**attempt)
+
+        raise Exception(f"Failed to insert {len(rows)} rows into {self.table_id}")
+
+    def _load(self, rows: list[dict]):
+        df = pd.DataFrame(rows, columns=[field.name for field in self.schema])
+
+        for (replay_id, round_id), round_df in df.groupby(["replay_id", "round_id"]):
+            # Replace the rows of the round once, so that the rows loaded by the previous run are not duplicated.
+            if (replay_id, round_id) not in self._replaced_rounds:
+                # Not existing until the rows are loaded again e.g. if the load fails.
+                self.index.discard([(replay_id, int(round_id))])
+                self._delete_round(replay_id, round_id)
+                self._replaced_rounds.add((replay_id, round_id))
+
             self.logger.info(
-                "Encountered errors while inserting rows: {}".format(errors)
+                f"Loading {len(round_df)} rows into {self.table_id}",
+                extra={"replay_id": replay_id, "round_id": round_id},
             )
+            self._load_dataframe(round_df)
+            self.index.add([(replay_id, int(round_id))])
+
+    @retry(max_retries=3, delay=2)
+    def _delete_round(self, replay_id, round_id):
+        self.bq_client.query(
+            f"DELETE FROM `{self.table_id}` WHERE replay_id = '{replay_id}' AND round_id = {round_id}"
+        ).result()
+
+    @retry(max_retries=3, delay=2)
+    def _load_dataframe(self, df: pd.DataFrame):
+        job_config = bigquery.LoadJobConfig(
+            schema=self.schema,
+            write_disposition=bigquery.WriteDisposition.WRITE_APPEND,
+        )
+        self.bq_client.load_table_from_dataframe(
+            df, self.table_id, job_config=job_config
+        ).result()
+
+    def _row_id(self, row: dict) -> str:
+        return f"{row['replay_id']}-{row['round_id']}-{row['frame_id']}"
 
-    def iterate_rounds(
+    def get_all_rows(
         self,
         mode: str,
         use_cache: bool = False,
-        min_round_frame_length: int = 1200,  # At least the round is longer than 20 sec (20 * 60 frames)
-        limit: Optional[int] = None,
         character: Optional[str] = None,
+        delta=timedelta(days=30),  # last 30 days
     ):
-        all_rows = self.get_all_rows(
-            character=character,
-            mode=mode,
-            use_cache=use_cache,
+        """
+        Rows of the frames recorded in the last `delta`.
+
+        With `use_cache`, the rows are cached per `mode` and `character` in `cache_dir`,
+        and only the rows recorded in the last `cache_lookback_days` before the cached ones or later are fetched.
+        `recorded_at` is when the replay was recorded, not when its rows were inserted, so the cached rows of
+        the lookback window are replaced by the fetched ones to pick up the replays analyzed late or again.
+        """
+        min_recorded_at = (datetime.now(timezone.utc) - delta).strftime(
+            "%Y-%m-%d %H:%M:%S"
         )
-        all_rows_by_group = all_rows.groupby(["replay_id", "round_id"])
 
-        iter_count = 0
+        if not use_cache:
+            print(f"loading from big query")
+            return self._query_rows(mode, character, min_recorded_at)
 
-        for (replay_id, round_id), round_rows in all_rows_by_group:
-            if len(round_rows) < min_round_frame_length:
-                print(
-                    f"WARN: Frames for this round is too short. Skipped. replay_id: {replay_id} | round_id: {round_id}"
-                )
-                continue
+        cache = RowsCache(
+            os.path.join(self.cache_dir, self._cache_name(mode, character)),
+            keys=["replay_id", "round_id", "frame_id"],
+            time_column="recorded_at",
+        )
 
-            iter_count += 1
-            if limit and iter_count > limit:
-                print(f"WARN: Reached iteration limit: {limit}")
-                break
+        if cache.since is None or min_recorded_at < cache.since:
+            cache.reset(since=min_recorded_at)
 
-            yield (replay_id, round_id, round_rows)
+        # Inclusive, so that the rows recorded in the same second as the window start are not missed.
+        after = min_recorded_at
 
-    def get_all_rows(
+        if cache.watermark is not None:
+            lookback = datetime.strptime(cache.watermark, "%Y-%m-%d %H:%M:%S") - (
+                timedelta(days=self.cache_lookback_days)
+            )
+            after = max(after, lookback.strftime("%Y-%m-%d %H:%M:%S"))
+
+        print(
+            f"loading from big query after {after} into local cache {cache.cache_dir}"
+        )
+        new_rows = self._query_rows(mode, character, after)
+        cache.merge(new_rows, since=after)
+        all_rows = cache.read(since=min_recorded_at)
+
+        # Nothing is cached, but the columns are still needed by the callers.
+        return new_rows if all_rows.empty else all_rows
+
+    def iterate_row_chunks(
         self,
         mode: str,
-        use_cache: bool = False,
         character: Optional[str] = None,
         delta=timedelta(days=30),  # last 30 days
+        chunk_size: int = 100_000,
     ):
-        CACHE_FILE_NAME = "frame_dataset.pkl"
+        """Same rows as `get_all_rows` in DataFrames of `chunk_size` rows, paged through the query result."""
+        min_recorded_at = (datetime.now(timezone.utc) - delta).strftime(
+            "%Y-%m-%d %H:%M:%S"
+        )
+
+        print(f"loading from big query in chunks of {chunk_size} rows")
+        rows = self.bq_client.query(
+            self._rows_query(mode, character, min_recorded_at)
+        ).result(page_size=chunk_size)
+
+        yield from rows.to_dataframe_iterable()
 
-        if use_cache and os.path.isfile(CACHE_FILE_NAME):
-            print(f"loading from local cache {CACHE_FILE_NAME}")
-            return pd.read_pickle(CACHE_FILE_NAME)
+    def _query_rows(self, mode: str, character: Optional[str], min_recorded_at: str):
+        return self.bq_client.query(
+            self._rows_query(mode, character, min_recorded_at)
+        ).to_dataframe()
 
+    def _rows_query(
+        self, mode: str, character: Optional[str], min_recorded_at: str
+    ) -> str:
         where_clauses = []
 
         if character:
@@ -253,25 +523,20 @@ class FrameDataset(BaseBqClient):
                 f"(p1_character = '{character}' OR p2_character = '{character}')"
             )
 
-        min_recorded_at = (datetime.now(timezone.utc) - delta).strftime(
-            "%Y-%m-%d %H:%M:%S"
-        )
         where_clauses.append(f'recorded_at >= "{min_recorded_at}"')
         where_clauses.append(f"p1_mode = '{mode}' AND p2_mode = '{mode}'")
 
         table_id = f"{self.bq_client.project}.{self.dataset_name}.frames"
 
-        print(f"loading from big query")
-        all_rows = self.bq_client.query(
-            f"""
+        return f"""
         SELECT *
         FROM `{table_id}`
         WHERE {" AND ".join(where_clauses)}
         ORDER BY replay_id, round_id, frame_id
         """
-        ).to_dataframe()
 
-        if use_cache:
-            all_rows.to_pickle(CACHE_FILE_NAME)
-
-        return all_rows
+    def _cache_name(self, mode: str, character: Optional[str]) -> str:
+        key = json.dumps(
+            [self.bq_client.project, self.dataset_name, mode, character]
+        ).encode()
+        return f"{mode}-{character or 'all'}-{hashlib.sha1(key).hexdigest()[:8]}"
@@ -0,0 +1,121 @@
+import atexit
+import os
+import pathlib
+import queue
+import threading
+from collections import deque
+from typing import Optional
+import cv2 as cv
+import numpy as np
+
+OFF = "off"
+ERROR = "error"
+SAMPLED = "sampled"
+ALL = "all"
+LEVELS = [OFF, ERROR, SAMPLED, ALL]
+
+
+class DebugImageCapture:
+    """
+    Debug images captured on the hot path of the analyzer e.g. `last_images/frame.jpeg`.
+
+    Levels:
+    - `off` ... No images are written.
+    - `error` ... The images of the last `buffer_size` frames are kept in memory,
+      and written only when `flush` is called on an error.
+    - `sampled` ... Same as `error`, and the images of every `sample_interval` frame are written.
+    - `all` ... The images of every frame are written.
+
+    Images are encoded and written by a background thread through a queue of `queue_size`.
+    """
+
+    def __init__(
+        self,
+        level: str = ALL,
+        sample_interval: int = 60,
+        buffer_size: int = 3,
+        queue_size: int = 256,
+    ):
+        level = level or ALL
+
+        if level not in LEVELS:
+            raise ValueError(
+                f"Unknown debug image level: {level}. Choose from {LEVELS}"
+            )
+
+        self.level = level
+        self.sample_interval = sample_interval or 1
+        self.buffer_size = buffer_size or 1
+        self.queue_size = queue_size or 256
+        self.frame_id: Optional[int] = None
+        # Images of the last frames i.e. [(frame_id, {path: image})]
+        self._buffer = deque(maxlen=self.buffer_size)
+        self._queue = None
+        self._thread = None
+
+    def begin_frame(self, frame_id: int):
+        self.frame_id = frame_id
+
+        if self.level in [ERROR, SAMPLED]:
+            self._buffer.append((frame_id, {}))
+
+    def capture(self, image: np.ndarray, path: str):
+        if self.level == OFF:
+            return
+
+        if self.level == ALL or self._is_sampled():
+            self._write(image, path)
+
+        if self.level in [ERROR, SAMPLED] and self._buffer:
+            _, images = self._buffer[-1]
+            images[path] = image
+
+    def flush(self):
+        """Write the images of the buffered frames. The last frame is written with the original names."""
+        while self._buffer:
+            frame_id, images = self._buffer.popleft()
+
+            for path, image in images.items():
+                if self._buffer:
+                    # Previous frames e.g. `last_images/123_frame.jpeg`
+                    path = os.path.join(
+                        os.path.dirname(path), f"{frame_id}_{os.path.basename(path)}"
+                    )
+
+                self._write(image, path)
+
+        self.wait()
+
+    def wait(self):
+        """Wait until the queued images are written."""
+        if self._queue is not None:
+            self._queue.join()
+
+    def _is_sampled(self) -> bool:
+        return (
+            self.level == SAMPLED
+            and self.frame_id is not None
+            and self.frame_id % self.sample_interval == 0
+        )
+
+    def _write(self, image: np.ndarray, path: str):
+        if self._thread is None:
+            self._queue = queue.Queue(maxsize=self.queue_size)
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+            atexit.register(self.wait)
+
+        # Blocks when the writer falls behind, so that the memory stays bounded.
+        self._queue.put((image, path))
+
+    def _run(self):
+        while True:
+            image, path = self._queue.get()
+
+            try:
+                pathlib.Path(path).parent.mkdir(parents=True, exist_ok=True)
+                cv.imwrite(path, image)
+            except Exception as e:
+                print(f"WARN: failed to write a debug image {path}: {e}")
+            finally:
+                self._queue.task_done()
@@ -0,0 +1,37 @@
+import cv2 as cv
+import numpy as np
+from typing import Optional
+
+
+class DuplicateDetector:
+    """
+    Detects a frame that is the same as the previous one e.g. a frame captured twice by the recorder.
+
+    Frames are compared by the mean squared error of the grayscale images as `GameWindowHelper.mse` does.
+    The grayscale image of the previous frame is kept, so that a frame is converted only once.
+    """
+
+    def __init__(self, threthold: float = 5):
+        self.threthold = threthold
+        self.previous: Optional[np.ndarray] = None
+
+    def reduce(self, frame: np.ndarray) -> np.ndarray:
+        return cv.cvtColor(frame, cv.COLOR_BGR2GRAY)
+
+    def is_duplicate(self, frame: np.ndarray) -> bool:
+        return self.is_duplicate_reduced(self.reduce(frame))
+
+    def is_duplicate_reduced(self, reduced: np.ndarray) -> bool:
+        ret = False
+        if self.previous is not None:
+            ret = self.mse(reduced, self.previous) < self.threthold
+
+        self.previous = reduced
+        return ret
+
+    def mse(self, reduced1: np.ndarray, reduced2: np.ndarray) -> float:
+        h, w = reduced1.shape
+        diff = cv.subtract(reduced1, reduced2)
+        # Squared in uint8 as `GameWindowHelper.mse` does.
+        err = np.sum(diff**2)
+        return err / float(h * w)
@@ -0,0 +1,128 @@
+import re
+import sqlite3
+from types import SimpleNamespace
+from typing import Optional
+import pandas as pd
+
+
+class FakeBqClient:
+    """
+    In-memory stand-in of `bigquery.Client` for running the datasets locally e.g. for testing.
+
+    Only the APIs used by the datasets are supported, and the queries run on SQLite.
+    Streaming inserts are deduplicated by the row IDs as BigQuery does on a best-effort basis.
+    `insert_errors` are returned by the following `insert_rows_json` calls one by one,
+    so that failed rows can be simulated e.g. `[[{"index": 0, "errors": [...]}]]`.
+    """
+
+    def __init__(
+        self,
+        project: str = "local",
+        location: str = "local",
+        insert_errors: Optional[list[list[dict]]] = None,
+    ):
+        self.project = project
+        self.location = location
+        self.insert_errors = insert_errors or []
+        self.connection = sqlite3.connect(":memory:", check_same_thread=False)
+        self._row_ids = set()
+
+    def create_dataset(self, dataset, timeout=None):
+        return dataset
+
+    def create_table(self, table, exists_ok=False):
+        columns = ", ".join(f'"{field.name}"' for field in table.schema)
+        self.connection.execute(
+            f"CREATE TABLE {'IF NOT EXISTS ' if exists_ok else ''}{self._table_name(table)} ({columns})"
+        )
+        return table
+
+    def insert_rows_json(self, table, json_rows, row_ids=None, **kwargs):
+        errors = self.insert_errors.pop(0) if self.insert_errors else []
+        failed = {error["index"] for error in errors}
+        table_name = self._table_name(table)
+
+        for i, row in enumerate(json_rows):
+            if i in failed:
+                continue
+
+            row_id = (table_name, row_ids[i]) if row_ids else None
+
+            if row_id in self._row_ids:
+                continue
+
+            if row_id:
+                self._row_ids.add(row_id)
+
+            columns = ", ".join(f'"{column}"' for column in row)
+            placeholders = ", ".join("?" for _ in row)
+            self.connection.execute(
+                f"INSERT INTO {table_name} ({columns}) VALUES ({placeholders})",
+                list(row.values()),
+            )
+
+        return errors
+
+    def load_table_from_dataframe(self, dataframe, destination, **kwargs):
+        dataframe.to_sql(
+            self._table_name(destination).strip('"'),
+            self.connection,
+            if_exists="append",
+            index=False,
+        )
+        return _FakeJob()
+
+    def query(self, query, **kwargs):
+        query = re.sub(
+            rf"`?{re.escape(self.project)}\.(\w+)\.(\w+)`?",
+            lambda m: f'"{m.group(1)}.{m.group(2)}"',
+            query,
+        )
+        return _FakeQueryJob(self.connection, query)
+
+    def _table_name(self, table) -> str:
+        table_id = table if isinstance(table, str) else str(table)
+        table_id = table_id.removeprefix(f"{self.project}.")
+        return f'"{table_id}"'
+
+
+class _FakeJob:
+    def result(self):
+        return self
+
+
+class _FakeQueryJob:
+    def __init__(self, connection: sqlite3.Connection, query: str):
+        self.connection = connection
+        self.query = query
+
+    def result(self, page_size: Optional[int] = None, **kwargs):
+        cursor = self.connection.execute(self.query)
+        self.connection.commit()
+
+        if cursor.description is None:
+            return _FakeRowIterator([], [], page_size)
+
+        columns = [column[0] for column in cursor.description]
+        return _FakeRowIterator(
+            [SimpleNamespace(**dict(zip(columns, row))) for row in cursor],
+            columns,
+            page_size,
+        )
+
+    def to_dataframe(self):
+        return pd.read_sql_query(self.query, self.connection)
+
+
+class _FakeRowIterator(list):
+    def __init__(self, rows: list, columns: list[str], page_size: Optional[int]):
+        super().__init__(rows)
+        self.columns = columns
+        self.page_size = page_size or len(rows) or 1
+
+    def to_dataframe_iterable(self):
+        for i in range(0, len(self), self.page_size):
+            yield pd.DataFrame(
+                [vars(row) for row in self[i : i + self.page_size]],
+                columns=self.columns,
+            )
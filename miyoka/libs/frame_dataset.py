@@ -0,0 +1,113 @@
+from abc import ABC, abstractmethod
+from typing import Iterable, Optional
+import pandas as pd
+
+__all__ = ["BaseFrameDataset"]
+
+
+class BaseFrameDataset(ABC):
+    @abstractmethod
+    def existing_rounds(self, *args, **kwargs): ...
+
+    @abstractmethod
+    def insert(self, *args, **kwargs): ...
+
+    @abstractmethod
+    def flush(self, *args, **kwargs): ...
+
+    @abstractmethod
+    def get_all_rows(self, *args, **kwargs): ...
+
+    @abstractmethod
+    def iterate_row_chunks(self, *args, **kwargs): ...
+
+    def is_exists(self, replay_id, round_id):
+        return (replay_id, round_id) in self.existing_rounds([(replay_id, round_id)])
+
+    def iterate_rounds(
+        self,
+        mode: str,
+        use_cache: bool = False,
+        min_round_frame_length: int = 1200,  # At least the round is longer than 20 sec (20 * 60 frames)
+        limit: Optional[int] = None,
+        character: Optional[str] = None,
+        chunk_size: Optional[int] = None,
+    ):
+        """
+        Yield the rows per round.
+
+        With `chunk_size`, the rows are read in chunks ordered by round instead of all at once,
+        so that only a round is kept in memory. `use_cache` is not supported in this mode.
+        """
+        if chunk_size and not use_cache:
+            rounds = self._group_chunks_by_round(
+                self.iterate_row_chunks(
+                    mode=mode, character=character, chunk_size=chunk_size
+                )
+            )
+        else:
+            all_rows = self.get_all_rows(
+                character=character,
+                mode=mode,
+                use_cache=use_cache,
+            )
+            rounds = (
+                (replay_id, round_id, round_rows)
+                for (replay_id, round_id), round_rows in all_rows.groupby(
+                    ["replay_id", "round_id"]
+                )
+            )
+
+        iter_count = 0
+
+        for replay_id, round_id, round_rows in rounds:
+            if len(round_rows) < min_round_frame_length:
+                print(
+                    f"WARN: Frames for this round is too short. Skipped. replay_id: {replay_id} | round_id: {round_id}"
+                )
+                continue
+
+            iter_count += 1
+            if limit and iter_count > limit:
+                print(f"WARN: Reached iteration limit: {limit}")
+                break
+
+            yield (replay_id, round_id, round_rows)
+
+    def _group_chunks_by_round(self, chunks: Iterable[pd.DataFrame]):
+        """Group the chunks ordered by round. The last round of a chunk is carried over to the next chunk."""
+        pending = None
+
+        for chunk in chunks:
+            if chunk.empty:
+                continue
+
+            if pending is not None:
+                chunk = pd.concat([pending, chunk], ignore_index=True)
+
+            chunk = _to_categorical(chunk)
+            last_round = (chunk["replay_id"] == chunk["replay_id"].iloc[-1]) & (
+                chunk["round_id"] == chunk["round_id"].iloc[-1]
+            )
+            pending = chunk[last_round]
+
+            for (replay_id, round_id), round_rows in chunk[~last_round].groupby(
+                ["replay_id", "round_id"], sort=False
+            ):
+                yield (replay_id, round_id, round_rows)
+
+        if pending is not None:
+            yield (
+                pending["replay_id"].iloc[0],
+                pending["round_id"].iloc[0],
+                pending,
+            )
+
+
+def _to_categorical(rows: pd.DataFrame) -> pd.DataFrame:
+    """Convert the inputs e.g. "6 lp" to categorical codes, because the same inputs repeat in most of the frames."""
+    for column in ["p1_input", "p2_input"]:
+        if column in rows and not isinstance(rows[column].dtype, pd.CategoricalDtype):
+            rows[column] = rows[column].astype("category")
+
+    return rows
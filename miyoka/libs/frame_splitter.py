@@ -1,10 +1,68 @@
 import cv2 as cv
+import numpy as np
 import shutil
-from typing import Iterator, Tuple
+from typing import Callable, Iterator, Optional, Tuple
 from logging import Logger
 import os
 
 
+class FrameBatch:
+    """
+    A batch of frames decoded lazily from the source.
+
+    Iterating the batch yields `(frame_id, frame)` pairs. Frames are decoded one by one
+    so that only the frame under analysis is kept in memory.
+    """
+
+    def __init__(
+        self,
+        read_frame: Callable[[int], Optional[np.ndarray]],
+        first_frame: np.ndarray,
+        start: int,
+        size: int,
+        export_dir: Optional[str] = None,
+    ) -> None:
+        self.read_frame = read_frame
+        self.first_frame = first_frame
+        self.start = start
+        self.size = size
+        self.export_dir = export_dir
+        self.stop = start
+
+    @property
+    def frame_range(self) -> range:
+        """Range of the frames decoded so far."""
+        return range(self.start, self.stop)
+
+    @property
+    def is_full(self) -> bool:
+        return (self.stop - self.start) >= self.size
+
+    def __iter__(self) -> Iterator[Tuple[int, np.ndarray]]:
+        while not self.is_full:
+            frame_id = self.stop
+
+            if frame_id == self.start:
+                frame = self.first_frame
+                self.first_frame = None
+            else:
+                frame = self.read_frame(frame_id)
+
+            if frame is None:
+                return
+
+            if self.export_dir:
+                cv.imwrite(f"{self.export_dir}/{frame_id}.jpeg", frame)
+
+            self.stop += 1
+
+            yield frame_id, frame
+
+    def drain(self):
+        for _ in self:
+            pass
+
+
 class FrameSplitter:
     def __init__(
         self,
@@ -13,34 +71,168 @@ class FrameSplitter:
         batch_size: int,
         clear_per_batch: bool,
         skip_split: bool,
+        seek_stride: int = 0,
     ) -> None:
         self.logger = logger
         self.export_dir = export_dir
         self.batch_size = batch_size
         self.clear_per_batch = clear_per_batch
         self.skip_split = skip_split
+        self.seek_stride = seek_stride or 0
 
     def split_in_batch(
         self,
         video_path: str,
-    ) -> Iterator[Tuple[range, str]]:
+        export: bool = False,
+        start: int = 0,
+    ) -> Iterator[Tuple[FrameBatch, int]]:
+        """
+        Split the video into batches of frames from `start`.
+
+        Frames are streamed to the consumer in memory. If `export` is true,
+        they are also written to `{export_dir}/{frame_id}.jpeg` e.g. for uploading the split frames.
+        Decoding stops when the consumer closes the generator e.g. on game over.
+        """
         if self.skip_split:
             self.logger.info(
                 f"Skipping frame splitting for {video_path} as per configuration."
             )
-            frame_range = range(1, 100000)
-            yield (frame_range, self.export_dir, 100000)
+            yield from self._split_exported_frames_in_batch(start)
             return
 
-        if os.path.exists(self.export_dir):
-            shutil.rmtree(self.export_dir)
+        if export:
+            if os.path.exists(self.export_dir):
+                shutil.rmtree(self.export_dir)
 
-        if not os.path.exists(self.export_dir):
-            os.makedirs(self.export_dir)
+            if not os.path.exists(self.export_dir):
+                os.makedirs(self.export_dir)
 
         self.logger.info(f"Reading frames from {video_path}")
         vidcap = cv.VideoCapture(video_path)
+        total_frame_count = self._validate(vidcap)
+        _grab_frames(vidcap, start)
+
+        def read_frame(frame_id: int) -> Optional[np.ndarray]:
+            success, image = vidcap.read()
+            return image if success else None
+
+        if export:
+            self.logger.info(
+                f"Splitted frames will be exported to {self.export_dir} directory with batch size {self.batch_size}."
+            )
+
+        try:
+            for batch in self._iterate_batches(
+                read_frame, export_dir=self.export_dir if export else None, start=start
+            ):
+                yield (batch, total_frame_count)
+        finally:
+            vidcap.release()
+
+    def find_start_frame(
+        self,
+        video_path: str,
+        is_analyzable: Callable[[int, np.ndarray], bool],
+    ) -> int:
+        """
+        Find the frame to start decoding from, skipping e.g. the intro before the replay is started.
+
+        Every `seek_stride` frames is probed until a frame is analyzable, and the probe before the last probed frame
+        that is not analyzable is returned. Frames in between are grabbed i.e. decoded without being converted
+        or analyzed. The frames before the start are assumed to be not analyzable, i.e. unlike analyzing every frame,
+        an analyzable frame more than a stride before the first analyzable probe is skipped.
+        It returns 0 if `seek_stride` is 0.
+        """
+        if not self.seek_stride:
+            return 0
+
+        if self.skip_split:
+            return self._find_start_frame(self._read_exported_frame, is_analyzable)
+
+        vidcap = cv.VideoCapture(video_path)
+        position = 0
+
+        def read_frame_at(frame_id: int) -> Optional[np.ndarray]:
+            nonlocal position
+
+            # Grabbing is cheaper than seeking backward to a key frame and decoding forward.
+            while position < frame_id:
+                if not vidcap.grab():
+                    return None
+                position += 1
+
+            success, image = vidcap.read()
+            position += 1
+            return image if success else None
+
+        try:
+            return self._find_start_frame(read_frame_at, is_analyzable)
+        finally:
+            vidcap.release()
+
+    def _find_start_frame(
+        self,
+        read_frame_at: Callable[[int], Optional[np.ndarray]],
+        is_analyzable: Callable[[int, np.ndarray], bool],
+    ) -> int:
+        start = 0
+        frame_id = 0
+
+        while True:
+            frame = read_frame_at(frame_id)
+
+            if frame is None or is_analyzable(frame_id, frame):
+                break
+
+            start = frame_id
+            frame_id += self.seek_stride
+
+        # One more stride back, because a frame after the start can be not analyzable
+        # e.g. when the marker of the started replay flickers at the probe.
+        start = max(start - self.seek_stride, 0)
+        self.logger.info(f"Start decoding from frame {start}")
+        return start
+
+    def count_frames(self, video_path: str) -> int:
+        vidcap = cv.VideoCapture(video_path)
+
+        try:
+            return int(self._validate(vidcap))
+        finally:
+            vidcap.release()
+
+    def read_range(
+        self,
+        video_path: str,
+        start: int,
+        stop: Optional[int] = None,
+    ) -> Iterator[Tuple[int, np.ndarray]]:
+        """
+        Read the frames from `start` until `stop` (or the end of the video) e.g. for a shard of a round.
+
+        The frame count in the container can be inaccurate, so the last shard should read until the end.
+        The frames before `start` are grabbed, so that the frames are the same as reading the video from the beginning
+        e.g. at the shard boundaries.
+        """
+        vidcap = cv.VideoCapture(video_path)
+
+        try:
+            _grab_frames(vidcap, start)
+            frame_id = start
+
+            while stop is None or frame_id < stop:
+                success, image = vidcap.read()
 
+                if not success:
+                    break
+
+                yield frame_id, image
+
+                frame_id += 1
+        finally:
+            vidcap.release()
+
+    def _validate(self, vidcap: cv.VideoCapture) -> float:
         fps = vidcap.get(5)
         self.logger.info(f"Frames per second : {fps} FPS")
 
@@ -55,46 +247,74 @@ class FrameSplitter:
         if total_frame_count < 60:
             raise ValueError("Frame count is less than 60. Invalid video file.")
 
-        frame_id = prev_frame_id = 0
+        return total_frame_count
+
+    def _split_exported_frames_in_batch(
+        self, start: int = 0
+    ) -> Iterator[Tuple[FrameBatch, int]]:
+        total_frame_count = 100000
+
+        for batch in self._iterate_batches(self._read_exported_frame, start=start):
+            yield (batch, total_frame_count)
+
+    def _read_exported_frame(self, frame_id: int) -> Optional[np.ndarray]:
+        path = f"{self.export_dir}/{frame_id}.jpeg"
+
+        if not os.path.isfile(path):
+            return None
+
+        return cv.imread(path)
+
+    def _iterate_batches(
+        self,
+        read_frame: Callable[[int], Optional[np.ndarray]],
+        export_dir: Optional[str] = None,
+        start: int = 0,
+    ) -> Iterator[FrameBatch]:
+        frame_id = start
 
-        self.logger.info(
-            f"Splitted frames will be exported to {self.export_dir} directory with batch size {self.batch_size}."
-        )
         while True:
-            success, image = vidcap.read()
+            first_frame = read_frame(frame_id)
 
-            if not success:
+            if first_frame is None:
                 break
 
-            cv.imwrite(f"{self.export_dir}/{frame_id}.jpeg", image)
+            batch = FrameBatch(
+                read_frame,
+                first_frame,
+                start=frame_id,
+                size=self.batch_size,
+                export_dir=export_dir,
+            )
+
+            yield batch
+
+            # Decode the rest of the batch in case the consumer stopped in the middle,
+            # so that the next batch starts from the correct frame.
+            batch.drain()
 
-            frame_id += 1
+            self.logger.info(f"Processed batch of frames {batch.frame_range}.")
 
-            if (frame_id - prev_frame_id) >= self.batch_size:
-                frame_range = range(prev_frame_id, frame_id)
+            if export_dir and self.clear_per_batch:
+                shutil.rmtree(export_dir)
+                os.makedirs(export_dir)
 
                 self.logger.info(
-                    f"Prepared batch of frames {frame_range} from {video_path} to {self.export_dir} directory."
+                    f"Cleared {export_dir} directory after processing batch of frames {batch.frame_range}."
                 )
-                yield (frame_range, self.export_dir, total_frame_count)
 
-                if self.clear_per_batch:
-                    shutil.rmtree(self.export_dir)
-                    os.makedirs(self.export_dir)
+            frame_id = batch.frame_range.stop
 
-                    self.logger.info(
-                        f"Cleared {self.export_dir} directory after preparing batch of frames {frame_range} from {video_path}."
-                    )
 
-                prev_frame_id = frame_id
+def _grab_frames(vidcap: cv.VideoCapture, count: int) -> bool:
+    """
+    Skip the frames by grabbing them instead of seeking.
 
-        if frame_id != prev_frame_id:
-            frame_range = range(prev_frame_id, frame_id)
+    Seeking by `CAP_PROP_POS_FRAMES` is not frame accurate e.g. for inter-coded streams,
+    so the frame IDs could differ from reading the video from the beginning.
+    """
+    for _ in range(count):
+        if not vidcap.grab():
+            return False
 
-            self.logger.info(
-                f"Prepared batch of frames {frame_range} from {video_path} to {self.export_dir}."
-            )
-            yield (frame_range, self.export_dir, total_frame_count)
-
-            if self.clear_per_batch:
-                shutil.rmtree(self.export_dir)
+    return True
@@ -4,8 +4,12 @@ import cv2 as cv
 import numpy as np
 import pathlib
 from logging import Logger
+from typing import Optional
 from google.cloud import vision
 from miyoka.libs.utils import retry
+from miyoka.libs.debug_image_capture import DebugImageCapture
+from miyoka.libs.roi_cache import RoiCache
+from miyoka.libs.template_bank import Template, TemplateBank, shared_template_bank
 
 try:
     import dxcam
@@ -21,11 +25,24 @@ DEFAULT_SCREEN_LANGUAGE = "en"
 
 
 class GameWindowHelper:
-    def __init__(self, logger: Logger, window_name: str, extra: dict, margin: int = 50):
+    def __init__(
+        self,
+        logger: Logger,
+        window_name: str,
+        extra: dict,
+        margin: int = 50,
+        template_bank: TemplateBank = shared_template_bank,
+        roi_cache_size: int = 4096,
+        debug_image_capture: Optional[DebugImageCapture] = None,
+    ):
         self.logger = logger
         self.window_name = window_name
         self.extra = extra
         self.margin = margin
+        self.template_bank = template_bank
+        self.roi_cache = RoiCache(maxsize=roi_cache_size)
+        self.debug_image_capture = debug_image_capture or DebugImageCapture()
+        self.save_image_dir = "."
         self._screen_language = DEFAULT_SCREEN_LANGUAGE
 
     def init_camera(self):
@@ -171,12 +188,20 @@ class GameWindowHelper:
         return region
 
     def save_image(self, image, name="screenshot.jpeg"):
-        current_dir = pathlib.Path().resolve()
+        current_dir = pathlib.Path(self.save_image_dir).resolve()
         file_path = current_dir.joinpath(name)
         parent_dir = pathlib.Path(file_path).parent
         parent_dir.mkdir(parents=True, exist_ok=True)
         cv.imwrite(str(file_path), image)
 
+    def capture_image(self, image, name):
+        """
+        Same as `save_image` for debug images on the hot path of the analyzer.
+
+        Images are written asynchronously per the level of `debug_image_capture`.
+        """
+        self.debug_image_capture.capture(image, os.path.join(self.save_image_dir, name))
+
     def all_templates(self, dir):
         template_files = []
 
@@ -186,6 +211,9 @@ class GameWindowHelper:
 
         return template_files
 
+    def load_templates(self, dir) -> list[Template]:
+        return self.template_bank.get(dir)
+
     def mirror_p2_roi_from(self, p1_roi):
         (x, y, width, height) = p1_roi
         return (self._current_screen_width - (x + width), y, width, height)
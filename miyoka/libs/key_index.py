@@ -0,0 +1,106 @@
+import json
+import os
+import pathlib
+import time
+from typing import Hashable, Iterable, Optional
+
+
+class KeyIndex:
+    """
+    Local set of the keys known to exist in a table e.g. analyzed `(replay_id, round_id)` pairs.
+
+    A key in the index has rows in the table, so the check doesn't need a query. A key is removed by `discard`
+    before its rows are deleted e.g. replaced by `write_mode: load`, and added again after they are written.
+    Keys not in the index are resolved by the dataset with a query and added here.
+    `watermark` is the latest value fetched by an incremental refresh e.g. `recorded_at`.
+    When `path` is given, the index is persisted as JSON lines of the added and removed keys and reused by the next run.
+    A line is appended per change, and the lines are compacted into one when the index is read.
+    """
+
+    def __init__(self, path: Optional[str] = None):
+        self.path = path
+        self.watermark: Optional[str] = None
+        self.refreshed_at: Optional[float] = None
+        self._keys = set()
+
+        if self.path and os.path.exists(self.path):
+            self._read()
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._keys
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+    def add(self, keys: Iterable[Hashable], watermark: Optional[str] = None):
+        new_keys = [key for key in set(keys) if key not in self._keys]
+        self._keys.update(new_keys)
+        entry = {}
+
+        if new_keys:
+            entry["keys"] = new_keys
+
+        if watermark is not None and (
+            self.watermark is None or watermark > self.watermark
+        ):
+            self.watermark = entry["watermark"] = watermark
+
+        self._append(entry)
+
+    def discard(self, keys: Iterable[Hashable]):
+        removed_keys = [key for key in set(keys) if key in self._keys]
+        self._keys.difference_update(removed_keys)
+
+        if removed_keys:
+            self._append({"removed": removed_keys})
+
+    def mark_refreshed(self):
+        self.refreshed_at = time.monotonic()
+
+    def is_stale(self, refresh_interval: float) -> bool:
+        return (
+            self.refreshed_at is None
+            or time.monotonic() - self.refreshed_at >= refresh_interval
+        )
+
+    def _read(self):
+        with open(self.path) as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    # e.g. the last line written partially by a crashed run
+                    continue
+
+                # JSON has no tuples, so the composite keys are restored from lists.
+                self._keys.update(_key(key) for key in entry.get("keys", []))
+                self._keys.difference_update(
+                    _key(key) for key in entry.get("removed", [])
+                )
+                self.watermark = entry.get("watermark") or self.watermark
+
+        self._write()
+
+    def _append(self, entry: dict):
+        if not self.path or not entry:
+            return
+
+        pathlib.Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+
+        with open(self.path, "a") as f:
+            f.write(json.dumps(entry) + "\n")
+
+    def _write(self):
+        tmp_path = f"{self.path}.tmp"
+
+        with open(tmp_path, "w") as f:
+            f.write(
+                json.dumps({"watermark": self.watermark, "keys": list(self._keys)})
+                + "\n"
+            )
+
+        os.replace(tmp_path, self.path)
+
+
+def _key(key) -> Hashable:
+    return tuple(key) if isinstance(key, list) else key
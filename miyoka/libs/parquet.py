@@ -0,0 +1,236 @@
+import json
+import os
+import shutil
+import urllib.parse
+from datetime import datetime, timezone, timedelta
+from logging import Logger
+from typing import Optional
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+from miyoka.libs.frame_dataset import BaseFrameDataset
+
+PARTITIONING = ds.partitioning(
+    pa.schema([("replay_id", pa.string()), ("round_id", pa.int64())]),
+    flavor="hive",
+)
+
+SCHEMA = pa.schema(
+    [
+        ("frame_id", pa.int64()),
+        ("p1_input", pa.dictionary(pa.int32(), pa.string())),
+        ("p2_input", pa.dictionary(pa.int32(), pa.string())),
+        ("p1_character", pa.string()),
+        ("p2_character", pa.string()),
+        ("p1_mode", pa.string()),
+        ("p2_mode", pa.string()),
+        ("played_at", pa.string()),
+        ("recorded_at", pa.timestamp("us")),
+    ]
+)
+
+
+class ParquetFrameDataset(BaseFrameDataset):
+    """
+    Frame data of the analyzed rounds in local Parquet files e.g. for offline analysis without BigQuery.
+
+    Files are partitioned by round i.e. `<base_dir>/replay_id=<replay-id>/round_id=<round-id>/part-0.parquet`.
+    `replay_id` in the directory name is URI-encoded as the hive partitioning of pyarrow decodes it.
+    `p1_input` and `p2_input` are dictionary encoded. The character, mode and recorded time of the replay
+    are stored per row, so that `get_all_rows` filters them by the Parquet statistics without reading the rows.
+    """
+
+    def __init__(self, base_dir: str, logger: Logger):
+        self.base_dir = base_dir
+        self.logger = logger
+
+        self._rows = {}
+        self._replaced_rounds = set()
+
+    def existing_rounds(self, keys: list[tuple[str, int]]) -> set[tuple[str, int]]:
+        return {
+            (replay_id, round_id)
+            for replay_id, round_id in keys
+            if self._part_files(replay_id, round_id)
+        }
+
+    def insert(
+        self,
+        replay_id,
+        round_id,
+        frame_data: list[dict],
+        metadata: Optional[dict] = None,
+    ):
+        """Buffer the rows. Call `flush` when the round is done."""
+        if frame_data == []:
+            self.logger.info("No rows to parquet.")
+            return
+
+        if isinstance(metadata, str):
+            metadata = json.loads(metadata)
+
+        metadata = metadata or {}
+        p1 = metadata.get("p1", {})
+        p2 = metadata.get("p2", {})
+        recorded_at = datetime.now(timezone.utc).replace(tzinfo=None)
+        rows = self._rows.setdefault((replay_id, round_id), [])
+
+        for d in frame_data:
+            rows.append(
+                {
+                    "frame_id": d["frame_id"],
+                    "p1_input": " ".join(d["p1_input"]),
+                    "p2_input": " ".join(d["p2_input"]),
+                    "p1_character": p1.get("character"),
+                    "p2_character": p2.get("character"),
+                    "p1_mode": p1.get("mode"),
+                    "p2_mode": p2.get("mode"),
+                    "played_at": metadata.get("played_at"),
+                    "recorded_at": recorded_at,
+                }
+            )
+
+    def flush(self):
+        rounds = self._rows
+        self._rows = {}
+
+        for (replay_id, round_id), rows in rounds.items():
+            round_dir = self._round_dir(replay_id, round_id)
+
+            # Replace the files of the round once, so that the rows written by the previous run are not duplicated.
+            if (replay_id, round_id) not in self._replaced_rounds:
+                shutil.rmtree(round_dir, ignore_errors=True)
+                self._replaced_rounds.add((replay_id, round_id))
+
+            os.makedirs(round_dir, exist_ok=True)
+            part = len(self._part_files(replay_id, round_id))
+            path = os.path.join(round_dir, f"part-{part}.parquet")
+            # Hidden until written, so that a partially written file is not read.
+            tmp_path = os.path.join(round_dir, f".part-{part}.parquet.tmp")
+
+            self.logger.info(
+                f"Writing {len(rows)} rows into {path}",
+                extra={"replay_id": replay_id, "round_id": round_id},
+            )
+            pq.write_table(pa.Table.from_pylist(rows, schema=SCHEMA), tmp_path)
+            os.replace(tmp_path, path)
+
+    def get_all_rows(
+        self,
+        mode: str,
+        use_cache: bool = False,
+        character: Optional[str] = None,
+        delta=timedelta(days=30),  # last 30 days
+    ):
+        """Same as `FrameDataset.get_all_rows`. `use_cache` is ignored, because the files are local."""
+        columns = ["replay_id", "round_id"] + SCHEMA.names
+
+        if not os.path.isdir(self.base_dir):
+            return pd.DataFrame(columns=columns)
+
+        dataset = ds.dataset(
+            self.base_dir,
+            schema=pa.unify_schemas([PARTITIONING.schema, SCHEMA]),
+            format="parquet",
+            partitioning=PARTITIONING,
+        )
+        table = dataset.to_table(
+            columns=columns, filter=self._filter(mode, character, delta)
+        ).sort_by(
+            [
+                ("replay_id", "ascending"),
+                ("round_id", "ascending"),
+                ("frame_id", "ascending"),
+            ]
+        )
+
+        return table.to_pandas()
+
+    def iterate_row_chunks(
+        self,
+        mode: str,
+        character: Optional[str] = None,
+        delta=timedelta(days=30),  # last 30 days
+        chunk_size: Optional[int] = None,
+    ):
+        """Same rows as `get_all_rows` in a DataFrame per round. `chunk_size` is ignored, because a file is a round."""
+        if not os.path.isdir(self.base_dir):
+            return
+
+        expression = self._filter(mode, character, delta)
+
+        for replay_id, round_id in self._iterate_partitions():
+            dataset = ds.dataset(
+                self._part_paths(replay_id, round_id), schema=SCHEMA, format="parquet"
+            )
+            rows = dataset.to_table(filter=expression).sort_by("frame_id").to_pandas()
+
+            if rows.empty:
+                continue
+
+            rows.insert(0, "replay_id", replay_id)
+            rows.insert(1, "round_id", round_id)
+            yield rows
+
+    def _filter(self, mode: str, character: Optional[str], delta: timedelta):
+        min_recorded_at = (datetime.now(timezone.utc) - delta).replace(tzinfo=None)
+        expression = (
+            (ds.field("recorded_at") >= pa.scalar(min_recorded_at, pa.timestamp("us")))
+            & (ds.field("p1_mode") == mode)
+            & (ds.field("p2_mode") == mode)
+        )
+
+        if character:
+            expression &= (ds.field("p1_character") == character) | (
+                ds.field("p2_character") == character
+            )
+
+        return expression
+
+    def _iterate_partitions(self):
+        """Yield `(replay_id, round_id)` of the files in the order of `get_all_rows`."""
+        replay_dirs = {
+            urllib.parse.unquote(replay_dir.removeprefix("replay_id=")): replay_dir
+            for replay_dir in os.listdir(self.base_dir)
+            if replay_dir.startswith("replay_id=")
+        }
+
+        for replay_id in sorted(replay_dirs):
+            round_ids = [
+                int(round_dir.removeprefix("round_id="))
+                for round_dir in os.listdir(
+                    os.path.join(self.base_dir, replay_dirs[replay_id])
+                )
+                if round_dir.startswith("round_id=")
+            ]
+
+            for round_id in sorted(round_ids):
+                if self._part_files(replay_id, round_id):
+                    yield replay_id, round_id
+
+    def _part_paths(self, replay_id, round_id) -> list[str]:
+        round_dir = self._round_dir(replay_id, round_id)
+        return [
+            os.path.join(round_dir, name)
+            for name in self._part_files(replay_id, round_id)
+        ]
+
+    def _round_dir(self, replay_id, round_id) -> str:
+        return os.path.join(
+            self.base_dir,
+            f"replay_id={urllib.parse.quote(str(replay_id), safe='')}",
+            f"round_id={round_id}",
+        )
+
+    def _part_files(self, replay_id, round_id) -> list[str]:
+        round_dir = self._round_dir(replay_id, round_id)
+
+        if not os.path.isdir(round_dir):
+            return []
+
+        return [
+            name
+            for name in os.listdir(round_dir)
+            if name.startswith("part-") and name.endswith(".parquet")
+        ]
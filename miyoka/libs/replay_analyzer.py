@@ -1,11 +1,19 @@
 from logging import Logger
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import contextlib
+import multiprocessing
+import os
+import shutil
+import tempfile
+import traceback
 from dependency_injector.providers import Factory
 from miyoka.libs.frame_splitter import FrameSplitter
 from miyoka.libs.storages import (
     FrameStorage,
     ReplayStorage,
 )
-from miyoka.libs.bigquery import ReplayDataset, FrameDataset
+from miyoka.libs.bigquery import ReplayDataset
+from miyoka.libs.frame_dataset import BaseFrameDataset
 from miyoka.libs.exceptions import (
     GameOver,
 )
@@ -22,9 +30,11 @@ class ReplayAnalyzer:
         replay_dataset: ReplayDataset,
         replay_storage: ReplayStorage,
         frame_storage: FrameStorage,
-        frame_dataset: FrameDataset,
+        frame_dataset: BaseFrameDataset,
         frame_splitter: FrameSplitter,
         round_analyzer_factory: Factory[RoundAnalyzer],
+        workers: int = 1,
+        round_shards: int = 1,
     ):
         self.logger = logger
         self.replay_id = replay_id
@@ -36,6 +46,8 @@ class ReplayAnalyzer:
         self.frame_dataset = frame_dataset
         self.frame_splitter = frame_splitter
         self.round_analyzer_factory = round_analyzer_factory
+        self.workers = workers or 1
+        self.round_shards = round_shards or 1
 
     def run(
         self,
@@ -43,65 +55,394 @@ class ReplayAnalyzer:
         self.logger.info(f"Analyzing replay {self.replay_id}")
         metadata = self.replay_dataset.get_metadata(self.replay_id)
         self.logger.info("Metadata", extra={"metadata": metadata})
-        for round_id in self.replay_storage.iterate_rounds(self.replay_id):
-            if self.frame_dataset.is_exists(self.replay_id, round_id):
+
+        all_round_ids = list(self.replay_storage.iterate_rounds(self.replay_id))
+        analyzed_rounds = self.frame_dataset.existing_rounds(
+            [(self.replay_id, round_id) for round_id in all_round_ids]
+        )
+
+        round_ids = []
+        for round_id in all_round_ids:
+            if (self.replay_id, round_id) in analyzed_rounds:
                 self.logger.info(
                     f"Skipping round {round_id} as it is already analyzed.",
                     extra={"replay_id": self.replay_id, "round_id": round_id},
                 )
                 continue
 
-            with self.replay_storage.open(self.replay_id, round_id) as download_path:
+            round_ids.append(round_id)
+
+        try:
+            # When a round is split into shards, the workers are used for the shards instead.
+            if self.workers > 1 and len(round_ids) > 1 and self.round_shards <= 1:
+                self.analyze_rounds_in_parallel(round_ids, metadata)
+                return
+
+            for round_id in round_ids:
+                with self.replay_storage.open(
+                    self.replay_id, round_id
+                ) as download_path:
+                    try:
+                        self.analyze_round(
+                            round_id,
+                            download_path,
+                            metadata,
+                        )
+                    finally:
+                        self.frame_dataset.flush()
+
+                        if self.upload_last_images:
+                            self.frame_storage.upload_as_zip(
+                                "last_images",
+                                f"{self.replay_id}/{round_id}/last_images.zip",
+                            )
+        finally:
+            # The frames are uploaded in the background while the next frames are analyzed.
+            self.frame_storage.wait()
+
+    def analyze_round(
+        self,
+        round_id: int,
+        download_path: str,
+        metadata: dict,
+    ):
+        if self.round_shards > 1:
+            if self.upload_split_frames or self.frame_splitter.skip_split:
+                self.logger.info(
+                    "Round sharding is not supported with upload_split_frames or skip_split. Analyzing the round in a single process.",
+                    extra={"replay_id": self.replay_id, "round_id": round_id},
+                )
+            else:
+                self.analyze_round_in_shards(round_id, download_path, metadata)
+                return
+
+        round_analyzer = self.round_analyzer_factory(
+            replay_id=self.replay_id, round_id=round_id, metadata=metadata
+        )
+        start = self.frame_splitter.find_start_frame(
+            download_path, round_analyzer.is_analyzable
+        )
+        # Closed on game over, so that the rest of the video is not decoded.
+        with contextlib.closing(
+            self.frame_splitter.split_in_batch(
+                download_path, export=self.upload_split_frames, start=start
+            )
+        ) as batches:
+            for (
+                frame_batch,
+                total_frame_count,
+            ) in batches:
                 try:
-                    self.analyze_round(
-                        round_id,
-                        download_path,
-                        metadata,
+                    round_analyzer.analyze_frames(frame_batch)
+                except GameOver:
+                    break
+                except Exception as e:
+                    self.logger.error(
+                        str(e),
+                        extra={
+                            "replay_id": self.replay_id,
+                            "round_id": round_id,
+                            "frame_range": frame_batch.frame_range,
+                        },
                     )
+                    raise
                 finally:
-                    if self.upload_last_images:
-                        self.frame_storage.upload_as_zip(
-                            "last_images",
-                            f"{self.replay_id}/{round_id}/last_images.zip",
+                    with round_analyzer.read_frame_data() as frame_data:
+                        self.frame_dataset.insert(
+                            self.replay_id, round_id, frame_data, metadata
                         )
 
-    def analyze_round(
+                if self.upload_split_frames:
+                    frame_range = frame_batch.frame_range
+                    first_range = frame_range.start
+                    last_range = frame_range[-1]
+                    self.frame_storage.upload_as_zip(
+                        self.frame_splitter.export_dir,
+                        f"{self.replay_id}/{round_id}/frames/{first_range}-{last_range}.zip",
+                        # The frame files are not rewritten, but removed per batch or round.
+                        link=True,
+                    )
+
+    def analyze_rounds_in_parallel(
+        self,
+        round_ids: list[int],
+        metadata: dict,
+    ):
+        """
+        Analyze the rounds in worker processes.
+
+        Each worker splits and analyzes a round in its own scratch directory,
+        and the frame data and the files to upload are returned to this process.
+        """
+        self.logger.info(
+            f"Analyzing {len(round_ids)} rounds of replay {self.replay_id} with {self.workers} workers"
+        )
+        errors = []
+
+        with contextlib.ExitStack() as stack:
+            executor = stack.enter_context(
+                self._create_worker_pool(min(self.workers, len(round_ids)))
+            )
+            futures = {}
+
+            for round_id in round_ids:
+                # Download the next round while the previous rounds are analyzed.
+                download_path = stack.enter_context(
+                    self.replay_storage.open(self.replay_id, round_id)
+                )
+                work_dir = stack.enter_context(
+                    tempfile.TemporaryDirectory(
+                        prefix=f"miyoka-{self.replay_id}-{round_id}-"
+                    )
+                )
+                future = executor.submit(
+                    _analyze_round_in_worker,
+                    replay_id=self.replay_id,
+                    round_id=round_id,
+                    download_path=download_path,
+                    metadata=metadata,
+                    work_dir=work_dir,
+                    upload_split_frames=self.upload_split_frames,
+                )
+                futures[future] = (round_id, work_dir)
+
+            for future in as_completed(futures):
+                round_id, work_dir = futures[future]
+                result = future.result()
+
+                for insert_args in result["inserts"]:
+                    self.frame_dataset.insert(*insert_args)
+
+                self.frame_dataset.flush()
+
+                for source_dir, dest_path in result["uploads"]:
+                    self.frame_storage.upload_as_zip(source_dir, dest_path, link=True)
+
+                if self.upload_last_images:
+                    self.frame_storage.upload_as_zip(
+                        os.path.join(work_dir, "last_images"),
+                        f"{self.replay_id}/{round_id}/last_images.zip",
+                    )
+
+                if result["error"]:
+                    self.logger.error(
+                        result["error"],
+                        extra={"replay_id": self.replay_id, "round_id": round_id},
+                    )
+                    errors.append(round_id)
+
+        if errors:
+            raise Exception(
+                f"Failed to analyze rounds {errors} of replay {self.replay_id}"
+            )
+
+    def analyze_round_in_shards(
         self,
         round_id: int,
         download_path: str,
         metadata: dict,
     ):
+        """
+        Analyze a round split into contiguous frame ranges in worker processes.
+
+        Each worker observes its shard with a round analyzer of its own, and the observations
+        are analyzed in order in this process. The result is the same as `analyze_round`, because a worker grabs
+        the frames before its shard instead of seeking. The workers stop observing their shards once the round is over.
+        """
         round_analyzer = self.round_analyzer_factory(
             replay_id=self.replay_id, round_id=round_id, metadata=metadata
         )
+        start = self.frame_splitter.find_start_frame(
+            download_path, round_analyzer.is_analyzable
+        )
+        total_frame_count = self.frame_splitter.count_frames(download_path)
+        shard_size = max(-(-(total_frame_count - start) // self.round_shards), 1)
+        starts = list(range(start, max(total_frame_count, start + 1), shard_size))
+        # The last shard reads until the end, because the frame count can be inaccurate.
+        stops = starts[1:] + [None]
+        max_workers = self.workers if self.workers > 1 else self.round_shards
+
+        self.logger.info(
+            f"Analyzing round {round_id} in {len(starts)} shards of {shard_size} frames with {max_workers} workers",
+            extra={"replay_id": self.replay_id, "round_id": round_id},
+        )
+
+        with contextlib.ExitStack() as stack:
+            # Entered before the pool, so that it is shut down after the workers.
+            manager = stack.enter_context(
+                multiprocessing.get_context("spawn").Manager()
+            )
+            stop_event = manager.Event()
+            executor = stack.enter_context(self._create_worker_pool(max_workers))
+            futures = []
+
+            for start, stop in zip(starts, stops):
+                work_dir = stack.enter_context(
+                    tempfile.TemporaryDirectory(
+                        prefix=f"miyoka-{self.replay_id}-{round_id}-{start}-"
+                    )
+                )
+                future = executor.submit(
+                    _observe_shard_in_worker,
+                    replay_id=self.replay_id,
+                    round_id=round_id,
+                    download_path=download_path,
+                    metadata=metadata,
+                    start=start,
+                    stop=stop,
+                    work_dir=work_dir,
+                    stop_event=stop_event,
+                )
+                futures.append((future, start, work_dir))
 
-        for (
-            frame_range,
-            frame_dir,
-            total_frame_count,
-        ) in self.frame_splitter.split_in_batch(download_path):
             try:
-                round_analyzer.analyze_frames(frame_range, frame_dir)
+                for future, start, work_dir in futures:
+                    shard = future.result()
+
+                    try:
+                        round_analyzer.analyze_shard(shard)
+                    finally:
+                        _keep_last_images(work_dir)
+
+                        with round_analyzer.read_frame_data() as frame_data:
+                            self.frame_dataset.insert(
+                                self.replay_id, round_id, frame_data, metadata
+                            )
             except GameOver:
-                break
+                pass
             except Exception as e:
                 self.logger.error(
                     str(e),
                     extra={
                         "replay_id": self.replay_id,
                         "round_id": round_id,
-                        "frame_range": frame_range,
+                        "shard_start": start,
                     },
                 )
                 raise
             finally:
-                with round_analyzer.read_frame_data() as frame_data:
-                    self.frame_dataset.insert(self.replay_id, round_id, frame_data)
-
-            if self.upload_split_frames:
-                first_range = frame_range.start
-                last_range = frame_range[-1]
-                self.frame_storage.upload_as_zip(
-                    frame_dir,
-                    f"{self.replay_id}/{round_id}/frames/{first_range}-{last_range}.zip",
-                )
+                # Cancelling stops only the shards not started yet. The running workers check the event.
+                stop_event.set()
+
+                for future, _, _ in futures:
+                    future.cancel()
+
+    def _create_worker_pool(self, max_workers: int) -> ProcessPoolExecutor:
+        return ProcessPoolExecutor(
+            max_workers=max_workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_worker,
+        )
+
+
+class _FrameDataCollector:
+    """Stand-in of FrameDataset in a worker process. The frame data is inserted by the parent process."""
+
+    def __init__(self):
+        self.inserts = []
+
+    def insert(self, replay_id, round_id, frame_data: list[dict], metadata=None):
+        self.inserts.append((replay_id, round_id, list(frame_data), metadata))
+
+    def flush(self):
+        pass
+
+
+class _UploadCollector:
+    """Stand-in of FrameStorage in a worker process. The files are uploaded by the parent process."""
+
+    def __init__(self, work_dir: str):
+        self.work_dir = work_dir
+        self.uploads = []
+
+    def upload_as_zip(self, source_dir, dest_path, link: bool = False):
+        # Keep a copy, because the source dir is cleared per batch.
+        kept_dir = os.path.join(self.work_dir, "uploads", str(len(self.uploads)))
+        shutil.copytree(source_dir, kept_dir)
+        self.uploads.append((kept_dir, dest_path))
+
+    def wait(self):
+        pass
+
+
+_worker_container = None
+
+
+def _init_worker():
+    global _worker_container
+
+    # Imported here, because the container depends on this module.
+    from miyoka.container import Container
+
+    _worker_container = Container()
+
+
+def _analyze_round_in_worker(
+    replay_id: str,
+    round_id: int,
+    download_path: str,
+    metadata: dict,
+    work_dir: str,
+    upload_split_frames: bool,
+) -> dict:
+    game_window_helper = _worker_container.game_window_helper()
+    game_window_helper.save_image_dir = work_dir
+
+    frame_dataset = _FrameDataCollector()
+    frame_storage = _UploadCollector(work_dir)
+    replay_analyzer = _worker_container.replay_analyzer(
+        replay_id=replay_id,
+        upload_split_frames=upload_split_frames,
+        replay_dataset=None,
+        replay_storage=None,
+        frame_dataset=frame_dataset,
+        frame_storage=frame_storage,
+        frame_splitter=_worker_container.frame_splitter(
+            export_dir=os.path.join(work_dir, "frames")
+        ),
+        workers=1,
+        round_shards=1,
+    )
+
+    error = None
+    try:
+        replay_analyzer.analyze_round(round_id, download_path, metadata)
+    except Exception:
+        error = traceback.format_exc()
+
+    return {
+        "inserts": frame_dataset.inserts,
+        "uploads": frame_storage.uploads,
+        "error": error,
+    }
+
+
+def _observe_shard_in_worker(
+    replay_id: str,
+    round_id: int,
+    download_path: str,
+    metadata: dict,
+    start: int,
+    stop: int,
+    work_dir: str,
+    stop_event=None,
+) -> dict:
+    game_window_helper = _worker_container.game_window_helper()
+    game_window_helper.save_image_dir = work_dir
+
+    round_analyzer = _worker_container.round_analyzer(
+        replay_id=replay_id, round_id=round_id, metadata=metadata
+    )
+    frame_splitter = _worker_container.frame_splitter()
+
+    return round_analyzer.observe_frames(
+        frame_splitter.read_range(download_path, start, stop), stop_event=stop_event
+    )
+
+
+def _keep_last_images(work_dir: str):
+    """Keep the last images of a shard as the last images of the round."""
+    last_images_dir = os.path.join(work_dir, "last_images")
+
+    if os.path.exists(last_images_dir):
+        shutil.copytree(last_images_dir, "last_images", dirs_exist_ok=True)
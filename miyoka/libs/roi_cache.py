@@ -0,0 +1,68 @@
+from collections import OrderedDict
+from typing import Any, Callable, Hashable
+import numpy as np
+
+
+class RoiCache:
+    """
+    LRU cache of the results identified from cropped images (ROIs).
+
+    The key is the pixels of the cropped image, so that the same contents e.g. while an input is held
+    return the cached result without matching the templates again. `maxsize=0` disables the cache.
+    """
+
+    def __init__(self, maxsize: int = 4096):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._results = OrderedDict()
+
+    def key(self, namespace: Hashable, image: np.ndarray) -> tuple:
+        return (namespace, image.shape, image.tobytes())
+
+    def get(self, key: tuple, default=None) -> Any:
+        if key in self._results:
+            self.hits += 1
+            self._results.move_to_end(key)
+            return self._results[key]
+
+        self.misses += 1
+        return default
+
+    def put(self, key: tuple, result: Any):
+        if self.maxsize <= 0:
+            return
+
+        self._results[key] = result
+        self._results.move_to_end(key)
+
+        if len(self._results) > self.maxsize:
+            self._results.popitem(last=False)
+
+    def get_or_compute(
+        self, namespace: Hashable, image: np.ndarray, compute: Callable[[], Any]
+    ) -> Any:
+        key = self.key(namespace, image)
+        result = self.get(key, _MISSING)
+
+        if result is _MISSING:
+            result = compute()
+            self.put(key, result)
+
+        return result
+
+    def info(self) -> dict:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "size": len(self._results),
+            "maxsize": self.maxsize,
+        }
+
+    def clear(self):
+        self.hits = 0
+        self.misses = 0
+        self._results = OrderedDict()
+
+
+_MISSING = object()
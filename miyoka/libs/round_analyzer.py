@@ -7,5 +7,14 @@ class RoundAnalyzer(ABC):
     @abstractmethod
     def analyze_frames(self, *args, **kwargs): ...
 
+    @abstractmethod
+    def is_analyzable(self, *args, **kwargs): ...
+
+    @abstractmethod
+    def observe_frames(self, *args, **kwargs): ...
+
+    @abstractmethod
+    def analyze_shard(self, *args, **kwargs): ...
+
     @abstractmethod
     def read_frame_data(self, *args, **kwargs): ...
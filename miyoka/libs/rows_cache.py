@@ -0,0 +1,129 @@
+import json
+import os
+import shutil
+from typing import Optional
+import pandas as pd
+
+MANIFEST_FILE_NAME = "manifest.json"
+TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+
+class RowsCache:
+    """
+    Rows of a query cached locally in per-day partitions of `time_column` e.g. `<cache_dir>/2024-01-01.pkl`.
+
+    `since` is the oldest time the cache covers, and `watermark` is the latest time of the cached rows,
+    so that only the rows near or after the watermark are fetched and merged by `merge`.
+    The rows are deduplicated by `keys`, so fetching the rows at the watermark again is safe.
+    `merge(rows, since=...)` replaces the cached rows since the given time with `rows` i.e. the rows of the window
+    fetched again, so that the rows inserted or replaced later than their `time_column` are picked up.
+    """
+
+    def __init__(self, cache_dir: str, keys: list[str], time_column: str):
+        self.cache_dir = cache_dir
+        self.keys = keys
+        self.time_column = time_column
+        self.since: Optional[str] = None
+        self.watermark: Optional[str] = None
+
+        manifest_path = os.path.join(self.cache_dir, MANIFEST_FILE_NAME)
+
+        if os.path.isfile(manifest_path):
+            with open(manifest_path) as f:
+                manifest = json.load(f)
+
+            self.since = manifest["since"]
+            self.watermark = manifest["watermark"]
+
+    def reset(self, since: str):
+        shutil.rmtree(self.cache_dir, ignore_errors=True)
+        os.makedirs(self.cache_dir)
+        self.since = since
+        self.watermark = None
+        self._write_manifest()
+
+    def merge(self, rows: pd.DataFrame, since: Optional[str] = None):
+        """Merge the rows into the cache. With `since`, the cached rows since that time are replaced by `rows`."""
+        days = {}
+
+        if not rows.empty:
+            times = pd.to_datetime(rows[self.time_column])
+            days = dict(list(rows.groupby(times.dt.strftime("%Y-%m-%d"))))
+
+        if since is not None:
+            # The days of the window without new rows still have to drop their old rows.
+            for file_name in os.listdir(self.cache_dir):
+                day = file_name.removesuffix(".pkl")
+
+                if file_name.endswith(".pkl") and day >= since[:10]:
+                    days.setdefault(day, None)
+
+        for day, day_rows in sorted(days.items()):
+            path = self._partition_path(day)
+
+            if os.path.isfile(path):
+                cached_rows = pd.read_pickle(path)
+
+                if since is not None:
+                    cached_rows = cached_rows[
+                        pd.to_datetime(cached_rows[self.time_column])
+                        < pd.Timestamp(since)
+                    ]
+
+                day_rows = pd.concat([cached_rows, day_rows])
+
+            if day_rows is None or day_rows.empty:
+                if os.path.isfile(path):
+                    os.remove(path)
+                continue
+
+            day_rows = day_rows.drop_duplicates(subset=self.keys, keep="last")
+            tmp_path = f"{path}.tmp"
+            day_rows.to_pickle(tmp_path)
+            os.replace(tmp_path, path)
+
+        if rows.empty:
+            return
+
+        watermark = times.max().strftime(TIME_FORMAT)
+
+        if self.watermark is None or watermark > self.watermark:
+            self.watermark = watermark
+
+        self._write_manifest()
+
+    def read(self, since: str) -> pd.DataFrame:
+        """Read the rows since the given time. Older partitions are removed."""
+        frames = []
+        # Whole days are kept, so the cache still covers the rows since the beginning of the day.
+        since_day = f"{since[:10]} 00:00:00"
+
+        if self.since is None or since_day > self.since:
+            self.since = since_day
+            self._write_manifest()
+
+        for file_name in sorted(os.listdir(self.cache_dir)):
+            if not file_name.endswith(".pkl"):
+                continue
+
+            path = os.path.join(self.cache_dir, file_name)
+
+            if file_name.removesuffix(".pkl") < since[:10]:
+                os.remove(path)
+                continue
+
+            frames.append(pd.read_pickle(path))
+
+        if not frames:
+            return pd.DataFrame()
+
+        rows = pd.concat(frames, ignore_index=True)
+        rows = rows[pd.to_datetime(rows[self.time_column]) >= pd.Timestamp(since)]
+        return rows.sort_values(self.keys, ignore_index=True)
+
+    def _partition_path(self, day: str) -> str:
+        return os.path.join(self.cache_dir, f"{day}.pkl")
+
+    def _write_manifest(self):
+        with open(os.path.join(self.cache_dir, MANIFEST_FILE_NAME), "w") as f:
+            json.dump({"since": self.since, "watermark": self.watermark}, f)
@@ -1,10 +1,14 @@
-from dataclasses import dataclass
+import sys
+from array import array
+from dataclasses import dataclass, field
 import numpy as np
+import pandas as pd
 from numpy.typing import NDArray
-from typing import Optional
+from scipy.sparse import csr_matrix, issparse
+from typing import Iterable, Optional
 
 
-@dataclass
+@dataclass(slots=True)
 class Scene:
     id: int
     inputs: list[str]
@@ -14,6 +18,20 @@ class Scene:
     character: str
     vector: Optional[NDArray[np.float64]] = None
     scene_video_path: Optional[str] = None
+    _uuid: Optional[str] = field(default=None, init=False, repr=False, compare=False)
+
+    def __post_init__(self):
+        # The same string object is shared by the scenes of a replay and a character.
+        self.replay_id = sys.intern(str(self.replay_id))
+        self.character = sys.intern(str(self.character))
+
+    def __setstate__(self, state):
+        # Scenes pickled before `slots` have a dict instead of `(None, slots)`.
+        if isinstance(state, tuple):
+            state = {**(state[0] or {}), **(state[1] or {})}
+
+        for name in Scene.__slots__:
+            setattr(self, name, state.get(name))
 
     @property
     def fullpath(self) -> str:
@@ -21,4 +39,190 @@ class Scene:
 
     @property
     def uuid(self) -> str:
-        return f"{self.replay_id}-{self.round_id}-{self.character}-scene-{self.id}"
+        if self._uuid is None:
+            self._uuid = (
+                f"{self.replay_id}-{self.round_id}-{self.character}-scene-{self.id}"
+            )
+
+        return self._uuid
+
+
+class SceneBatch:
+    """
+    Scenes in columns instead of a Scene object per scene e.g. for keeping the scenes of a month in memory.
+
+    The columns are typed arrays. Replay IDs, characters and inputs are stored as codes of their distinct values,
+    and the vectors as the non-zero values i.e. CSR. Indexing and iterating create Scene objects,
+    so that a batch is used where a list of scenes is expected e.g. `SceneExporter.export(batch[i], ...)`.
+    Appended scenes are copied into the columns, i.e. changing a scene after `append` doesn't change the batch.
+    Update the batch instead e.g. `batch.scene_video_paths[i] = video_path`, or keep the scenes e.g. in `SceneStore`
+    until they are saved.
+    """
+
+    def __init__(self, scenes: Iterable[Scene] = ()):
+        self.replay_ids: list[str] = []
+        self.characters: list[str] = []
+        self.vocabulary: list[str] = []
+        self.scene_video_paths: list[Optional[str]] = []
+
+        self._codes = {"replay_id": {}, "character": {}, "input": {}}
+        self._ids = array("q")
+        self._round_ids = array("q")
+        self._frame_starts = array("q")
+        self._frame_stops = array("q")
+        self._replay_codes = array("i")
+        self._character_codes = array("i")
+        self._input_codes = array("i")
+        self._offsets = array("q", [0])
+        self._vector_indices = array("i")
+        self._vector_data = array("d")
+        self._vector_indptr = array("q", [0])
+        # Unknown until the first scene
+        self._vector_width: Optional[int] = None
+        self._is_vectorized: Optional[bool] = None
+        self._is_dense: bool = True
+
+        self.extend(scenes)
+
+    def __len__(self) -> int:
+        return len(self._ids)
+
+    def __getitem__(self, index: int) -> Scene:
+        if index < 0:
+            index += len(self)
+
+        if not 0 <= index < len(self):
+            raise IndexError(f"Scene index out of range: {index}")
+
+        codes = self._input_codes[self._offsets[index] : self._offsets[index + 1]]
+
+        return Scene(
+            id=self._ids[index],
+            inputs=[self.vocabulary[code] for code in codes],
+            frame_range=range(self._frame_starts[index], self._frame_stops[index]),
+            replay_id=self.replay_ids[self._replay_codes[index]],
+            round_id=self._round_ids[index],
+            character=self.characters[self._character_codes[index]],
+            vector=self._vector(index),
+            scene_video_path=self.scene_video_paths[index],
+        )
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+    def append(self, scene: Scene):
+        self._append_vector(scene.vector)
+        self._ids.append(scene.id)
+        self._round_ids.append(scene.round_id)
+        self._frame_starts.append(scene.frame_range.start)
+        self._frame_stops.append(scene.frame_range.stop)
+        self._replay_codes.append(
+            _code(self._codes["replay_id"], self.replay_ids, scene.replay_id)
+        )
+        self._character_codes.append(
+            _code(self._codes["character"], self.characters, scene.character)
+        )
+        self._input_codes.extend(
+            _code(self._codes["input"], self.vocabulary, token)
+            for token in scene.inputs
+        )
+        self._offsets.append(len(self._input_codes))
+        self.scene_video_paths.append(scene.scene_video_path)
+
+    def extend(self, scenes: Iterable[Scene]):
+        for scene in scenes:
+            self.append(scene)
+
+    @property
+    def input_codes(self) -> np.ndarray:
+        """Codes of `vocabulary` of all the scenes. The inputs of scene i are `input_codes[offsets[i]:offsets[i + 1]]`."""
+        return np.array(self._input_codes, dtype=np.int32)
+
+    @property
+    def offsets(self) -> np.ndarray:
+        return np.array(self._offsets, dtype=np.int64)
+
+    @property
+    def metadata(self) -> pd.DataFrame:
+        return pd.DataFrame(
+            {
+                "scene_id": np.array(self._ids, dtype=np.int64),
+                "replay_id": np.array(self.replay_ids, dtype=object)[
+                    np.array(self._replay_codes, dtype=np.int32)
+                ],
+                "round_id": np.array(self._round_ids, dtype=np.int64),
+                "character": np.array(self.characters, dtype=object)[
+                    np.array(self._character_codes, dtype=np.int32)
+                ],
+                "frame_start": np.array(self._frame_starts, dtype=np.int64),
+                "frame_stop": np.array(self._frame_stops, dtype=np.int64),
+                "scene_video_path": pd.Series(self.scene_video_paths, dtype=object),
+            }
+        )
+
+    @property
+    def vectors(self):
+        """N x D vectors, sparse if the scenes have sparse vectors. None if the scenes are not vectorized."""
+        if not self._is_vectorized:
+            return None
+
+        vectors = csr_matrix(
+            (
+                np.array(self._vector_data, dtype=np.float64),
+                np.array(self._vector_indices, dtype=np.int32),
+                np.array(self._vector_indptr, dtype=np.int64),
+            ),
+            shape=(len(self), self._vector_width),
+        )
+        return vectors.toarray() if self._is_dense else vectors
+
+    def _append_vector(self, vector):
+        is_vectorized = vector is not None
+
+        if self._is_vectorized is None:
+            self._is_vectorized = is_vectorized
+        elif self._is_vectorized != is_vectorized:
+            raise ValueError("Some scenes are not vectorized.")
+
+        if not is_vectorized:
+            return
+
+        if issparse(vector):
+            row = csr_matrix(vector)
+            indices, data = row.indices, row.data
+            self._is_dense = False
+        else:
+            vector = np.asarray(vector).ravel()
+            indices = np.flatnonzero(vector)
+            data = vector[indices]
+
+        self._vector_width = self._vector_width or vector.shape[-1]
+        self._vector_indices.extend(indices.tolist())
+        self._vector_data.extend(data.tolist())
+        self._vector_indptr.append(len(self._vector_indices))
+
+    def _vector(self, index: int):
+        if not self._is_vectorized:
+            return None
+
+        start, stop = self._vector_indptr[index], self._vector_indptr[index + 1]
+        vector = csr_matrix(
+            (
+                np.array(self._vector_data[start:stop], dtype=np.float64),
+                np.array(self._vector_indices[start:stop], dtype=np.int32),
+                np.array([0, stop - start], dtype=np.int64),
+            ),
+            shape=(1, self._vector_width),
+        )
+        return vector.toarray()[0] if self._is_dense else vector
+
+
+def _code(codes: dict[str, int], values: list[str], value: str) -> int:
+    code = codes.get(value)
+
+    if code is None:
+        code = codes[value] = len(values)
+        values.append(value)
+
+    return code
@@ -1,63 +1,431 @@
+import contextlib
 import cv2
+import itertools
+import json
+import multiprocessing
 import os
 import shutil
 import pathlib
+from concurrent.futures import (
+    ALL_COMPLETED,
+    FIRST_COMPLETED,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    wait,
+)
+from typing import Callable, ContextManager, Iterable, Iterator, Optional, Union
+import numpy as np
 from miyoka.libs.scene import Scene
 
+FRAMES_SOURCE = "frames"
+VIDEO_SOURCE = "video"
+SOURCES = [FRAMES_SOURCE, VIDEO_SOURCE]
+
+COPY_OUTPUT = "copy"
+HARDLINK_OUTPUT = "hardlink"
+SYMLINK_OUTPUT = "symlink"
+MANIFEST_OUTPUT = "manifest"
+SIMILARITY_OUTPUTS = [COPY_OUTPUT, HARDLINK_OUTPUT, SYMLINK_OUTPUT, MANIFEST_OUTPUT]
+
 
 class SceneExporter:
+    """
+    Export scenes to mp4 videos.
+
+    Sources:
+    - `frames` ... The split frames of a round i.e. `<frames-dir>/<frame-id>.jpeg` downloaded by `FrameStorage.download_frames`,
+      or the frames in the zip files read by `FrameStorage.read_frames` instead of the dir.
+    - `video` ... The round video e.g. downloaded by `ReplayStorage`. Only the frames of the scenes are decoded
+      by seeking to the scenes, so that the split frames are not needed.
+
+    Similarity outputs (`export_by_similarity`):
+    - `copy` ... Copy the video of the similar scene.
+    - `hardlink` ... Hard link to the video of the similar scene. Copied if the link fails e.g. across file systems.
+      The link is the same file as the scene video, so exporting the scene again in place changes the link too.
+    - `symlink` ... Relative symbolic link to the video of the similar scene.
+    - `manifest` ... Only a line per similar scene in `<SIMILARITY_OUTPUT_DIR>/manifest.jsonl`.
+      `materialize_by_similarity` creates the files later e.g. for a base scene.
+      A line is not appended again for the same similar scene e.g. when the similar scenes are output again.
+    """
+
     FPS = 25
     OUTPUT_DIR = "scenes"
     SIMILARITY_OUTPUT_DIR = "scenes_by_similarity"
     PREFIX_FRAME_SIZE = 0
     SUFFIX_FRAME_SIZE = 10
+    # Frames read ahead while the previous frames are encoded
+    PREFETCH_FRAME_SIZE = 8
+    # Seek the video instead of decoding the frames in between if the next scene is farther than this.
+    SEEK_FRAME_SIZE = 120
+    MANIFEST_FILE_NAME = "manifest.jsonl"
 
-    def __init__(self):
-        pass
+    def __init__(
+        self,
+        workers: int = 1,
+        source: str = FRAMES_SOURCE,
+        similarity_output: str = COPY_OUTPUT,
+    ):
+        source = source or FRAMES_SOURCE
+        similarity_output = similarity_output or COPY_OUTPUT
 
-    def export(self, scene: Scene, frames_dir_path: str) -> str:
-        video_path = (
-            f"{self.OUTPUT_DIR}/{scene.replay_id}/{scene.round_id}/scene-{scene.id}.mp4"
-        )
+        if source not in SOURCES:
+            raise ValueError(f"Unknown scene source: {source}. Choose from {SOURCES}")
 
-        os.makedirs(
-            f"{self.OUTPUT_DIR}/{scene.replay_id}/{scene.round_id}", exist_ok=True
-        )
+        if similarity_output not in SIMILARITY_OUTPUTS:
+            raise ValueError(
+                f"Unknown similarity output: {similarity_output}. Choose from {SIMILARITY_OUTPUTS}"
+            )
+
+        self.workers = workers or 1
+        self.source = source
+        self.similarity_output = similarity_output
+        # Entries of the manifest by `dst_path`. Read when the first entry is output.
+        self._manifest_entries: Optional[dict[str, dict]] = None
+
+    def export(self, scene: Scene, source_path: str) -> Optional[str]:
+        """Export the scene from `source_path` i.e. the frames directory or the round video of `source`."""
+        return self._export_round([scene], source_path, self.source)[0]
+
+    def export_many(
+        self,
+        scenes: Iterable[Scene],
+        source_path: Union[str, Callable[[Scene], str]],
+    ) -> list[Optional[str]]:
+        """
+        Export the scenes and return the video paths in the same order. None if the scene has no frames.
+
+        `source_path` is the frames directory or the round video of a scene
+        e.g. `lambda scene: f"download/{scene.replay_id}/{scene.round_id}/frames"`.
+        A source that is a context manager e.g. `ZippedFrames` is closed after the scenes of its round are exported.
+        The scenes of a round are exported together, so that a frame is read once for the overlapping scenes.
+        The rounds are exported in `workers` processes, and a source is opened only when a worker is about to be free.
+        """
+
+        def open_source(scene: Scene) -> ContextManager[str]:
+            source = source_path(scene) if callable(source_path) else source_path
+
+            if isinstance(source, contextlib.AbstractContextManager):
+                return source
+
+            return contextlib.nullcontext(source)
+
+        return self._export_rounds(scenes, open_source, self.source)
+
+    def export_from_replay_storage(
+        self, scenes: Iterable[Scene], replay_storage
+    ) -> list[Optional[str]]:
+        """
+        Same as `export_many`, but cut the scenes from the round videos in `ReplayStorage` instead of the split frames.
+
+        A round video is downloaded once for its scenes and removed after the scenes are exported
+        unless `skip_download` of the storage is true.
+        """
+
+        def open_source(scene: Scene) -> ContextManager[str]:
+            return replay_storage.open(scene.replay_id, scene.round_id)
+
+        return self._export_rounds(scenes, open_source, VIDEO_SOURCE)
+
+    def _export_rounds(
+        self,
+        scenes: Iterable[Scene],
+        open_source: Callable[[Scene], ContextManager[str]],
+        source: str,
+    ) -> list[Optional[str]]:
+        rounds = {}
+        count = 0
+
+        for index, scene in enumerate(scenes):
+            round_scenes = rounds.setdefault((scene.replay_id, scene.round_id), [])
+            round_scenes.append((index, scene))
+            count += 1
+
+        video_paths = [None] * count
+
+        def collect(round_scenes, round_video_paths):
+            for (index, _), video_path in zip(round_scenes, round_video_paths):
+                video_paths[index] = video_path
+
+        if self.workers <= 1 or len(rounds) <= 1:
+            for round_scenes in rounds.values():
+                round_scenes_only = [scene for _, scene in round_scenes]
+
+                with open_source(round_scenes_only[0]) as source_path:
+                    collect(
+                        round_scenes,
+                        self._export_round(round_scenes_only, source_path, source),
+                    )
+
+            return video_paths
+
+        max_workers = min(self.workers, len(rounds))
+
+        with contextlib.ExitStack() as stack:
+            # Entered before the pool, so that the sources are closed after the workers stopped e.g. on an error.
+            sources = stack.enter_context(contextlib.ExitStack())
+            executor = stack.enter_context(
+                ProcessPoolExecutor(
+                    max_workers=max_workers,
+                    mp_context=multiprocessing.get_context("spawn"),
+                )
+            )
+            futures = {}
+
+            def collect_done(return_when):
+                done, _ = wait(futures, return_when=return_when)
+
+                for future in done:
+                    round_scenes, round_sources = futures.pop(future)
+                    collect(round_scenes, future.result())
+                    # e.g. remove the downloaded video as soon as its round is exported
+                    round_sources.close()
+
+            for round_scenes in rounds.values():
+                round_scenes_only = [scene for _, scene in round_scenes]
+                # Open the next source e.g. download the next video while the workers export the previous rounds,
+                # but only one more than the workers, so that the sources don't pile up.
+                round_sources = sources.enter_context(contextlib.ExitStack())
+                source_path = round_sources.enter_context(
+                    open_source(round_scenes_only[0])
+                )
+
+                if len(futures) >= max_workers:
+                    collect_done(FIRST_COMPLETED)
+
+                future = executor.submit(
+                    self._export_round, round_scenes_only, source_path, source
+                )
+                futures[future] = (round_scenes, round_sources)
+
+            collect_done(ALL_COMPLETED)
+
+        return video_paths
+
+    def _export_round(
+        self, scenes: list[Scene], source_path: str, source: str
+    ) -> list[Optional[str]]:
+        """
+        Export the scenes of a round by reading the frames in order once.
 
-        images = [
-            f"{frames_dir_path}/{i}.jpeg"
-            for i in range(
-                scene.frame_range.start - self.PREFIX_FRAME_SIZE,
+        A frame is written to the videos of all the scenes whose range contains it,
+        and a video is closed after its last frame.
+        """
+        frame_ranges = [
+            range(
+                max(scene.frame_range.start - self.PREFIX_FRAME_SIZE, 0),
                 scene.frame_range.stop + self.SUFFIX_FRAME_SIZE,
             )
+            for scene in scenes
         ]
-        images = [image for image in images if os.path.isfile(image)]
-        frame = cv2.imread(images[0])
-        height, width, layers = frame.shape
+        frame_ids = set().union(*frame_ranges)
 
-        video = cv2.VideoWriter(
-            video_path, cv2.VideoWriter_fourcc(*"mp4v"), self.FPS, (width, height)
-        )
+        if source == FRAMES_SOURCE and not isinstance(source_path, str):
+            # e.g. `ZippedFrames` of `FrameStorage.read_frames`, i.e. the frames are not extracted.
+            frame_ids = frame_ids.intersection(source_path.frame_ids)
+            frames = (source_path.read(i) for i in sorted(frame_ids))
+        elif source == FRAMES_SOURCE:
+            frame_ids = {
+                i for i in frame_ids if os.path.isfile(f"{source_path}/{i}.jpeg")
+            }
+            frames = (cv2.imread(f"{source_path}/{i}.jpeg") for i in sorted(frame_ids))
+        else:
+            # The frame count of a video can be inaccurate, so the frames are read until the end.
+            frames = self._read_video_frames(source_path, sorted(frame_ids))
+
+        # The last frame per scene. Scenes without frames are not exported.
+        last_frame_ids = {
+            index: max(frame_ids.intersection(frame_range))
+            for index, frame_range in enumerate(frame_ranges)
+            if not frame_ids.isdisjoint(frame_range)
+        }
+        order = sorted(last_frame_ids, key=lambda index: frame_ranges[index].start)
+        video_paths = [None] * len(scenes)
+        videos = {}
+        next_scene = 0
+
+        try:
+            for frame_id, frame in self._prefetch(zip(sorted(frame_ids), frames)):
+                if frame is None:
+                    break
+
+                # Open the videos of the scenes starting by this frame.
+                while (
+                    next_scene < len(order)
+                    and frame_ranges[order[next_scene]].start <= frame_id
+                ):
+                    index = order[next_scene]
+                    video_paths[index] = self._video_path(scenes[index])
+                    height, width, _ = frame.shape
+                    videos[index] = cv2.VideoWriter(
+                        video_paths[index],
+                        cv2.VideoWriter_fourcc(*"mp4v"),
+                        self.FPS,
+                        (width, height),
+                    )
+                    next_scene += 1
+
+                for index, video in list(videos.items()):
+                    if frame_id not in frame_ranges[index]:
+                        continue
+
+                    video.write(frame)
+
+                    if frame_id == last_frame_ids[index]:
+                        video.release()
+                        del videos[index]
+        finally:
+            # e.g. the video ended before the last frame of the scene
+            for video in videos.values():
+                video.release()
+
+        return video_paths
+
+    def _read_video_frames(
+        self, video_path: str, frame_ids: list[int]
+    ) -> Iterator[Optional[np.ndarray]]:
+        """Decode the frames of `frame_ids` in order. It yields None if the video ended."""
+        vidcap = cv2.VideoCapture(video_path)
+        position = 0
+
+        try:
+            for frame_id in frame_ids:
+                if frame_id - position > self.SEEK_FRAME_SIZE:
+                    vidcap.set(cv2.CAP_PROP_POS_FRAMES, frame_id)
+                    position = frame_id
+
+                # Grabbing is cheaper than seeking backward to a key frame and decoding forward.
+                while position < frame_id:
+                    if not vidcap.grab():
+                        yield None
+                        return
+                    position += 1
 
-        for image in images:
-            video.write(cv2.imread(image))
+                success, frame = vidcap.read()
+                position += 1
+                yield frame if success else None
 
-        cv2.destroyAllWindows()
-        video.release()
+                if not success:
+                    return
+        finally:
+            vidcap.release()
 
-        return video_path
+    def _prefetch(self, frames: Iterator) -> Iterator:
+        """Read the frames in a thread ahead of the encoding."""
+        frames = iter(frames)
 
-    def export_by_similarity(self, base_scene: Scene, target_scene: Scene):
+        def read_chunk() -> list:
+            return list(itertools.islice(frames, self.PREFETCH_FRAME_SIZE))
+
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            future = executor.submit(read_chunk)
+
+            while chunk := future.result():
+                future = executor.submit(read_chunk)
+                yield from chunk
+
+    def _video_path(self, scene: Scene) -> str:
+        os.makedirs(
+            f"{self.OUTPUT_DIR}/{scene.replay_id}/{scene.round_id}", exist_ok=True
+        )
+        return (
+            f"{self.OUTPUT_DIR}/{scene.replay_id}/{scene.round_id}/scene-{scene.id}.mp4"
+        )
+
+    def export_by_similarity(self, base_scene: Scene, target_scene: Scene) -> str:
+        """Output the video of the similar scene under the base scene by `similarity_output`, and return the path."""
         src_path = target_scene.scene_video_path
         dst_path = f"{self.SIMILARITY_OUTPUT_DIR}/{base_scene.fullpath}/{target_scene.uuid}.mp4"
-        pathlib.Path(f"{self.SIMILARITY_OUTPUT_DIR}/{base_scene.fullpath}/").mkdir(
-            parents=True, exist_ok=True
-        )
+
+        if self.similarity_output == MANIFEST_OUTPUT:
+            entry = {
+                "base_scene": base_scene.fullpath,
+                "similar_scene": target_scene.uuid,
+                "src_path": src_path,
+                "dst_path": dst_path,
+            }
+
+            if self._manifest_entries is None:
+                self._manifest_entries = self._read_manifest()
+
+            if self._manifest_entries.get(dst_path) != entry:
+                os.makedirs(self.SIMILARITY_OUTPUT_DIR, exist_ok=True)
+
+                with open(self._manifest_path(), "a") as f:
+                    f.write(json.dumps(entry) + "\n")
+
+                self._manifest_entries[dst_path] = entry
+        else:
+            self._output_file(src_path, dst_path, self.similarity_output)
+
+        return dst_path
+
+    def materialize_by_similarity(
+        self,
+        base_scene: Optional[Scene] = None,
+        similarity_output: str = COPY_OUTPUT,
+    ) -> list[str]:
+        """
+        Create the files of the similar scenes in the manifest, only of `base_scene` if given.
+        The files are linked or copied by `similarity_output`. A file is created once by its latest entry.
+        """
+        if similarity_output == MANIFEST_OUTPUT:
+            raise ValueError("The manifest can't be materialized into a manifest.")
+
+        dst_paths = []
+
+        for entry in self._read_manifest().values():
+            if base_scene and entry["base_scene"] != base_scene.fullpath:
+                continue
+
+            self._output_file(entry["src_path"], entry["dst_path"], similarity_output)
+            dst_paths.append(entry["dst_path"])
+
+        return dst_paths
+
+    def _read_manifest(self) -> dict[str, dict]:
+        """The latest entry per `dst_path` in the manifest."""
+        entries = {}
+
+        if not os.path.isfile(self._manifest_path()):
+            return entries
+
+        with open(self._manifest_path()) as f:
+            for line in f:
+                entry = json.loads(line)
+                # Moved to the end, so that the files are created in the order of the latest entries.
+                entries.pop(entry["dst_path"], None)
+                entries[entry["dst_path"]] = entry
+
+        return entries
+
+    def _output_file(self, src_path: str, dst_path: str, similarity_output: str):
+        dst_dir = os.path.dirname(dst_path)
+        pathlib.Path(dst_dir).mkdir(parents=True, exist_ok=True)
+
+        # Replaced as `copyfile` does.
+        if os.path.lexists(dst_path):
+            os.remove(dst_path)
+
+        if similarity_output == HARDLINK_OUTPUT:
+            try:
+                os.link(src_path, dst_path)
+                return
+            except OSError:
+                # e.g. across file systems
+                pass
+        elif similarity_output == SYMLINK_OUTPUT:
+            os.symlink(os.path.relpath(src_path, dst_dir), dst_path)
+            return
+
         shutil.copyfile(src_path, dst_path)
 
+    def _manifest_path(self) -> str:
+        return os.path.join(self.SIMILARITY_OUTPUT_DIR, self.MANIFEST_FILE_NAME)
+
     def clean_output_dir(self):
         shutil.rmtree(self.OUTPUT_DIR, ignore_errors=True)
         shutil.rmtree(self.SIMILARITY_OUTPUT_DIR, ignore_errors=True)
+        self._manifest_entries = None
 
 
 if __name__ == "__main__":
@@ -1,49 +1,106 @@
+import bisect
+import functools
+import json
+import os
 import pandas as pd
 from sklearn.metrics.pairwise import cosine_similarity
 import numpy as np
 import pickle
-from miyoka.libs.scene import Scene
+import shutil
+from scipy.sparse import csr_matrix, issparse, load_npz, save_npz, vstack
+from typing import Iterable, Optional
+from miyoka.libs.scene import Scene, SceneBatch
+from miyoka.libs.similarity_index import SimilarityIndex
+
+METADATA_COLUMNS = [
+    "scene_id",
+    "replay_id",
+    "round_id",
+    "character",
+    "frame_start",
+    "frame_stop",
+    "scene_video_path",
+]
 
 
 class SceneStore:
+    """
+    Scenes saved in a columnar format under `save_dir`.
+
+    `save` replaces the saved scenes, and `save(append=True)` appends the new scenes. The scenes are saved
+    in segments i.e. `<save_dir>/segment-<n>/` of
+    the metadata table (`metadata.parquet`), the inputs coded by `inputs.json` with their offsets
+    (`inputs.npy`, `offsets.npy`) and the vectors (`vectors.npy` or sparse `vectors.npz`).
+    `load` reads only the metadata. The inputs and vectors are memory-mapped when they are used,
+    and Scene objects are created only for the scenes accessed.
+    The scenes not saved yet are kept as they are, so that e.g. `scene_video_path` set after `append` is saved.
+    """
+
     SIMILARITY_THRETHOLD = 0.9
     OUTPUT_DIR = "scenes_by_similarity"
+    SAVE_DIR = "scene_store"
+    # Saved by the previous versions. Loaded when `SAVE_DIR` doesn't exist yet.
     SAVE_FILE_NAME = "scene_store.pkl"
 
-    def __init__(self):
-        self.scenes: list[Scene] = []
+    def __init__(
+        self,
+        similarity_index: Optional[SimilarityIndex] = None,
+        save_dir: Optional[str] = None,
+    ):
+        self.similarity_index = similarity_index or SimilarityIndex()
+        self.save_dir = save_dir or self.SAVE_DIR
+        self._segments: list[_SceneSegment] = []
+        # Scenes not saved yet
+        self._pending: list[Scene] = []
+        self._vocabulary: list[str] = []
+
+    def __len__(self) -> int:
+        return sum(len(segment) for segment in self._segments) + len(self._pending)
+
+    @property
+    def scenes(self) -> list[Scene]:
+        return [self.scene(i) for i in range(len(self))]
+
+    @scenes.setter
+    def scenes(self, scenes: Iterable[Scene]):
+        """Replace the scenes. The saved scenes are replaced by `save`."""
+        self._segments = []
+        self._vocabulary = []
+        self._pending = list(scenes)
+
+    def scene(self, index: int) -> Scene:
+        saved = self._saved_count()
+
+        if index >= saved:
+            return self._pending[index - saved]
+
+        starts = self._segment_starts()
+        segment_index = bisect.bisect_right(starts, index) - 1
+        return self._segments[segment_index].scene(
+            index - starts[segment_index], self._vocabulary
+        )
 
     def append(self, scene: Scene):
-        self.scenes.append(scene)
+        self._pending.append(scene)
 
-    def iterate_similar_scenes(self, columns: list[str]):
-        scene_metadata = {}
-        scene_metadata["replay_id"] = []
-        scene_metadata["round_id"] = []
-        scene_metadata["scene_id"] = []
-        scene_vectors = []
-
-        for scene in self.scenes:
-            scene_vectors.append(scene.vector)
-            scene_metadata["replay_id"].append(scene.replay_id)
-            scene_metadata["round_id"].append(scene.round_id)
-            scene_metadata["scene_id"].append(scene.id)
+    def extend(self, scenes: Iterable[Scene]):
+        self._pending.extend(scenes)
 
+    def iterate_similar_scenes(self, columns: list[str]):
         # Scene Vector DB
-        left_df = pd.DataFrame(
-            scene_metadata, columns=["replay_id", "round_id", "scene_id"]
-        )
-        right_df = pd.DataFrame(scene_vectors, columns=columns)
-        scene_df = left_df.join(right_df)
+        scene_df = self._metadata()[["replay_id", "round_id", "scene_id"]]
         print("------------ Scene vectors")
         print(scene_df)
+
+        rows, cols, _ = self.similarity_index.pairs(
+            self._vectors(), self.SIMILARITY_THRETHOLD, include_self=True
+        )
         print("------------ Cosine Similarity")
-        cos_sim = cosine_similarity(right_df, right_df)
-        print(cos_sim)
+        print(f"similar pairs: {len(rows)}")
 
-        for idx in np.argwhere(cos_sim > self.SIMILARITY_THRETHOLD):
-            base_scene = self.scenes[idx[0]]
-            target_scene = self.scenes[idx[1]]
+        for base_idx, target_idx in zip(rows, cols):
+            base_scene = self.scene(base_idx)
+            target_scene = self.scene(target_idx)
             yield base_scene, target_scene
 
     # Replay, Scenes and Frames
@@ -53,23 +110,17 @@ class SceneStore:
     # XYZ      , 2       ,   c_1   , 1          , (10, 30), (30, 60), .......
     @property
     def main_df(self) -> pd.DataFrame:
-        columns = {}
-        columns["replay_id"] = []
-        columns["round_id"] = []
-        columns["scene_id"] = []
-        columns["frame_range"] = []
-        columns["character"] = []
-
-        for scene in self.scenes:
-            columns["replay_id"].append(scene.replay_id)
-            columns["round_id"].append(scene.round_id)
-            columns["scene_id"].append(scene.id)
-            frame_range_val = f"{scene.frame_range.start}-{scene.frame_range.stop}"
-            columns["frame_range"].append(frame_range_val)
-            columns["character"].append(scene.character)
-
+        metadata = self._metadata()
         df = pd.DataFrame(
-            columns,
+            {
+                "replay_id": metadata["replay_id"],
+                "round_id": metadata["round_id"],
+                "scene_id": metadata["scene_id"],
+                "frame_range": metadata["frame_start"].astype(str)
+                + "-"
+                + metadata["frame_stop"].astype(str),
+                "character": metadata["character"],
+            },
             columns=["replay_id", "round_id", "scene_id", "frame_range", "character"],
         )
         return df
@@ -80,37 +131,29 @@ class SceneStore:
     # XYZ-1-1    ,    AYZ-3-30
     @property
     def similarity_df(self) -> pd.DataFrame:
-        columns = {}
-        columns["replay_id"] = []
-        columns["round_id"] = []
-        columns["character"] = []
-        columns["scene_id"] = []
-        columns["similar_replay_id"] = []
-        columns["similar_round_id"] = []
-        columns["similar_character"] = []
-        columns["similar_scene_id"] = []
-
-        for idx in np.argwhere(self.similarity_index > self.SIMILARITY_THRETHOLD):
-            if idx[0] == idx[1]:
-                continue  # Skip the same one
-
-            base_scene = self.scenes[idx[0]]
-            target_scene = self.scenes[idx[1]]
-
-            if base_scene.character != target_scene.character:
-                continue  # Skip different characters
-
-            columns["replay_id"].append(base_scene.replay_id)
-            columns["round_id"].append(base_scene.round_id)
-            columns["character"].append(base_scene.character)
-            columns["scene_id"].append(base_scene.id)
-            columns["similar_replay_id"].append(target_scene.replay_id)
-            columns["similar_round_id"].append(target_scene.round_id)
-            columns["similar_character"].append(target_scene.character)
-            columns["similar_scene_id"].append(target_scene.id)
+        metadata = self._metadata()
+
+        # Only the scenes of the same character are compared, and the same one is skipped.
+        rows, cols, _ = self.similarity_index.pairs(
+            self._vectors(),
+            self.SIMILARITY_THRETHOLD,
+            groups=metadata["character"].tolist(),
+        )
+
+        base_scenes = metadata.iloc[rows].reset_index(drop=True)
+        target_scenes = metadata.iloc[cols].reset_index(drop=True)
 
         df = pd.DataFrame(
-            columns,
+            {
+                "replay_id": base_scenes["replay_id"],
+                "round_id": base_scenes["round_id"],
+                "character": base_scenes["character"],
+                "scene_id": base_scenes["scene_id"],
+                "similar_replay_id": target_scenes["replay_id"],
+                "similar_round_id": target_scenes["round_id"],
+                "similar_character": target_scenes["character"],
+                "similar_scene_id": target_scenes["scene_id"],
+            },
             columns=[
                 "replay_id",
                 "round_id",
@@ -125,22 +168,238 @@ class SceneStore:
         return df
 
     @property
-    def similarity_index(self) -> np.ndarray:
-        scene_vectors = []
+    def similarity_matrix(self) -> np.ndarray:
+        """Dense N x N similarities. Use `similarity_index` for many scenes."""
+        vectors = self._vectors()
+
+        # e.g. no scenes or no scenes with vectors
+        if vectors.shape[0] == 0 or vectors.shape[1] == 0:
+            return np.zeros((vectors.shape[0], vectors.shape[0]))
+
+        return cosine_similarity(vectors, vectors)
+
+    def save(self, append: bool = False):
+        """
+        Save the scenes into `save_dir`, replacing the saved scenes as the pickle was overwritten.
+
+        With `append`, only the scenes not saved yet are appended as a new segment to the saved scenes,
+        even if they are not loaded, e.g. for adding the scenes of new replays incrementally.
+        """
+        if append:
+            if not self._pending:
+                return
+
+            if not self._segments and os.path.isdir(self.save_dir):
+                pending = self._pending
+                self.load()
+                self._pending = pending
+
+            os.makedirs(self.save_dir, exist_ok=True)
+            self._write_pending(self.save_dir)
+            return
+
+        # Written in a temporary directory, so that the saved scenes are kept if it fails.
+        tmp_dir = f"{self.save_dir}.tmp"
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        os.makedirs(tmp_dir)
+
+        # The segments are not changed once written, so they are copied as they are.
+        for index, segment in enumerate(self._segments):
+            shutil.copytree(
+                segment.segment_dir, os.path.join(tmp_dir, f"segment-{index:05d}")
+            )
 
-        for scene in self.scenes:
-            scene_vectors.append(scene.vector)
+        self._write_pending(tmp_dir)
 
-        df = pd.DataFrame(scene_vectors)
-        return cosine_similarity(df, df)
+        old_dir = f"{self.save_dir}.old"
+        shutil.rmtree(old_dir, ignore_errors=True)
 
-    def save(self):
-        with open(self.SAVE_FILE_NAME, "wb") as f:
-            pickle.dump(self.scenes, f)
+        if os.path.isdir(self.save_dir):
+            os.replace(self.save_dir, old_dir)
+
+        os.replace(tmp_dir, self.save_dir)
+        shutil.rmtree(old_dir, ignore_errors=True)
+        self.load()
+
+    def _write_pending(self, store_dir: str):
+        """Write the scenes not saved yet as the next segment of `store_dir`."""
+        segment_dir = os.path.join(store_dir, f"segment-{len(self._segments):05d}")
+        codes = {token: i for i, token in enumerate(self._vocabulary)}
+        # Converted to the columns when they are saved.
+        pending = SceneBatch(self._pending)
+
+        for token in pending.vocabulary:
+            if token not in codes:
+                codes[token] = len(self._vocabulary)
+                self._vocabulary.append(token)
+
+        # The vocabulary only grows, so the saved segments keep their codes.
+        _replace_json(os.path.join(store_dir, "inputs.json"), self._vocabulary)
+
+        if self._pending:
+            _SceneSegment.write(segment_dir, pending, codes)
+            self._segments.append(_SceneSegment(segment_dir))
+
+        self._pending = []
 
     def load(self):
-        with open(self.SAVE_FILE_NAME, "rb") as f:
-            self.scenes = pickle.load(f)
+        self._segments = []
+        self._pending = []
+        self._vocabulary = []
+
+        if not os.path.isdir(self.save_dir) and os.path.isfile(self.SAVE_FILE_NAME):
+            print(f"loading {self.SAVE_FILE_NAME}. Call save() to convert it.")
+            with open(self.SAVE_FILE_NAME, "rb") as f:
+                self._pending = pickle.load(f)
+            return
+
+        with open(os.path.join(self.save_dir, "inputs.json")) as f:
+            self._vocabulary = json.load(f)
+
+        self._segments = [
+            _SceneSegment(os.path.join(self.save_dir, name))
+            for name in sorted(os.listdir(self.save_dir))
+            if name.startswith("segment-")
+        ]
+
+    def _saved_count(self) -> int:
+        return sum(len(segment) for segment in self._segments)
+
+    def _segment_starts(self) -> list[int]:
+        return list(np.cumsum([0] + [len(segment) for segment in self._segments[:-1]]))
+
+    def _metadata(self) -> pd.DataFrame:
+        metadata = [segment.metadata for segment in self._segments]
+
+        if len(self._pending) > 0 or not metadata:
+            metadata.append(SceneBatch(self._pending).metadata)
+
+        return pd.concat(metadata, ignore_index=True)
+
+    def _vectors(self):
+        """
+        N x D vectors of the scenes, sparse if any of them is sparse.
+        The scenes without vectors have zero vectors, so that they are not similar to any scene
+        but the rows are still the indexes of the scenes.
+        """
+        vectors = [segment.vectors for segment in self._segments]
+        counts = [len(segment) for segment in self._segments]
+
+        if len(self._pending) > 0:
+            vectors.append(SceneBatch(self._pending).vectors)
+            counts.append(len(self._pending))
+
+        width = max((v.shape[1] for v in vectors if v is not None), default=0)
+
+        if any(issparse(v) for v in vectors):
+            return vstack(
+                [
+                    csr_matrix(v) if v is not None else csr_matrix((count, width))
+                    for v, count in zip(vectors, counts)
+                ],
+                format="csr",
+            )
+
+        return np.vstack(
+            [
+                v if v is not None else np.zeros((count, width))
+                for v, count in zip(vectors, counts)
+            ]
+            or [np.zeros((0, width))]
+        )
+
+
+class _SceneSegment:
+    def __init__(self, segment_dir: str):
+        self.segment_dir = segment_dir
+        self.metadata = pd.read_parquet(os.path.join(segment_dir, "metadata.parquet"))
+
+    def __len__(self) -> int:
+        return len(self.metadata)
+
+    @functools.cached_property
+    def inputs(self) -> np.ndarray:
+        return np.load(os.path.join(self.segment_dir, "inputs.npy"), mmap_mode="r")
+
+    @functools.cached_property
+    def offsets(self) -> np.ndarray:
+        return np.load(os.path.join(self.segment_dir, "offsets.npy"), mmap_mode="r")
+
+    @functools.cached_property
+    def vectors(self):
+        sparse_path = os.path.join(self.segment_dir, "vectors.npz")
+
+        if os.path.isfile(sparse_path):
+            return load_npz(sparse_path).tocsr()
+
+        dense_path = os.path.join(self.segment_dir, "vectors.npy")
+
+        if os.path.isfile(dense_path):
+            return np.load(dense_path, mmap_mode="r")
+
+        return None
+
+    def scene(self, index: int, vocabulary: list[str]) -> Scene:
+        row = self.metadata.iloc[index]
+        codes = self.inputs[self.offsets[index] : self.offsets[index + 1]]
+        vector = None
+
+        if self.vectors is not None:
+            vector = (
+                self.vectors[index]
+                if issparse(self.vectors)
+                else np.array(self.vectors[index])
+            )
+
+        return Scene(
+            id=int(row["scene_id"]),
+            inputs=[vocabulary[code] for code in codes],
+            frame_range=range(int(row["frame_start"]), int(row["frame_stop"])),
+            replay_id=row["replay_id"],
+            round_id=int(row["round_id"]),
+            character=row["character"],
+            vector=vector,
+            scene_video_path=(
+                None if pd.isna(row["scene_video_path"]) else row["scene_video_path"]
+            ),
+        )
+
+    @staticmethod
+    def write(segment_dir: str, scenes: SceneBatch, codes: dict[str, int]):
+        # Written in a temporary directory, so that a partially written segment is not loaded.
+        tmp_dir = os.path.join(
+            os.path.dirname(segment_dir), f".{os.path.basename(segment_dir)}.tmp"
+        )
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        os.makedirs(tmp_dir)
+
+        scenes.metadata[METADATA_COLUMNS].to_parquet(
+            os.path.join(tmp_dir, "metadata.parquet"), index=False
+        )
+        # Codes of the batch to the codes of the store
+        store_codes = np.array(
+            [codes[token] for token in scenes.vocabulary], dtype=np.int32
+        )
+        np.save(os.path.join(tmp_dir, "inputs.npy"), store_codes[scenes.input_codes])
+        np.save(os.path.join(tmp_dir, "offsets.npy"), scenes.offsets)
+
+        vectors = scenes.vectors
+
+        if issparse(vectors):
+            save_npz(os.path.join(tmp_dir, "vectors.npz"), vectors)
+        elif vectors is not None:
+            np.save(os.path.join(tmp_dir, "vectors.npy"), vectors)
+
+        os.replace(tmp_dir, segment_dir)
+
+
+def _replace_json(path: str, data):
+    tmp_path = f"{path}.tmp"
+
+    with open(tmp_path, "w") as f:
+        json.dump(data, f)
+
+    os.replace(tmp_path, path)
 
 
 if __name__ == "__main__":
@@ -1,6 +1,7 @@
 from abc import ABC, abstractmethod
 import numpy as np
 from numpy.typing import NDArray
+from scipy.sparse import csr_matrix
 
 __all__ = ["SceneVectorizer"]
 
@@ -11,3 +12,6 @@ class SceneVectorizer(ABC):
 
     @abstractmethod
     def vectorize(self, inputs: list[str]) -> NDArray[np.float64]: ...
+
+    @abstractmethod
+    def vectorize_many(self, scene_inputs: list[list[str]]) -> csr_matrix: ...
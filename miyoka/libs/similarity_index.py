@@ -0,0 +1,173 @@
+from typing import Optional
+import numpy as np
+from scipy.sparse import issparse
+from sklearn.preprocessing import normalize
+
+EXACT_METHOD = "exact"
+LSH_METHOD = "lsh"
+METHODS = [EXACT_METHOD, LSH_METHOD]
+
+
+class SimilarityIndex:
+    """
+    Pairs of the vectors whose cosine similarity is above a threthold, without the N x N similarity matrix.
+
+    Methods:
+    - `exact` ... Similarities of `block_size` rows against the rest at a time. Memory is O(block_size x N).
+    - `lsh` ... Approximate. Only the vectors in the same bucket of random hyperplanes (`lsh_bits` per table)
+      in any of `lsh_tables` tables are compared, so some similar pairs can be missed.
+      A bucket is compared `block_size` rows at a time as `exact`, so a large bucket doesn't need all its pairs at once.
+
+    Vectors are compared only within the same group e.g. character when `groups` is given.
+    `top_k` keeps the most similar pairs per vector.
+    """
+
+    def __init__(
+        self,
+        method: str = EXACT_METHOD,
+        top_k: Optional[int] = None,
+        block_size: int = 1024,
+        lsh_bits: int = 16,
+        lsh_tables: int = 8,
+        seed: int = 0,
+    ):
+        method = method or EXACT_METHOD
+
+        if method not in METHODS:
+            raise ValueError(
+                f"Unknown similarity method: {method}. Choose from {METHODS}"
+            )
+
+        self.method = method
+        self.top_k = top_k
+        self.block_size = block_size or 1024
+        self.lsh_bits = lsh_bits or 16
+        self.lsh_tables = lsh_tables or 8
+        self.seed = seed
+
+    def pairs(
+        self,
+        vectors,
+        threthold: float,
+        groups: Optional[list] = None,
+        include_self: bool = False,
+    ) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Return `(rows, cols, similarities)` of the pairs above the threthold in the order of the rows and cols,
+        i.e. the same order as `np.argwhere(cosine_similarity(vectors) > threthold)`.
+        """
+        rows, cols, similarities = [], [], []
+
+        # e.g. no scenes
+        if vectors.shape[0] == 0 or vectors.shape[1] == 0:
+            return (np.array([], dtype=int), np.array([], dtype=int), np.array([]))
+
+        vectors = normalize(vectors)
+
+        for members in self._groups(vectors.shape[0], groups):
+            if self.method == LSH_METHOD:
+                found = self._lsh_pairs(vectors, members, threthold)
+            else:
+                found = self._exact_pairs(vectors, members, threthold)
+
+            for group_rows, group_cols, group_similarities in found:
+                if not include_self:
+                    mask = group_rows != group_cols
+                    group_rows = group_rows[mask]
+                    group_cols = group_cols[mask]
+                    group_similarities = group_similarities[mask]
+
+                if self.top_k:
+                    keep = self._top_k(group_rows, group_similarities)
+                    group_rows = group_rows[keep]
+                    group_cols = group_cols[keep]
+                    group_similarities = group_similarities[keep]
+
+                rows.append(group_rows)
+                cols.append(group_cols)
+                similarities.append(group_similarities)
+
+        if not rows:
+            return (np.array([], dtype=int), np.array([], dtype=int), np.array([]))
+
+        rows = np.concatenate(rows)
+        cols = np.concatenate(cols)
+        similarities = np.concatenate(similarities)
+        order = np.lexsort((cols, rows))
+        return rows[order], cols[order], similarities[order]
+
+    def _groups(self, size: int, groups: Optional[list]):
+        if groups is None:
+            yield np.arange(size)
+            return
+
+        codes, _ = _factorize(groups)
+
+        for code in np.unique(codes):
+            yield np.flatnonzero(codes == code)
+
+    def _exact_pairs(self, vectors, members: np.ndarray, threthold: float):
+        yield from self._block_pairs(vectors, members, threthold)
+
+    def _lsh_pairs(self, vectors, members: np.ndarray, threthold: float):
+        group_vectors = vectors[members]
+        rng = np.random.default_rng(self.seed)
+        codes, similarities = [], []
+
+        for _ in range(self.lsh_tables):
+            hyperplanes = rng.standard_normal((vectors.shape[1], self.lsh_bits))
+            bits = _to_dense(group_vectors @ hyperplanes) > 0
+            signatures = bits @ (1 << np.arange(self.lsh_bits, dtype=np.int64))
+            order = np.argsort(signatures, kind="stable")
+            boundaries = np.flatnonzero(np.diff(signatures[order])) + 1
+
+            for bucket in np.split(order, boundaries):
+                # Only the pairs above the threthold are kept, not all the pairs of the bucket.
+                for bucket_rows, bucket_cols, bucket_similarities in self._block_pairs(
+                    group_vectors, bucket, threthold
+                ):
+                    codes.append(bucket_rows * len(members) + bucket_cols)
+                    similarities.append(bucket_similarities)
+
+        if not codes:
+            return
+
+        # The same pair found in the other tables
+        codes, first = np.unique(np.concatenate(codes), return_index=True)
+
+        yield (
+            members[codes // len(members)],
+            members[codes % len(members)],
+            np.concatenate(similarities)[first],
+        )
+
+    def _block_pairs(self, vectors, indexes: np.ndarray, threthold: float):
+        """Pairs of `indexes` above the threthold, `block_size` rows at a time. Memory is O(block_size x len(indexes))."""
+        targets = vectors[indexes]
+
+        for start in range(0, len(indexes), self.block_size):
+            block = targets[start : start + self.block_size]
+            similarities = _to_dense(block @ targets.T)
+            block_rows, block_cols = np.nonzero(similarities > threthold)
+
+            yield (
+                indexes[block_rows + start],
+                indexes[block_cols],
+                similarities[block_rows, block_cols],
+            )
+
+    def _top_k(self, rows: np.ndarray, similarities: np.ndarray) -> np.ndarray:
+        # Most similar first per row
+        order = np.lexsort((-similarities, rows))
+        rank = np.arange(len(order)) - np.searchsorted(rows[order], rows[order])
+        return np.sort(order[rank < self.top_k])
+
+
+def _factorize(values: list) -> tuple[np.ndarray, list]:
+    uniques = {}
+    codes = np.array([uniques.setdefault(value, len(uniques)) for value in values])
+    return codes, list(uniques)
+
+
+def _to_dense(matrix) -> np.ndarray:
+    return matrix.toarray() if issparse(matrix) else np.asarray(matrix)
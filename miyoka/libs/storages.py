@@ -4,11 +4,16 @@ from logging import Logger
 import os
 import json
 import pathlib
+import shutil
+import tempfile
 import threading
 import time
 import zipfile
 import datetime
 import argparse
+import cv2
+import numpy as np
+from concurrent.futures import Future, ThreadPoolExecutor, wait
 from google.cloud import storage
 from google.cloud.storage import Client
 from google.auth import impersonated_credentials
@@ -348,58 +353,263 @@ class ReplayStreamingStorage(BaseStorageClient):
 
 
 class FrameStorage(BaseStorageClient):
+    # Uploads queued per worker before `upload_as_zip` blocks
+    QUEUE_SIZE_PER_WORKER = 2
+
     def __init__(self, workers: int, skip_upload: bool, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        self.workers = workers
+        self.workers = workers or 1
         self.skip_upload = skip_upload
+        self._executor: ThreadPoolExecutor | None = None
+        self._futures: list[Future] = []
+        self._queue_slots = threading.BoundedSemaphore(
+            self.workers * self.QUEUE_SIZE_PER_WORKER
+        )
+
+    def upload_as_zip(self, source_dir, dest_path, link: bool = False):
+        """
+        Uploads the files in the dir as a zip file to the bucket in the background.
+
+        The files are copied to a temporary dir next to the source dir, so that the source dir can be cleared
+        e.g. for the next batch of frames.
+        With `link`, they are hard linked instead of copied. Only for the files that are never rewritten
+        e.g. the split frames, because a rewritten file changes the linked file too while it's being uploaded.
+        The zip is not compressed, because the frames are JPEG, and it's streamed into a resumable upload
+        without a local zip file. Call `wait` to wait for the uploads.
+        """
+        if self.skip_upload:
+            self.logger.info(f"Skipping upload of {source_dir} to {dest_path}")
+            return
+
+        # Next to the source dir, so that the files are linked in the same file system instead of copied.
+        parent_dir = os.path.dirname(os.path.abspath(source_dir))
+        kept_dir = tempfile.mkdtemp(
+            prefix=".miyoka-upload-",
+            dir=parent_dir if os.path.isdir(parent_dir) else None,
+        )
+
+        if os.path.isdir(source_dir):
+            shutil.copytree(
+                source_dir,
+                kept_dir,
+                copy_function=_link_or_copy if link else shutil.copy2,
+                dirs_exist_ok=True,
+            )
 
-    def upload_as_zip(self, source_dir, dest_path):
-        """Uploads a zip file to the bucket."""
-        zip_path = "tmp.zip"
-        with zipfile.ZipFile(zip_path, "w", zipfile.ZIP_DEFLATED) as zipf:
-            for root, dirs, files in os.walk(source_dir):
-                for file in files:
-                    file_path = os.path.join(root, file)
-                    zipf.write(file_path, os.path.relpath(file_path, source_dir))
+        # Block while the workers are behind, so that the kept files don't pile up.
+        self._queue_slots.acquire()
+
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(
+                max_workers=self.workers, thread_name_prefix="frame-upload"
+            )
+
+        future = self._executor.submit(self._upload_zip, kept_dir, dest_path)
+        future.add_done_callback(lambda _: self._queue_slots.release())
+        # Failed uploads are kept to be raised by `wait`.
+        self._futures = [f for f in self._futures if not f.done() or f.exception()]
+        self._futures.append(future)
+
+    def wait(self):
+        """Wait for the uploads in the background. The first error is raised after all the uploads are done."""
+        futures = self._futures
+        self._futures = []
+        wait(futures)
+
+        for future in futures:
+            future.result()
+
+    def _upload_zip(self, kept_dir: str, dest_path: str):
+        try:
+            blob = self.storage_client.bucket(self.bucket_name).blob(dest_path)
 
-        self.upload_file(zip_path, dest_path, delete_original=True)
+            # `ZipFile` flushes the file, which is not supported by a resumable upload.
+            with blob.open("wb", ignore_flush=True) as f:
+                with zipfile.ZipFile(f, "w", zipfile.ZIP_STORED) as zipf:
+                    for root, dirs, files in os.walk(kept_dir):
+                        for file in files:
+                            file_path = os.path.join(root, file)
+                            zipf.write(file_path, os.path.relpath(file_path, kept_dir))
+
+            self.logger.info(f"Zip file uploaded to {dest_path}.")
+        finally:
+            shutil.rmtree(kept_dir, ignore_errors=True)
 
     def download_frames(self, replay_id, round_id) -> str:
+        """
+        Download and extract the frames of the round i.e. `download/<replay-id>/<round-id>/frames/<frame-id>.jpeg`.
+
+        The zip files are downloaded in `workers` threads. Each zip file is extracted by the thread that downloaded it,
+        while the other threads download the next zip files.
+        """
         download_dir_path = f"download/{replay_id}/{round_id}/frames"
 
         if os.path.isdir(download_dir_path):
             return download_dir_path
 
-        bucket = self.storage_client.bucket(self.bucket_name)
+        paths = self._list_frame_zips(replay_id, round_id)
+        self.logger.info(f"Downloading {len(paths)} frame zips of round {round_id}")
+
+        # Extracted in a temporary dir first, so that partially downloaded frames are not used
+        # as the downloaded frames next time.
+        os.makedirs(os.path.dirname(download_dir_path), exist_ok=True)
+        extract_dir = tempfile.mkdtemp(
+            prefix=".frames-", dir=os.path.dirname(download_dir_path)
+        )
+
+        try:
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                futures = [
+                    executor.submit(self._download_and_extract, path, extract_dir)
+                    for path in paths
+                ]
+
+                for future in futures:
+                    future.result()
+
+            os.replace(extract_dir, download_dir_path)
+        finally:
+            shutil.rmtree(extract_dir, ignore_errors=True)
+
+        return download_dir_path
+
+    def read_frames(self, replay_id, round_id) -> "ZippedFrames":
+        """
+        Download the zip files of the round frames to a temporary dir without extracting them.
+
+        The zip files are removed when the returned frames are closed
+        e.g. `SceneExporter.export_many(scenes, lambda scene: frame_storage.read_frames(scene.replay_id, scene.round_id))`
+        """
+        paths = self._list_frame_zips(replay_id, round_id)
+        self.logger.info(f"Reading {len(paths)} frame zips of round {round_id}")
+        archive_dir = tempfile.mkdtemp(prefix=f"miyoka-frames-{replay_id}-{round_id}-")
+        archive_paths = [
+            os.path.join(archive_dir, f"{i}.zip") for i in range(len(paths))
+        ]
+
+        def download(path: str, archive_path: str):
+            blob = self.storage_client.bucket(self.bucket_name).blob(path)
+            blob.download_to_filename(archive_path)
 
+        try:
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                for future in [
+                    executor.submit(download, path, archive_path)
+                    for path, archive_path in zip(paths, archive_paths)
+                ]:
+                    future.result()
+        except BaseException:
+            shutil.rmtree(archive_dir, ignore_errors=True)
+            raise
+
+        return ZippedFrames(archive_paths, archive_dir=archive_dir)
+
+    def _list_frame_zips(self, replay_id, round_id) -> list[str]:
         blobs = self.storage_client.list_blobs(
             self.bucket_name, prefix=f"{replay_id}/{round_id}/frames"
         )
+        return [blob.name for blob in blobs if blob.name.endswith(".zip")]
 
-        print(f"blobs: {blobs}")
+    def _download_and_extract(self, path: str, extract_dir: str):
+        fd, zip_path = tempfile.mkstemp(prefix="miyoka-frames-", suffix=".zip")
+        os.close(fd)
 
-        paths = [blob.name for blob in blobs if blob.name.endswith(".zip")]
-        print(f"paths: {paths}")
+        try:
+            blob = self.storage_client.bucket(self.bucket_name).blob(path)
+            blob.download_to_filename(zip_path)
 
-        for path in paths:
-            source_blob_name = path
-            destination_file_name = "tmp-frames.zip"
-            blob = bucket.blob(source_blob_name)
-            blob.download_to_filename(destination_file_name)
+            with zipfile.ZipFile(zip_path, "r") as zip_ref:
+                zip_ref.extractall(extract_dir)
 
-            print(
-                "Downloaded storage object {} from bucket {} to local file {}.".format(
-                    source_blob_name, self.bucket_name, destination_file_name
-                )
-            )
+            self.logger.info(f"Extracted {path}")
+        finally:
+            os.remove(zip_path)
 
-            print(f"Extracting zip {destination_file_name}...")
-            with zipfile.ZipFile(destination_file_name, "r") as zip_ref:
-                zip_ref.extractall(download_dir_path)
 
-            os.remove(destination_file_name)
+class ZippedFrames:
+    """
+    Frames of a round in the zip files i.e. the `<frame-id>.jpeg` members, so that the frames are not extracted.
 
-        return download_dir_path
+    The zip files are opened when a frame is read first, and a frame is decoded when it's read.
+    It's pickled as the paths of the zip files e.g. for a worker process, which opens them again.
+    `archive_dir` is removed by `close` e.g. the temporary dir of `FrameStorage.read_frames`,
+    but not by the pickled copies.
+    """
+
+    def __init__(self, archive_paths: list[str], archive_dir: str | None = None):
+        self.archive_paths = archive_paths
+        self.archive_dir = archive_dir
+        self._zip_refs: list[zipfile.ZipFile] = []
+        self._members: dict[int, tuple[zipfile.ZipFile, str]] | None = None
+
+    def __getstate__(self):
+        return self.archive_paths
+
+    def __setstate__(self, archive_paths: list[str]):
+        self.__init__(archive_paths)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __len__(self) -> int:
+        return len(self._index())
+
+    def __contains__(self, frame_id: int) -> bool:
+        return frame_id in self._index()
+
+    @property
+    def frame_ids(self) -> list[int]:
+        return sorted(self._index())
+
+    def read(self, frame_id: int) -> np.ndarray | None:
+        members = self._index()
+
+        if frame_id not in members:
+            return None
+
+        zip_ref, name = members[frame_id]
+        return cv2.imdecode(
+            np.frombuffer(zip_ref.read(name), np.uint8), cv2.IMREAD_COLOR
+        )
+
+    def close(self):
+        for zip_ref in self._zip_refs:
+            zip_ref.close()
+
+        self._zip_refs = []
+        self._members = None
+
+        if self.archive_dir:
+            shutil.rmtree(self.archive_dir, ignore_errors=True)
+
+    def _index(self) -> dict[int, tuple[zipfile.ZipFile, str]]:
+        if self._members is not None:
+            return self._members
+
+        self._members = {}
+
+        for archive_path in self.archive_paths:
+            zip_ref = zipfile.ZipFile(archive_path)
+            self._zip_refs.append(zip_ref)
+
+            for name in zip_ref.namelist():
+                stem, ext = os.path.splitext(os.path.basename(name))
+
+                if ext == ".jpeg" and stem.isdigit():
+                    self._members[int(stem)] = (zip_ref, name)
+
+        return self._members
+
+
+def _link_or_copy(src: str, dst: str):
+    try:
+        os.link(src, dst)
+    except OSError:
+        # e.g. across file systems
+        shutil.copy2(src, dst)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,93 @@
+import os
+import threading
+import cv2 as cv
+import numpy as np
+from dataclasses import dataclass
+from typing import Optional
+from miyoka.libs.template_matcher import TemplateMatcher
+
+TEMPLATE_FILE_EXTENSION = ".jpeg"
+
+
+@dataclass(frozen=True)
+class Template:
+    file_name: str
+    name: str  # e.g. "lp_1.jpeg" => "lp"
+    number: Optional[int]  # e.g. "4_10.jpeg" => 4
+    image: np.ndarray  # Grayscale
+
+    @classmethod
+    def from_file(cls, template_dir: str, file_name: str) -> "Template":
+        head = file_name[0]
+
+        return cls(
+            file_name=file_name,
+            name=file_name.replace(TEMPLATE_FILE_EXTENSION, "").split("_")[0],
+            number=int(head) if head.isdecimal() else None,
+            image=cv.imread(os.path.join(template_dir, file_name), cv.IMREAD_GRAYSCALE),
+        )
+
+
+class TemplateBank:
+    """
+    Templates loaded in memory per template directory i.e. `templates/{WxH}/{lang}/{dir}`.
+
+    Each directory is read from the disk only once and shared across the helper instances.
+    If `cache` is false, the templates are read on every access (mainly for benchmarking).
+    """
+
+    def __init__(self, cache: bool = True):
+        self.cache = cache
+        self._templates: dict[str, list[Template]] = {}
+        self._matchers: dict[str, TemplateMatcher] = {}
+        self._lock = threading.Lock()
+
+    def get(self, template_dir: str) -> list[Template]:
+        if not self.cache:
+            return self._load(template_dir)
+
+        templates = self._templates.get(template_dir)
+
+        if templates is None:
+            with self._lock:
+                templates = self._templates.get(template_dir)
+
+                if templates is None:
+                    templates = self._load(template_dir)
+                    self._templates[template_dir] = templates
+
+        return templates
+
+    def get_matcher(self, template_dir: str) -> TemplateMatcher:
+        if not self.cache:
+            return TemplateMatcher(self._load(template_dir))
+
+        matcher = self._matchers.get(template_dir)
+
+        if matcher is None:
+            matcher = TemplateMatcher(self.get(template_dir))
+
+            with self._lock:
+                matcher = self._matchers.setdefault(template_dir, matcher)
+
+        return matcher
+
+    def clear(self):
+        with self._lock:
+            self._templates = {}
+            self._matchers = {}
+
+    def _load(self, template_dir: str) -> list[Template]:
+        templates = []
+
+        for file in os.listdir(template_dir):
+            if not file.endswith(TEMPLATE_FILE_EXTENSION):
+                continue
+
+            templates.append(Template.from_file(template_dir, file))
+
+        return templates
+
+
+# Process-wide template bank shared by every game window helper.
+shared_template_bank = TemplateBank()
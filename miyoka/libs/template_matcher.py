@@ -0,0 +1,170 @@
+import numpy as np
+from typing import Optional, Tuple
+
+
+class TemplateMatches:
+    """Scores of all templates against all images, matched by `TemplateMatcher`."""
+
+    def __init__(self, templates: list, scores: np.ndarray, locations: np.ndarray):
+        self.templates = templates
+        self.scores = scores  # (n_images, n_templates)
+        self.locations = locations  # (n_images, n_templates, 2) as (x, y)
+
+    def identify(
+        self, image_index: int, threthold: float
+    ) -> Tuple[str, Optional[Tuple[int, int, int, int]]]:
+        """
+        Same result as `GameWindowHelper.identify_in_screen` for the image at `image_index`.
+
+        The returned roi is the location of the last template as `identify_in_screen` does.
+        """
+        if not self.templates:
+            return "", None
+
+        # The first template of the highest score above the threthold
+        scores = self.scores[image_index]
+        best = scores.argmax()
+        detected = self.templates[best].name if scores[best] > threthold else ""
+
+        x, y = self.locations[image_index, -1]
+        h, w = self.templates[-1].image.shape
+        return detected, (int(x), int(y), w, h)
+
+
+class TemplateMatcher:
+    """
+    Vectorized template matching equivalent to `cv.matchTemplate(..., cv.TM_CCOEFF_NORMED)`.
+
+    Every placement of every normalized template within an image is precomputed as a column of
+    a matrix, so that all templates are scored against all images with a single matrix product.
+    The window statistics are computed from the integral images as OpenCV does.
+    """
+
+    def __init__(self, templates: list):
+        # `templates` are `miyoka.libs.template_bank.Template`s.
+        self.templates = templates
+        self._plans = {}
+
+    def match(self, images: np.ndarray) -> TemplateMatches:
+        """Score the templates against grayscale images of the same size i.e. (n_images, height, width)."""
+        n_images, height, width = images.shape
+        plan = self._plan(height, width)
+
+        num = images.reshape(n_images, height * width).astype(np.float32) @ plan.kernels
+        num = num.astype(np.float64)
+
+        images = images.astype(np.float64)
+        window_sum = plan.window_sum(self._integral(images))
+        window_sqsum = plan.window_sum(self._integral(images**2))
+        window_var = window_sqsum - window_sum**2 / plan.areas
+        denom = np.sqrt(np.maximum(window_var, 0))
+
+        # Same handling of the numerical error as OpenCV.
+        abs_num = np.abs(num)
+        result = np.where(
+            abs_num < denom,
+            num / np.where(denom == 0, 1, denom),
+            np.where(abs_num < denom * 1.125, np.sign(num), 0),
+        )
+        result = np.where(plan.flat, 1, result)  # A flat template matches everywhere.
+
+        padded = np.full((n_images, len(self.templates) * plan.max_placements), -np.inf)
+        padded[:, plan.positions] = result
+        padded = padded.reshape(n_images, len(self.templates), plan.max_placements)
+
+        # First maximum in row-major order as cv.minMaxLoc does.
+        best = padded.argmax(axis=2)
+        scores = np.take_along_axis(padded, best[:, :, None], axis=2)[:, :, 0]
+        locations = np.stack([best % plan.out_widths, best // plan.out_widths], axis=2)
+
+        return TemplateMatches(self.templates, scores, locations)
+
+    def _integral(self, images: np.ndarray) -> np.ndarray:
+        """Flattened integral images i.e. (n_images, (height + 1) * (width + 1))."""
+        n_images, height, width = images.shape
+        integrals = np.zeros((n_images, height + 1, width + 1))
+        integrals[:, 1:, 1:] = images.cumsum(axis=1).cumsum(axis=2)
+        return integrals.reshape(n_images, -1)
+
+    def _plan(self, height: int, width: int) -> "_MatchPlan":
+        plan = self._plans.get((height, width))
+
+        if plan is None:
+            plan = _MatchPlan(self.templates, height, width)
+            self._plans[(height, width)] = plan
+
+        return plan
+
+
+class _MatchPlan:
+    """Precomputed placements of the templates within images of `height` x `width`."""
+
+    def __init__(self, templates: list, height: int, width: int):
+        n_placements = [
+            (height - h + 1) * (width - w + 1)
+            for h, w in (template.image.shape for template in templates)
+        ]
+
+        if min(n_placements, default=1) <= 0:
+            raise ValueError(
+                f"Templates must be smaller than the images. image: {(height, width)}"
+            )
+
+        self.max_placements = max(n_placements, default=0)
+        self.out_widths = np.ones(len(templates), dtype=np.int64)
+
+        kernels = []
+        positions = []
+        corners = (
+            []
+        )  # top-left, top-right, bottom-left, bottom-right of the integral image
+        areas = []
+        flat = []
+
+        for i, template in enumerate(templates):
+            h, w = template.image.shape
+            out_h, out_w = height - h + 1, width - w + 1
+            self.out_widths[i] = out_w
+
+            kernel = template.image.astype(np.float64)
+            kernel -= kernel.mean()
+            norm = np.sqrt((kernel**2).sum())
+            is_flat = norm < np.finfo(np.float64).eps
+
+            if not is_flat:
+                kernel /= norm
+
+            for j in range(out_h * out_w):
+                y, x = divmod(j, out_w)
+                placed = np.zeros((height, width))
+                placed[y : y + h, x : x + w] = kernel
+                kernels.append(placed.ravel())
+                positions.append(i * self.max_placements + j)
+                corners.append(
+                    [
+                        y * (width + 1) + x,
+                        y * (width + 1) + x + w,
+                        (y + h) * (width + 1) + x,
+                        (y + h) * (width + 1) + x + w,
+                    ]
+                )
+                areas.append(h * w)
+                flat.append(is_flat)
+
+        self.kernels = np.ascontiguousarray(
+            np.array(kernels, dtype=np.float32).reshape(-1, height * width).T
+        )
+        self.positions = np.array(positions, dtype=np.int64)
+        self.corners = np.array(corners, dtype=np.int64).reshape(-1, 4).T
+        self.areas = np.array(areas, dtype=np.float64)
+        self.flat = np.array(flat, dtype=bool)
+
+    def window_sum(self, integrals: np.ndarray) -> np.ndarray:
+        """Sum of every placement window from the flattened integral images."""
+        top_left, top_right, bottom_left, bottom_right = self.corners
+        return (
+            integrals[:, bottom_right]
+            - integrals[:, top_right]
+            - integrals[:, bottom_left]
+            + integrals[:, top_left]
+        )
@@ -1,3 +1,4 @@
+import argparse
 from miyoka.libs.replay_analyzer import ReplayAnalyzer
 from miyoka.container import Container
 from dependency_injector.wiring import inject, Provide
@@ -11,7 +12,25 @@ def run(
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--workers",
+        type=int,
+        help="Number of worker processes analyzing rounds in parallel",
+    )
+    parser.add_argument(
+        "--round-shards",
+        type=int,
+        help="Number of shards of a round analyzed in parallel",
+    )
+    args = parser.parse_args()
+
     container = Container()
+    if args.workers:
+        container.config.replay_analyzer.workers.from_value(args.workers)
+    if args.round_shards:
+        container.config.replay_analyzer.round_shards.from_value(args.round_shards)
+
     container.wire(
         modules=[
             __name__,
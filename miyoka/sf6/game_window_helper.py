@@ -1,6 +1,7 @@
 import cv2 as cv
 import numpy as np
 from miyoka.libs.game_window_helper import GameWindowHelper as GameWindowHelperBase
+from miyoka.libs.template_matcher import TemplateMatches
 from datetime import datetime
 import urllib.parse
 
@@ -70,7 +71,7 @@ class GameWindowHelper(GameWindowHelperBase):
         (x, y, width, height) = roi
         cropped_image = image[y : y + height, x : x + width]
 
-        self.save_image(cropped_image, f"last_images/is_paused/image.jpeg")
+        self.capture_image(cropped_image, f"last_images/is_paused/image.jpeg")
 
         tmp, _ = self.identify_in_screen(
             cropped_image, self.templates_dir("replay_center"), threthold=0.7
@@ -89,16 +90,12 @@ class GameWindowHelper(GameWindowHelperBase):
         for img in image:
             img_gray = cv.cvtColor(img, cv.COLOR_BGR2GRAY)
 
-            for template_file in self.all_templates(template_dir):
-                template = cv.imread(
-                    template_dir + "/" + template_file, cv.IMREAD_GRAYSCALE
-                )
-                name = template_file.replace(".jpeg", "").split("_")[0]
-                score, roi = self.detect(img_gray, template)
+            for template in self.load_templates(template_dir):
+                score, roi = self.detect(img_gray, template.image)
 
                 if (score > threthold) and (score > highest):
                     highest = score
-                    detected = name
+                    detected = template.name
                     roi = roi
 
         return detected, roi
@@ -108,6 +105,9 @@ class GameWindowHelper(GameWindowHelperBase):
             image, self.templates_dir("replay_inputs_modern"), threthold=0.69
         )
 
+        return self._detect_modern_input_strength(image, modern_input, roi)
+
+    def _detect_modern_input_strength(self, image, modern_input, roi):
         if not modern_input:
             return None
 
@@ -157,6 +157,9 @@ class GameWindowHelper(GameWindowHelperBase):
             image, self.templates_dir("replay_inputs_classic"), threthold=0.69
         )
 
+        return self._detect_classic_input_strength(image, classic_input, roi)
+
+    def _detect_classic_input_strength(self, image, classic_input, roi):
         if not classic_input:
             return None
 
@@ -414,7 +417,7 @@ class GameWindowHelper(GameWindowHelperBase):
 
         return ret
 
-    def identify_replay_input(self, image, player, mode):
+    def replay_input_rois(self, player):
         diameter = 18
         radius = int(diameter / 2)
         p1_rois = [
@@ -431,46 +434,124 @@ class GameWindowHelper(GameWindowHelperBase):
             (172 - radius, 163 - radius, diameter, diameter),  # input 5
             (192 - radius, 163 - radius, diameter, diameter),  # input 6
         ]
+
+        if player == "p1":
+            return p1_rois
+        elif player == "p2":
+            return [self.mirror_p2_roi_from(p1_roi) for p1_roi in p1_rois]
+
+    def identify_replay_input(self, image, player, mode):
+        return self.identify_replay_inputs(image, {player: mode})[player]
+
+    def identify_replay_inputs(self, image, modes: dict) -> dict:
+        """
+        Identify the replay inputs of the players e.g. `{"p1": "classic", "p2": "modern"}`.
+
+        All input icons of a frame are scored against the templates in a single pass,
+        instead of matching templates one by one per icon.
+        """
+        rois = {player: self.replay_input_rois(player) for player in modes}
+
+        # Arrows of all players
+        arrows = self._identify_rois(
+            image,
+            [player_rois[0] for player_rois in rois.values()],
+            self.templates_dir("replay_inputs_arrows"),
+            threthold=0.67,
+        )
+
+        # Action buttons of all players per mode
+        input_icons = {}
+        for mode in set(modes.values()):
+            players = [player for player in modes if modes[player] == mode]
+            icons = self._identify_rois(
+                image,
+                [roi for player in players for roi in rois[player][1:]],
+                self.templates_dir(f"replay_inputs_{mode}"),
+                threthold=0.69,
+            )
+
+            for i, player in enumerate(players):
+                offset = i * (len(rois[player]) - 1)
+                input_icons[player] = icons[offset : offset + len(rois[player]) - 1]
+
+        results = {}
+        for i, (player, mode) in enumerate(modes.items()):
+            arrow, _ = arrows[i]
+            results[player] = self._collect_replay_input(
+                image, player, mode, rois[player], arrow, input_icons[player]
+            )
+
+        return results
+
+    def _identify_rois(self, image, rois, template_dir, threthold) -> list:
+        """
+        `identify_in_screen` of each roi as `(name, roi)`.
+
+        The results are cached by the pixels of the rois. Only the rois not in the cache are matched.
+        """
+        cropped_images = [
+            image[y : y + height, x : x + width] for x, y, width, height in rois
+        ]
+        keys = [
+            self.roi_cache.key((template_dir, threthold), cropped_image)
+            for cropped_image in cropped_images
+        ]
+        results = [self.roi_cache.get(key) for key in keys]
+        missed = [i for i, result in enumerate(results) if result is None]
+
+        if missed:
+            matches = self._match_rois(
+                [cropped_images[i] for i in missed], template_dir
+            )
+
+            for j, i in enumerate(missed):
+                results[i] = matches.identify(j, threthold=threthold)
+                self.roi_cache.put(keys[i], results[i])
+
+        return results
+
+    def _match_rois(self, cropped_images, template_dir) -> TemplateMatches:
+        cropped_images = np.stack(cropped_images)
+        n, height, width, channels = cropped_images.shape
+        images_gray = cv.cvtColor(
+            cropped_images.reshape(n * height, width, channels), cv.COLOR_BGR2GRAY
+        ).reshape(n, height, width)
+
+        return self.template_bank.get_matcher(template_dir).match(images_gray)
+
+    def _collect_replay_input(self, image, player, mode, rois, arrow, input_icons):
         if mode == "classic":
             candidates = ["lp", "mp", "hp", "lk", "mk", "hk"]
         elif mode == "modern":
             candidates = ["la", "sp", "dp", "ma", "ha", "auto", "di", "grab"]
 
-        if player == "p1":
-            rois = p1_rois
-        elif player == "p2":
-            rois = [self.mirror_p2_roi_from(p1_roi) for p1_roi in p1_rois]
+        if player == "p2":
             candidates.reverse()
 
         inputs = []
-        arrow = ""
-        input = ""
 
-        for x, y, width, height in rois:
+        for i, (x, y, width, height) in enumerate(rois):
             # print(f"player: {player} x: {x} y: {y} width: {width} height: {height}")
             cropped_image = image[y : y + height, x : x + width]
-            self.save_image(
+            self.capture_image(
                 cropped_image,
                 f"last_images/identify_replay_input/{player}_{x}_{y}.jpeg",
             )
 
-            if not arrow:
-                arrow, _ = self.identify_in_screen(
-                    cropped_image,
-                    self.templates_dir("replay_inputs_arrows"),
-                    threthold=0.67,
-                )
-
+            if i == 0:
                 if not arrow:
                     arrow = "undef"
                     break
 
                 continue
 
+            name, roi = input_icons[i - 1]
+
             if mode == "classic":
-                input = self.identify_replay_input_classic(cropped_image)
+                input = self._detect_classic_input_strength(cropped_image, name, roi)
             elif mode == "modern":
-                input = self.identify_replay_input_modern(cropped_image)
+                input = self._detect_modern_input_strength(cropped_image, name, roi)
 
             # print(f"player: {player} input: {input}")
             if input and len(candidates) > 0:
@@ -489,27 +570,31 @@ class GameWindowHelper(GameWindowHelperBase):
     def _detect_number(self, image, roi, player):
         (x, y, width, height) = roi
         image = image[y : y + height, x : x + width]
-        image_gray = cv.cvtColor(image, cv.COLOR_BGR2GRAY)
         dir = self.templates_dir("replay_inputs_count")
+
+        self.capture_image(
+            image, f"last_images/identify_replay_input_count/{player}_{x}_{y}.jpeg"
+        )
+
+        return self.roi_cache.get_or_compute(
+            dir, image, lambda: self._match_number(image, dir)
+        )
+
+    def _match_number(self, image, dir):
+        image_gray = cv.cvtColor(image, cv.COLOR_BGR2GRAY)
         threthold = 0.68
 
         detected = None
         highest = 0
 
-        self.save_image(
-            image, f"last_images/identify_replay_input_count/{player}_{x}_{y}.jpeg"
-        )
-
-        for template_file in self.all_templates(dir):
-            template = cv.imread(dir + "/" + template_file, cv.IMREAD_GRAYSCALE)
-            number = int(template_file.replace(".jpeg", "")[0])
-            score, _ = self.detect(image_gray, template)
+        for template in self.load_templates(dir):
+            score, _ = self.detect(image_gray, template.image)
             # print(f"name: {name} score: {score}")
 
             if (score > threthold) and (score > highest):
                 # print(f"renew highest: {highest}")
                 highest = score
-                detected = number
+                detected = template.number
 
         if not detected:
             detected = 0
@@ -375,7 +375,7 @@ class ReplayRecorder(ReplayRecorderBase):
     def is_replay_exist(self) -> bool:
         if self.save_to == "google_cloud_storage":
             if self.replay_dataset.is_exists(self.current_replay_id):
-                self.logger.warn(f"Replay {current_replay_id} already exists")
+                self.logger.warn(f"Replay {self.current_replay_id} already exists")
                 return True
         elif self.save_to == "local_file_storage":
             filename = self._local_replay_file_name()
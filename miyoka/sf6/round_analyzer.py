@@ -1,15 +1,23 @@
-import cv2 as cv
 from logging import Logger
+from typing import Iterable, Tuple
 import contextlib
+import numpy as np
+from miyoka.libs.duplicate_detector import DuplicateDetector
 from miyoka.libs.exceptions import GameOver
+from miyoka.libs.frame_splitter import FrameBatch
 from miyoka.libs.round_analyzer import RoundAnalyzer as RoundAnalyzerBase
 from miyoka.sf6.game_window_helper import GameWindowHelper
 
+MAX_ROWS = 3
+# Frames observed between the checks of the stop event, because a check of a `Manager().Event()` is an IPC round trip.
+STOP_EVENT_INTERVAL = 30
+
 
 class RoundAnalyzer(RoundAnalyzerBase):
     def __init__(
         self,
         game_window_helper: GameWindowHelper,
+        duplicate_detector: DuplicateDetector,
         logger: Logger,
         replay_id: str,
         round_id: int,
@@ -29,7 +37,6 @@ class RoundAnalyzer(RoundAnalyzerBase):
         self.p1_input_count_verifiable = False
         self.p2_input_count_verifiable = False
         self.replay_started = False
-        self.previous_frame = None
         self.duplicate_frame_count = 0
         self.dropped_frame_count = 0
         self.previous_p1_all_rows_count = None
@@ -37,6 +44,7 @@ class RoundAnalyzer(RoundAnalyzerBase):
         self.init_game_window_helper_screen_size = False
 
         self.game_window_helper = game_window_helper
+        self.duplicate_detector = duplicate_detector
         self.logger = logger
         self.start_frame_at = start_frame_at
         self.stop_frame_at = stop_frame_at
@@ -56,49 +64,203 @@ class RoundAnalyzer(RoundAnalyzerBase):
 
     def analyze_frames(
         self,
-        frame_range: range,
-        frame_dir: str,
+        frame_batch: FrameBatch,
     ):
         self.logger.info(
-            f"Start analyzing frames {frame_range} from {frame_dir} for round {self.round_id}"
+            f"Start analyzing frames from {frame_batch.start} for round {self.round_id}"
         )
-        for frame_id in frame_range:
+        debug_image_capture = self.game_window_helper.debug_image_capture
+
+        try:
+            for frame_id, frame in frame_batch:
+                if frame_id <= self.start_frame_at:
+                    continue
+
+                self._init_game_window_helper_screen_size(frame)
+                debug_image_capture.begin_frame(frame_id)
+                self._analyze(frame, frame_id)
+        except GameOver:
+            raise
+        except Exception:
+            # Write the debug images of the last frames before the error.
+            debug_image_capture.flush()
+            raise
+        finally:
+            debug_image_capture.wait()
+
+    def is_analyzable(self, frame_id: int, frame: np.ndarray) -> bool:
+        """True if the frame is analyzed i.e. after `start_frame_at` and the replay is started."""
+        if frame_id <= self.start_frame_at:
+            return False
+
+        self._init_game_window_helper_screen_size(frame)
+        return self._is_replay_started(frame)
+
+    def observe_frames(
+        self, frames: Iterable[Tuple[int, np.ndarray]], stop_event=None
+    ) -> dict:
+        """
+        Observe a shard of the frames of a round, e.g. in a worker process.
+
+        Only the per-frame results are computed here. The observations are analyzed in order
+        by `analyze_shard`, with the first and last started frames of the shard for reconciling
+        the duplicate detection at the shard boundaries.
+        Stops reading the frames once `stop_event` (e.g. `multiprocessing.Manager().Event()`) is set,
+        which is checked every `STOP_EVENT_INTERVAL` frames.
+        """
+        observations = []
+        first_started_reduced = None
+        first_started_frame_id = None
+        debug_image_capture = self.game_window_helper.debug_image_capture
+
+        for i, (frame_id, frame) in enumerate(frames):
+            if (
+                stop_event is not None
+                and i % STOP_EVENT_INTERVAL == 0
+                and stop_event.is_set()
+            ):
+                break
+
             if frame_id <= self.start_frame_at:
                 continue
 
-            path = f"{frame_dir}/{frame_id}.jpeg"
-            frame = cv.imread(path)
+            self._init_game_window_helper_screen_size(frame)
+            debug_image_capture.begin_frame(frame_id)
+
+            observation = self._observe_safely(frame, frame_id)
+
+            if "error" in observation:
+                debug_image_capture.flush()
+
+            if observation.get("started") and first_started_frame_id is None:
+                first_started_reduced = self.duplicate_detector.reduce(frame)
+                first_started_frame_id = frame_id
+
+            observations.append(observation)
+
+        debug_image_capture.wait()
 
-            if not self.init_game_window_helper_screen_size:
-                height, width, channels = frame.shape
-                self.game_window_helper.current_screen_width = width
-                self.game_window_helper.current_screen_height = height
-                self.init_game_window_helper_screen_size = True
+        return {
+            "observations": observations,
+            "first_started_reduced": first_started_reduced,
+            "first_started_frame_id": first_started_frame_id,
+            "last_started_reduced": self.duplicate_detector.previous,
+        }
 
-            self._analyze(frame, frame_id)
+    def analyze_shard(self, shard: dict):
+        """
+        Analyze the observations of a shard returned by `observe_frames`.
+
+        The shards must be analyzed in order. The result is the same as `analyze_frames`.
+        """
+        for observation in shard["observations"]:
+            if (
+                observation["frame_id"] == shard["first_started_frame_id"]
+                and "duplicate" in observation
+            ):
+                # The first started frame of the shard had no previous frame in the worker.
+                # Compare it with the last started frame of the previous shards instead.
+                observation["duplicate"] = self.duplicate_detector.is_duplicate_reduced(
+                    shard["first_started_reduced"]
+                )
+
+            self._apply(observation)
+
+        if shard["last_started_reduced"] is not None:
+            self.duplicate_detector.previous = shard["last_started_reduced"]
+
+    def _init_game_window_helper_screen_size(self, frame):
+        if not self.init_game_window_helper_screen_size:
+            height, width, channels = frame.shape
+            self.game_window_helper.current_screen_width = width
+            self.game_window_helper.current_screen_height = height
+            self.init_game_window_helper_screen_size = True
 
     def _analyze(
         self,
         frame,
         frame_id,
     ):
-        if not self._is_replay_started(frame):
+        observation = self._observe_safely(frame, frame_id)
+        self._apply(observation, frame)
+
+    def _observe_safely(self, frame, frame_id) -> dict:
+        observation = {"frame_id": frame_id}
+
+        try:
+            self._observe(frame, observation)
+        except Exception as e:
+            # Raised when the frame is analyzed in order, so that the preceding results of the frame
+            # (e.g. dropped frames) are applied first.
+            observation["error"] = e
+
+        return observation
+
+    def _observe(self, frame, observation: dict):
+        """Per-frame results that don't depend on the other frames except the previous one."""
+        observation["started"] = self._is_replay_started(frame)
+
+        if not observation["started"]:
+            return
+
+        observation["duplicate"] = self._check_duplicate(frame)
+
+        if observation["duplicate"]:
             return
 
-        if self._check_duplicate(frame):
+        observation["game_over"] = self._check_game_over(frame)
+
+        if observation["game_over"]:
+            return
+
+        self.game_window_helper.capture_image(frame, "last_images/frame.jpeg")
+
+        observation["p1_all_rows_count"], observation["p2_all_rows_count"] = (
+            self._get_all_rows_count(frame)
+        )
+
+        if observation["frame_id"] == self.stop_frame_at:
+            return
+
+        observation["p1_input"], observation["p2_input"] = self._identify_replay_input(
+            frame
+        )
+
+    def _apply(self, observation: dict, frame=None):
+        """Analyze the observation of a frame in order."""
+        frame_id = observation["frame_id"]
+
+        if "error" in observation and "duplicate" not in observation:
+            raise observation["error"]
+
+        if not observation["started"]:
+            return
+
+        if observation["duplicate"]:
             self.logger.info("duplicate", extra={"number": frame_id})
             self.duplicate_frame_count += 1
             return
 
-        if self._check_game_over(frame):
+        if "error" in observation and "game_over" not in observation:
+            raise observation["error"]
+
+        if observation["game_over"]:
             self.logger.info(
-                "game_over", extra={"round_id": self.round_id, "number": frame_id}
+                "game_over",
+                extra={
+                    "round_id": self.round_id,
+                    "number": frame_id,
+                    "roi_cache": self.game_window_helper.roi_cache.info(),
+                },
             )
             raise GameOver("Game over", frame_id=frame_id)
 
-        self.game_window_helper.save_image(frame, "last_images/frame.jpeg")
+        if "error" in observation and "p1_all_rows_count" not in observation:
+            raise observation["error"]
 
-        ret, p1_all_rows_count, p2_all_rows_count = self._check_dropped_frames(frame)
+        ret, p1_all_rows_count, p2_all_rows_count = self._check_dropped_frames(
+            observation["p1_all_rows_count"], observation["p2_all_rows_count"]
+        )
 
         self.logger.info(
             "check_dropped_frames",
@@ -113,11 +275,14 @@ class RoundAnalyzer(RoundAnalyzerBase):
         if frame_id == self.stop_frame_at:
             raise Exception(f"Stopped at frame {frame_id} for debugging")
 
+        if "error" in observation:
+            raise observation["error"]
+
         if ret == "dropped":
             self.p1_input_count_verifiable = False
             self.p2_input_count_verifiable = False
 
-        p1_input, p2_input = self._identify_replay_input(frame)
+        p1_input, p2_input = observation["p1_input"], observation["p2_input"]
 
         self.logger.info(
             "input",
@@ -129,7 +294,15 @@ class RoundAnalyzer(RoundAnalyzerBase):
             },
         )
 
-        self._verify_replay_input(frame, p1_input, p2_input, frame_id)
+        self._verify_replay_input(
+            frame,
+            p1_input,
+            p2_input,
+            frame_id,
+            # The displayed counts of the latest inputs i.e. the second rows.
+            p1_input_count=p1_all_rows_count[1],
+            p2_input_count=p2_all_rows_count[1],
+        )
 
         self.frame_data.append(
             {
@@ -156,12 +329,7 @@ class RoundAnalyzer(RoundAnalyzerBase):
         return self.game_window_helper.is_replay_started(image)
 
     def _check_duplicate(self, frame):
-        ret = False
-        if self.previous_frame is not None:
-            ret = self.game_window_helper.mse(frame, self.previous_frame) < 5
-
-        self.previous_frame = frame
-        return ret
+        return self.duplicate_detector.is_duplicate(frame)
 
     def _compare_rows_count(self, all_rows_count, previous_all_rows_count, max_rows):
         ret = ""
@@ -217,18 +385,19 @@ class RoundAnalyzer(RoundAnalyzerBase):
 
         return p1_count == 0 or p2_count == 0
 
-    def _check_dropped_frames(self, frame):
-        max_rows = 3
-
+    def _get_all_rows_count(self, frame):
         p1_all_rows_count = self.game_window_helper.get_all_rows_count(
-            frame, max_rows, "p1"
+            frame, MAX_ROWS, "p1"
         )
         p2_all_rows_count = self.game_window_helper.get_all_rows_count(
-            frame, max_rows, "p2"
+            frame, MAX_ROWS, "p2"
         )
 
+        return (p1_all_rows_count, p2_all_rows_count)
+
+    def _check_dropped_frames(self, p1_all_rows_count, p2_all_rows_count):
         ret = self._eval_all_rows_count(
-            max_rows,
+            MAX_ROWS,
             p1_all_rows_count,
             p2_all_rows_count,
             self.previous_p1_all_rows_count,
@@ -241,16 +410,25 @@ class RoundAnalyzer(RoundAnalyzerBase):
         return ret
 
     def _identify_replay_input(self, frame):
-        p1_input = self.game_window_helper.identify_replay_input(
-            frame, "p1", self.metadata["p1"]["mode"]
-        )
-        p2_input = self.game_window_helper.identify_replay_input(
-            frame, "p2", self.metadata["p2"]["mode"]
+        inputs = self.game_window_helper.identify_replay_inputs(
+            frame,
+            {
+                "p1": self.metadata["p1"]["mode"],
+                "p2": self.metadata["p2"]["mode"],
+            },
         )
 
-        return (p1_input, p2_input)
+        return (inputs["p1"], inputs["p2"])
 
-    def _verify_replay_input(self, frame, p1_input, p2_input, frame_id):
+    def _verify_replay_input(
+        self,
+        frame,
+        p1_input,
+        p2_input,
+        frame_id,
+        p1_input_count,
+        p2_input_count,
+    ):
         self.p1_input_count, self.p1_input_count_verifiable = (
             self._verify_player_replay_input(
                 "p1",
@@ -260,6 +438,7 @@ class RoundAnalyzer(RoundAnalyzerBase):
                 current_input_count=self.p1_input_count,
                 input_count_verifiable=self.p1_input_count_verifiable,
                 frame_id=frame_id,
+                displayed_input_count=p1_input_count,
             )
         )
 
@@ -272,6 +451,7 @@ class RoundAnalyzer(RoundAnalyzerBase):
                 current_input_count=self.p2_input_count,
                 input_count_verifiable=self.p2_input_count_verifiable,
                 frame_id=frame_id,
+                displayed_input_count=p2_input_count,
             )
         )
 
@@ -284,6 +464,7 @@ class RoundAnalyzer(RoundAnalyzerBase):
         current_input_count,
         input_count_verifiable,
         frame_id,
+        displayed_input_count,
     ):
         if "undef" in input:
             raise Exception(f"{player} input is empty!!!!!")
@@ -303,17 +484,16 @@ class RoundAnalyzer(RoundAnalyzerBase):
                 )
 
             if self.verify_inputs_count and input_count_verifiable:
-                expected_input_count = (
-                    self.game_window_helper.identify_replay_input_count(frame, player)
-                )
+                expected_input_count = displayed_input_count
 
                 if (
                     current_input_count < 100
                     and expected_input_count != current_input_count
                 ):
-                    self.game_window_helper.save_image(
-                        frame, f"last_images/{player}_input_verification_error.jpeg"
-                    )
+                    if frame is not None:
+                        self.game_window_helper.capture_image(
+                            frame, f"last_images/{player}_input_verification_error.jpeg"
+                        )
 
                     raise Exception(
                         f"Expected {player} input count was {expected_input_count}, but {current_input_count}. Last input: {input}. raw: {frame_id}"
@@ -1,5 +1,6 @@
 from pandas import DataFrame
 import numpy as np
+import pandas as pd
 from sklearn.cluster import DBSCAN
 import matplotlib.pyplot as plt
 from miyoka.libs.scene import Scene
@@ -12,6 +13,11 @@ from miyoka.sf6.constants import (
 )
 
 
+GAP_SEGMENTER = "gap"
+DBSCAN_SEGMENTER = "dbscan"
+SEGMENTERS = [GAP_SEGMENTER, DBSCAN_SEGMENTER]
+
+
 class SceneSplitter(SceneSplitterBase):
     # If action frames are close enough, they are concatenated as one scene i.e. `eps=30` of DBSCAN.
     CLUSTERING_DISTANCE = 30
@@ -19,88 +25,60 @@ class SceneSplitter(SceneSplitterBase):
     PREFIX_FRAME_SIZE = 10
     SUFFIX_FRAME_SIZE = 0
 
-    def __init__(self, *args, **kwargs):
+    def __init__(self, segmenter: str = GAP_SEGMENTER, *args, **kwargs):
         super().__init__(*args, **kwargs)
 
+        segmenter = segmenter or GAP_SEGMENTER
+
+        if segmenter not in SEGMENTERS:
+            raise ValueError(
+                f"Unknown segmenter: {segmenter}. Choose from {SEGMENTERS}"
+            )
+
+        self.segmenter = segmenter
+
     def split(
         self,
         round_rows: DataFrame,
         is_display_clustering: bool = False,
     ):
-        last_frame_id = round_rows.loc[round_rows["frame_id"].idxmax()]["frame_id"]
+        frame_ids = round_rows["frame_id"].to_numpy(dtype=np.int64)
+        last_frame_id = frame_ids.max()
         print(f"last_frame_id: {last_frame_id}")
         replay_id = round_rows["replay_id"].values[0]
         round_id = round_rows["round_id"].values[0]
 
+        # Scenes are sliced from the frames sorted by frame ID. The rows keep their original order.
+        frame_order = np.argsort(frame_ids, kind="stable")
+        sorted_frame_ids = frame_ids[frame_order]
+
         for p in ["p1", "p2"]:
             character = round_rows[f"{p}_character"].values[0]
             print(f"p: {p} character: {character}")
 
-            input_mask = {arrow: None for arrow in ARROWS}
-
-            action_pos = np.array(
-                [
-                    [
-                        row["frame_id"],
-                        (
-                            NON_ACTION_LABEL
-                            if row[f"{p}_input"] in input_mask
-                            else ACTION_LABEL
-                        ),
-                    ]
-                    for _, row in round_rows.iterrows()
-                ]
+            # Arrow-only inputs are non-action frames.
+            is_arrow = round_rows[f"{p}_input"].isin(ARROWS).to_numpy()
+            action_pos = np.column_stack(
+                [frame_ids, np.where(is_arrow, NON_ACTION_LABEL, ACTION_LABEL)]
             )
 
-            clustering = DBSCAN(
-                eps=self.CLUSTERING_DISTANCE,
-                min_samples=self.CLUSTERING_MIN_SAMPLES,
-            ).fit(action_pos)
-            labels = clustering.labels_  # labels of frames
-            print(f"labels: {labels}")
-            print(f"clustering: {clustering}")
+            # Inverted once per distinct input instead of per row.
+            codes, uniques = pd.factorize(round_rows[f"{p}_input"])
+            if p == "p2":
+                uniques = [invert_arrow(input) for input in uniques]
+            inputs = np.array(list(uniques), dtype=object)[codes]
 
-            n_clusters_ = len(set(labels)) - (1 if -1 in labels else 0)
-            n_noise_ = list(labels).count(-1)
-
-            print("Estimated number of clusters: %d" % n_clusters_)
-            print("Estimated number of noise points: %d" % n_noise_)
-
-            unique_labels = set(labels)  # labels of clusters
-            core_samples_mask = np.zeros_like(labels, dtype=bool)
-            core_samples_mask[clustering.core_sample_indices_] = True
-
-            if is_display_clustering:
-                self.display_clustering(
-                    labels, unique_labels, action_pos, core_samples_mask, n_clusters_
-                )
+            if self.segmenter == GAP_SEGMENTER and not is_display_clustering:
+                clusters = self._segment_by_gap(frame_ids, ~is_arrow)
+            else:
+                clusters = self._cluster_by_dbscan(action_pos, is_display_clustering)
 
             # Show scenes
-            # Iterating clusters. k = a cluster
             scene_id = 0
-            for label in unique_labels:
-                if label == -1:
-                    # Ignore noise
-                    continue
-
-                class_member_mask = labels == label
-
-                xy = action_pos[class_member_mask & core_samples_mask]
-
-                if set(xy[:, 1]) == {NON_ACTION_LABEL}:
-                    # Ignore non-action frames
-                    continue
-
-                frame_ids = xy[:, 0]
-
-                if len(frame_ids) == 0:
-                    print(f"WARN: frame_idx is empty")
-                    continue
-
-                # print(f"frame_idx: {frame_idx}")
-                min_frame_id = max(min(frame_ids) - self.PREFIX_FRAME_SIZE, 0)
+            for cluster_frame_ids in clusters:
+                min_frame_id = max(cluster_frame_ids.min() - self.PREFIX_FRAME_SIZE, 0)
                 max_frame_id = min(
-                    (max(frame_ids) + self.SUFFIX_FRAME_SIZE),
+                    (cluster_frame_ids.max() + self.SUFFIX_FRAME_SIZE),
                     last_frame_id,
                 )
 
@@ -110,20 +88,11 @@ class SceneSplitter(SceneSplitterBase):
                 print(
                     f"replay_id: {replay_id} | round_id: {round_id} | scene_id: {scene_id} | frame range: {frame_range}"
                 )
-                # self.create_video(replay_id, round_id, scene_id, frame_range)
 
-                ranged_rows = round_rows.query(
-                    f"frame_id >= {min_frame_id} & frame_id <= {max_frame_id}"
-                )
-                if p == "p1":
-                    scene_inputs = [
-                        row[f"{p}_input"] for _, row in ranged_rows.iterrows()
-                    ]
-                elif p == "p2":
-                    scene_inputs = [
-                        invert_arrow(row[f"{p}_input"])
-                        for _, row in ranged_rows.iterrows()
-                    ]
+                # Rows of min_frame_id <= frame_id <= max_frame_id
+                start = np.searchsorted(sorted_frame_ids, min_frame_id, side="left")
+                stop = np.searchsorted(sorted_frame_ids, max_frame_id, side="right")
+                scene_inputs = inputs[np.sort(frame_order[start:stop])].tolist()
                 print(f"scene_inputs: {scene_inputs}")
 
                 scene = Scene(
@@ -139,6 +108,86 @@ class SceneSplitter(SceneSplitterBase):
 
                 yield scene
 
+    def _cluster_by_dbscan(self, action_pos, is_display_clustering: bool):
+        """Yield the frame IDs of the clusters of action frames in the order of the labels."""
+        clustering = DBSCAN(
+            eps=self.CLUSTERING_DISTANCE,
+            min_samples=self.CLUSTERING_MIN_SAMPLES,
+        ).fit(action_pos)
+        labels = clustering.labels_  # labels of frames
+        print(f"labels: {labels}")
+        print(f"clustering: {clustering}")
+
+        n_clusters_ = len(set(labels)) - (1 if -1 in labels else 0)
+        n_noise_ = list(labels).count(-1)
+
+        print("Estimated number of clusters: %d" % n_clusters_)
+        print("Estimated number of noise points: %d" % n_noise_)
+
+        unique_labels = set(labels)  # labels of clusters
+        core_samples_mask = np.zeros_like(labels, dtype=bool)
+        core_samples_mask[clustering.core_sample_indices_] = True
+
+        if is_display_clustering:
+            self.display_clustering(
+                labels, unique_labels, action_pos, core_samples_mask, n_clusters_
+            )
+
+        # Iterating clusters. k = a cluster
+        for label in unique_labels:
+            if label == -1:
+                # Ignore noise
+                continue
+
+            class_member_mask = labels == label
+
+            xy = action_pos[class_member_mask & core_samples_mask]
+
+            if len(xy) > 0 and np.all(xy[:, 1] == NON_ACTION_LABEL):
+                # Ignore non-action frames
+                continue
+
+            if len(xy) == 0:
+                print(f"WARN: frame_idx is empty")
+                continue
+
+            yield xy[:, 0]
+
+    def _segment_by_gap(self, frame_ids, is_action):
+        """
+        Yield the frame IDs of the segments of action frames split by the gaps longer than `CLUSTERING_DISTANCE`.
+
+        Same as the core samples of DBSCAN on `(frame_id, label)`, because action and non-action frames are
+        farther than the distance: a frame is in a segment when `CLUSTERING_MIN_SAMPLES` action frames
+        including itself are within the distance, and the segments are in the order of DBSCAN labels.
+        """
+        action_rows = np.flatnonzero(is_action)
+        # Stable sort of the ordered frame IDs is linear.
+        action_rows = action_rows[np.argsort(frame_ids[action_rows], kind="stable")]
+        action_frame_ids = frame_ids[action_rows]
+
+        neighbor_counts = np.searchsorted(
+            action_frame_ids, action_frame_ids + self.CLUSTERING_DISTANCE, side="right"
+        ) - np.searchsorted(
+            action_frame_ids, action_frame_ids - self.CLUSTERING_DISTANCE, side="left"
+        )
+        is_core = neighbor_counts >= self.CLUSTERING_MIN_SAMPLES
+        core_rows = action_rows[is_core]
+        core_frame_ids = action_frame_ids[is_core]
+
+        if len(core_frame_ids) == 0:
+            print("Number of segments: 0")
+            return
+
+        gaps = np.flatnonzero(np.diff(core_frame_ids) > self.CLUSTERING_DISTANCE) + 1
+        segments = np.split(np.arange(len(core_frame_ids)), gaps)
+        # DBSCAN labels the clusters in the order of the first row.
+        segments.sort(key=lambda segment: core_rows[segment].min())
+        print(f"Number of segments: {len(segments)}")
+
+        for segment in segments:
+            yield core_frame_ids[segment]
+
     def display_clustering(
         self, labels, unique_labels, action_pos, core_samples_mask, n_clusters_
     ):
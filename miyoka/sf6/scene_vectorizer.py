@@ -1,6 +1,8 @@
+import functools
 import itertools
 import numpy as np
 from numpy.typing import NDArray
+from scipy.sparse import csr_matrix
 from miyoka.libs.scene_vectorizer import SceneVectorizer as SceneVectorizerBase
 from miyoka.sf6.constants import ARROWS, CLASSIC_INPUTS
 
@@ -9,16 +11,11 @@ class SceneVectorizer(SceneVectorizerBase):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
 
-        self.vocabulary = self._build_vocabs()
-
-        # Bigram for arrows
-        perms = itertools.permutations(ARROWS, 2)
-        for p in perms:
-            token = ">".join(p)
-            self.vocabulary.append(token)
+        # Shared by the vectorizers in a process. The order is deterministic,
+        # so the vectors of different processes have the same columns.
+        self.vocabulary, self.token_to_index = _token_index()
 
         self.vocab_size = len(self.vocabulary)
-        self.token_to_index = {v: i for i, v in enumerate(self.vocabulary)}
         self.index_to_token = {i: v for i, v in enumerate(self.vocabulary)}
 
     def get_feature_names_out(self) -> list[str]:
@@ -27,6 +24,44 @@ class SceneVectorizer(SceneVectorizerBase):
     # TODO: Maybe action input and arrow input should be separately extracted as features.
     # e.g. '1' '2' '3' ... '1>2', '1>3', ... 'lp', 'mp'
     def vectorize(self, inputs: list[str]) -> NDArray[np.float64]:
+        indexes = np.array(self._tokenize(inputs))
+        values, counts = np.unique(indexes, return_counts=True)
+        vector = np.zeros(self.vocab_size)
+
+        for v, c in zip(values, counts):
+            vector[v] = c
+
+        print(f"scene_vector: {vector[:10]}")
+        print(f"np.nonzero(vector): {np.nonzero(vector)}")
+
+        if np.all(vector == 0):
+            raise Exception("ERROR: All vector is zero!")
+
+        return vector
+
+    def vectorize_many(self, scene_inputs: list[list[str]]) -> csr_matrix:
+        """Vectorize the scenes into a sparse matrix of (scenes, vocab_size) in one pass."""
+        indices = []
+        indptr = [0]
+
+        for inputs in scene_inputs:
+            tokens = self._tokenize(inputs)
+
+            if not tokens:
+                raise Exception("ERROR: All vector is zero!")
+
+            indices.extend(tokens)
+            indptr.append(len(indices))
+
+        matrix = csr_matrix(
+            (np.ones(len(indices)), indices, indptr),
+            shape=(len(scene_inputs), self.vocab_size),
+        )
+        # Count the same tokens in a scene
+        matrix.sum_duplicates()
+        return matrix
+
+    def _tokenize(self, inputs: list[str]) -> list[int]:
         optimized_inputs = []
         prev_t = ""
         for t in inputs:
@@ -43,41 +78,43 @@ class SceneVectorizer(SceneVectorizerBase):
 
             prev_t = t
 
-        indexes = np.array([self.token_to_index[t] for t in optimized_inputs])
-        values, counts = np.unique(indexes, return_counts=True)
-        vector = np.zeros(self.vocab_size)
+        return [self.token_to_index[t] for t in optimized_inputs]
 
-        for v, c in zip(values, counts):
-            vector[v] = c
 
-        print(f"scene_vector: {vector[:10]}")
-        print(f"np.nonzero(vector): {np.nonzero(vector)}")
+@functools.cache
+def _token_index() -> tuple[list[str], dict[str, int]]:
+    vocabulary = _build_vocabs()
 
-        if np.all(vector == 0):
-            raise Exception("ERROR: All vector is zero!")
+    # Bigram for arrows
+    perms = itertools.permutations(ARROWS, 2)
+    for p in perms:
+        token = ">".join(p)
+        vocabulary.append(token)
 
-        return vector
+    return vocabulary, {v: i for i, v in enumerate(vocabulary)}
+
+
+def _build_vocabs() -> list[str]:
+    vocabs = []
 
-    def _build_vocabs(self) -> list[str]:
-        vocabs = []
+    for arrow in ARROWS:
+        for input_comb in _input_combinations():
+            vocab = arrow
+            if input_comb:
+                input = " ".join(input_comb)
+                vocab += f" {input}"
+            vocabs.append(vocab)
 
-        for arrow in ARROWS:
-            for input_comb in self._input_combinations():
-                vocab = arrow
-                if input_comb:
-                    input = " ".join(input_comb)
-                    vocab += f" {input}"
-                vocabs.append(vocab)
+    return vocabs
 
-        return vocabs
 
-    def _input_combinations(self):
-        yield ""  # no input
+def _input_combinations():
+    yield ""  # no input
 
-        # for inputs in [CLASSIC_INPUTS, MODERN_INPUTS]:
-        for inputs in [CLASSIC_INPUTS]:
-            for r in range(1, len(inputs) + 1):
-                comb = itertools.combinations(inputs, r)
+    # for inputs in [CLASSIC_INPUTS, MODERN_INPUTS]:
+    for inputs in [CLASSIC_INPUTS]:
+        for r in range(1, len(inputs) + 1):
+            comb = itertools.combinations(inputs, r)
 
-                for i in comb:
-                    yield i
+            for i in comb:
+                yield i
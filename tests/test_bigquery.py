@@ -0,0 +1,155 @@
+import logging
+import unittest
+from unittest import mock
+from miyoka.libs.bigquery import (
+    LOAD_WRITE_MODE,
+    STREAM_WRITE_MODE,
+    FrameDataset,
+    ReplayDataset,
+)
+from miyoka.libs.fake_bigquery import FakeBqClient
+
+logger = logging.getLogger(__name__)
+
+
+def frame_data(count: int) -> list[dict]:
+    return [
+        {"frame_id": frame_id, "p1_input": ["6", "LP"], "p2_input": ["4"]}
+        for frame_id in range(count)
+    ]
+
+
+class FrameDatasetTest(unittest.TestCase):
+    def setUp(self):
+        self.bq_client = FakeBqClient()
+        # Retried streaming inserts back off with `time.sleep`.
+        patcher = mock.patch("miyoka.libs.bigquery.time.sleep")
+        self.sleep = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def frame_dataset(self, **kwargs) -> FrameDataset:
+        return FrameDataset("miyoka", "frames", self.bq_client, logger, **kwargs)
+
+    def count_rows(self) -> int:
+        rows = self.bq_client.query(
+            "SELECT COUNT(*) AS count FROM `local.miyoka.frames`"
+        ).result()
+        return rows[0].count
+
+    def test_stream_retries_failed_rows(self):
+        self.bq_client.insert_errors = [[{"index": 0, "errors": ["backendError"]}]]
+        frame_dataset = self.frame_dataset(write_mode=STREAM_WRITE_MODE, flush_rows=2)
+
+        frame_dataset.insert("replay-a", 1, frame_data(5))
+        frame_dataset.flush()
+
+        self.assertEqual(self.count_rows(), 5)
+        self.assertEqual(
+            frame_dataset.existing_rounds([("replay-a", 1), ("replay-a", 2)]),
+            {("replay-a", 1)},
+        )
+
+    def test_stream_sleeps_only_between_attempts(self):
+        error = [{"index": 0, "errors": ["backendError"]}]
+        self.bq_client.insert_errors = [error] * 3
+        frame_dataset = self.frame_dataset(write_mode=STREAM_WRITE_MODE, max_retries=2)
+
+        frame_dataset.insert("replay-a", 1, frame_data(1))
+
+        with self.assertRaises(Exception):
+            frame_dataset.flush()
+
+        self.assertEqual(self.sleep.call_args_list, [mock.call(1), mock.call(2)])
+
+    def test_stream_deduplicates_retried_batch(self):
+        frame_dataset = self.frame_dataset(write_mode=STREAM_WRITE_MODE)
+
+        # The same batch sent again e.g. after a timeout, and by the next run.
+        frame_dataset.insert("replay-a", 1, frame_data(3))
+        frame_dataset.flush()
+        frame_dataset.insert("replay-a", 1, frame_data(3))
+        frame_dataset.flush()
+        frame_dataset = self.frame_dataset(write_mode=STREAM_WRITE_MODE)
+        frame_dataset.insert("replay-a", 1, frame_data(3))
+        frame_dataset.flush()
+
+        self.assertEqual(self.count_rows(), 3)
+
+    def test_load_replaces_rows_of_retried_round(self):
+        frame_dataset = self.frame_dataset(write_mode=LOAD_WRITE_MODE)
+        frame_dataset.insert("replay-a", 1, frame_data(3))
+        frame_dataset.insert("replay-a", 2, frame_data(2))
+        frame_dataset.flush()
+
+        # The round analyzed again by the next run.
+        frame_dataset = self.frame_dataset(write_mode=LOAD_WRITE_MODE)
+        frame_dataset.insert("replay-a", 1, frame_data(4))
+        frame_dataset.flush()
+
+        self.assertEqual(self.count_rows(), 6)
+
+    def test_existing_rounds_queries_rounds_not_in_index(self):
+        frame_dataset = self.frame_dataset(write_mode=STREAM_WRITE_MODE)
+        frame_dataset.insert("replay-a", 1, frame_data(3))
+        frame_dataset.flush()
+        frame_dataset = self.frame_dataset(write_mode=LOAD_WRITE_MODE)
+        frame_dataset.insert("replay-b", 1, frame_data(3))
+        frame_dataset.flush()
+
+        # A new dataset has an empty index, so the rounds are checked in the table.
+        frame_dataset = self.frame_dataset(write_mode=LOAD_WRITE_MODE)
+
+        self.assertEqual(
+            frame_dataset.existing_rounds(
+                [("replay-a", 1), ("replay-b", 1), ("replay-b", 2), ("replay-c", 1)]
+            ),
+            {("replay-a", 1), ("replay-b", 1)},
+        )
+        self.assertIn(("replay-b", 1), frame_dataset.index)
+
+    def test_load_discards_round_from_index_until_loaded(self):
+        frame_dataset = self.frame_dataset(write_mode=LOAD_WRITE_MODE)
+        frame_dataset.insert("replay-a", 1, frame_data(3))
+        frame_dataset.flush()
+
+        frame_dataset = self.frame_dataset(write_mode=LOAD_WRITE_MODE)
+        frame_dataset.index.add([("replay-a", 1)])
+        frame_dataset.insert("replay-a", 1, frame_data(3))
+
+        with mock.patch.object(
+            FrameDataset, "_load_dataframe", side_effect=Exception("load failed")
+        ):
+            with self.assertRaises(Exception):
+                frame_dataset.flush()
+
+        self.assertNotIn(("replay-a", 1), frame_dataset.index)
+        self.assertEqual(frame_dataset.existing_rounds([("replay-a", 1)]), set())
+
+
+class ReplayDatasetTest(unittest.TestCase):
+    def setUp(self):
+        self.bq_client = FakeBqClient()
+
+    def replay_dataset(self) -> ReplayDataset:
+        return ReplayDataset(
+            "miyoka", "replays", self.bq_client, logger, refresh_interval=60
+        )
+
+    def test_existing_replay_ids_queries_ids_not_in_refreshed_index(self):
+        replay_dataset = self.replay_dataset()
+        replay_dataset.insert("replay-a", {})
+
+        self.assertTrue(replay_dataset.is_exists("replay-a"))
+        self.assertFalse(replay_dataset.is_exists("replay-b"))
+
+        # Inserted by another recorder after the index was refreshed
+        self.replay_dataset().insert("replay-b", {})
+
+        self.assertEqual(
+            replay_dataset.existing_replay_ids(["replay-a", "replay-b", "replay-c"]),
+            {"replay-a", "replay-b"},
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
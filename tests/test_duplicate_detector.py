@@ -0,0 +1,43 @@
+import logging
+import unittest
+import numpy as np
+from miyoka.libs.duplicate_detector import DuplicateDetector
+from miyoka.sf6.game_window_helper import GameWindowHelper
+
+
+def frames_with_duplicates() -> list[np.ndarray]:
+    """Frames captured twice, slightly changed around the threshold, and different."""
+    rng = np.random.default_rng(0)
+    frame = rng.integers(0, 256, (72, 128, 3), dtype=np.uint8)
+    frames = []
+
+    for i in range(60):
+        if i % 3 == 0:
+            frame = rng.integers(0, 256, frame.shape, dtype=np.uint8)
+        elif i % 3 == 1:
+            frame = frame.copy()
+            # Changed pixels of a frame that is almost the same
+            frame[rng.random(frame.shape[:2]) < i / 60] += 3
+
+        frames.append(frame)
+
+    return frames
+
+
+class DuplicateDetectorTest(unittest.TestCase):
+    def test_same_as_full_frame_mse(self):
+        helper = GameWindowHelper(logging.getLogger(__name__), window_name="", extra={})
+        detector = DuplicateDetector()
+        frames = frames_with_duplicates()
+        expected = [False] + [
+            helper.mse(frame, previous) < 5
+            for previous, frame in zip(frames, frames[1:])
+        ]
+
+        self.assertEqual([detector.is_duplicate(frame) for frame in frames], expected)
+        self.assertIn(True, expected)
+        self.assertIn(False, expected[1:])
+
+
+if __name__ == "__main__":
+    unittest.main()
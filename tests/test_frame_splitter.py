@@ -0,0 +1,138 @@
+import logging
+import os
+import tempfile
+import unittest
+import cv2 as cv
+import numpy as np
+from miyoka.libs.frame_splitter import FrameSplitter
+
+logger = logging.getLogger(__name__)
+
+FRAME_COUNT = 300
+FPS = 60
+
+
+def write_sample_video(path: str):
+    """A video whose frames are all different, encoded with key frames and inter frames."""
+    rng = np.random.default_rng(0)
+    background = rng.integers(0, 256, (96, 160, 3), dtype=np.uint8)
+    video = cv.VideoWriter(path, cv.VideoWriter_fourcc(*"mp4v"), FPS, (160, 96))
+
+    for frame_id in range(FRAME_COUNT):
+        frame = np.roll(background, frame_id, axis=1)
+        cv.putText(
+            frame, str(frame_id), (10, 60), cv.FONT_HERSHEY_SIMPLEX, 1, (255, 255, 255)
+        )
+        video.write(frame)
+
+    video.release()
+
+
+def read_sequentially(path: str) -> list[np.ndarray]:
+    vidcap = cv.VideoCapture(path)
+    frames = []
+
+    while True:
+        success, frame = vidcap.read()
+
+        if not success:
+            break
+
+        frames.append(frame)
+
+    vidcap.release()
+    return frames
+
+
+class FrameSplitterTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.tmp_dir = tempfile.TemporaryDirectory()
+        cls.video_path = os.path.join(cls.tmp_dir.name, "round.mp4")
+        write_sample_video(cls.video_path)
+        cls.frames = read_sequentially(cls.video_path)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.tmp_dir.cleanup()
+
+    def frame_splitter(self, seek_stride: int = 0) -> FrameSplitter:
+        return FrameSplitter(
+            logger,
+            export_dir=os.path.join(self.tmp_dir.name, "frames"),
+            batch_size=50,
+            clear_per_batch=True,
+            skip_split=False,
+            seek_stride=seek_stride,
+        )
+
+    def split(self, frame_splitter: FrameSplitter, start: int) -> list:
+        return [
+            (frame_id, frame)
+            for batch, _ in frame_splitter.split_in_batch(self.video_path, start=start)
+            for frame_id, frame in batch
+        ]
+
+    def assertSameFrames(self, frames: list, start: int):
+        self.assertEqual(
+            [frame_id for frame_id, _ in frames], list(range(start, len(self.frames)))
+        )
+
+        for frame_id, frame in frames:
+            np.testing.assert_array_equal(
+                frame, self.frames[frame_id], err_msg=frame_id
+            )
+
+    def test_split_from_start_matches_sequential_read(self):
+        self.assertEqual(len(self.frames), FRAME_COUNT)
+
+        for start in [0, 1, 13, 137, FRAME_COUNT - 1]:
+            with self.subTest(start=start):
+                self.assertSameFrames(self.split(self.frame_splitter(), start), start)
+
+    def test_read_range_shards_match_sequential_read(self):
+        frame_splitter = self.frame_splitter()
+        starts = [7, 80, 151, 222]
+        stops = starts[1:] + [None]
+
+        frames = [
+            (frame_id, frame)
+            for start, stop in zip(starts, stops)
+            for frame_id, frame in frame_splitter.read_range(
+                self.video_path, start, stop
+            )
+        ]
+
+        self.assertSameFrames(frames, starts[0])
+
+    def test_find_start_frame_with_flickering_marker(self):
+        replay_start = 137
+        seek_stride = 20
+        # The marker is hidden at the first probe after the start of the replay.
+        flickering_probe = (replay_start // seek_stride + 1) * seek_stride
+        probed = []
+
+        def is_analyzable(frame_id, frame):
+            np.testing.assert_array_equal(frame, self.frames[frame_id])
+            probed.append(frame_id)
+            return frame_id >= replay_start and frame_id != flickering_probe
+
+        frame_splitter = self.frame_splitter(seek_stride=seek_stride)
+        start = frame_splitter.find_start_frame(self.video_path, is_analyzable)
+
+        self.assertEqual(
+            probed, list(range(0, flickering_probe + seek_stride + 1, seek_stride))
+        )
+        self.assertLessEqual(start, replay_start)
+        self.assertSameFrames(self.split(frame_splitter, start), start)
+
+    def test_find_start_frame_without_seek_stride(self):
+        frame_splitter = self.frame_splitter()
+
+        self.assertEqual(
+            frame_splitter.find_start_frame(self.video_path, lambda *_: True), 0
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,64 @@
+import json
+import os
+import tempfile
+import unittest
+from miyoka.libs.key_index import KeyIndex
+
+
+class KeyIndexTest(unittest.TestCase):
+    def setUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.path = os.path.join(tmp_dir.name, "index.json")
+
+    def read_lines(self) -> list[dict]:
+        with open(self.path) as f:
+            return [json.loads(line) for line in f]
+
+    def test_persists_changes_incrementally(self):
+        index = KeyIndex(self.path)
+        index.add([("replay-a", 1), ("replay-a", 2)], watermark="2024-01-01 00:00:00")
+        index.add([("replay-a", 2), ("replay-b", 1)])
+        index.discard([("replay-a", 1)])
+
+        # Only the changes are appended.
+        self.assertEqual(
+            [sorted(line) for line in self.read_lines()],
+            [["keys", "watermark"], ["keys"], ["removed"]],
+        )
+        self.assertEqual(self.read_lines()[1]["keys"], [["replay-b", 1]])
+
+        index = KeyIndex(self.path)
+
+        self.assertEqual(len(index), 2)
+        self.assertIn(("replay-a", 2), index)
+        self.assertIn(("replay-b", 1), index)
+        self.assertNotIn(("replay-a", 1), index)
+        self.assertEqual(index.watermark, "2024-01-01 00:00:00")
+        # Compacted when read
+        self.assertEqual(len(self.read_lines()), 1)
+
+    def test_reads_index_written_as_one_json(self):
+        with open(self.path, "w") as f:
+            json.dump({"watermark": None, "keys": ["replay-a"]}, f)
+
+        index = KeyIndex(self.path)
+        index.add(["replay-b"])
+
+        self.assertEqual(len(KeyIndex(self.path)), 2)
+
+    def test_ignores_partially_written_line(self):
+        index = KeyIndex(self.path)
+        index.add(["replay-a"])
+
+        with open(self.path, "a") as f:
+            f.write('{"keys": ["repl')
+
+        index = KeyIndex(self.path)
+        index.add(["replay-b"])
+
+        self.assertEqual(len(KeyIndex(self.path)), 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
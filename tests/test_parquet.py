@@ -0,0 +1,94 @@
+import logging
+import tempfile
+import unittest
+from miyoka.libs.parquet import ParquetFrameDataset
+
+logger = logging.getLogger(__name__)
+
+METADATA = {
+    "p1": {"character": "ryu", "mode": "classic"},
+    "p2": {"character": "ken", "mode": "classic"},
+    "played_at": "2024-01-01 00:00:00",
+}
+
+
+def frame_data(count: int) -> list[dict]:
+    return [
+        {"frame_id": frame_id, "p1_input": ["6", "LP"], "p2_input": ["4"]}
+        for frame_id in range(count)
+    ]
+
+
+class ParquetFrameDatasetTest(unittest.TestCase):
+    def setUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.base_dir = tmp_dir.name
+
+    def frame_dataset(self) -> ParquetFrameDataset:
+        return ParquetFrameDataset(self.base_dir, logger)
+
+    def test_round_trip(self):
+        # Characters escaped in the partition directory name
+        replay_ids = ["replay-a", "replay b/%41"]
+        frame_dataset = self.frame_dataset()
+
+        for replay_id in replay_ids:
+            frame_dataset.insert(replay_id, 1, frame_data(3), METADATA)
+            frame_dataset.insert(replay_id, 2, frame_data(2), METADATA)
+
+        frame_dataset.flush()
+        frame_dataset = self.frame_dataset()
+
+        self.assertEqual(
+            frame_dataset.existing_rounds(
+                [("replay-a", 1), ("replay b/%41", 2), ("replay b/A", 2)]
+            ),
+            {("replay-a", 1), ("replay b/%41", 2)},
+        )
+
+        rows = frame_dataset.get_all_rows("classic")
+        expected_keys = [
+            (replay_id, round_id, frame_id)
+            for replay_id in sorted(replay_ids)
+            for round_id, count in [(1, 3), (2, 2)]
+            for frame_id in range(count)
+        ]
+
+        self.assertEqual(
+            list(zip(rows["replay_id"], rows["round_id"], rows["frame_id"])),
+            expected_keys,
+        )
+        self.assertEqual(set(rows["p1_input"]), {"6 LP"})
+        self.assertEqual(set(rows["p2_character"]), {"ken"})
+        self.assertTrue(frame_dataset.get_all_rows("modern").empty)
+
+        chunks = list(frame_dataset.iterate_row_chunks("classic"))
+
+        self.assertEqual(
+            [
+                key
+                for chunk in chunks
+                for key in zip(chunk["replay_id"], chunk["round_id"], chunk["frame_id"])
+            ],
+            expected_keys,
+        )
+
+    def test_flush_replaces_rows_of_previous_run(self):
+        frame_dataset = self.frame_dataset()
+        frame_dataset.insert("replay-a", 1, frame_data(3), METADATA)
+        frame_dataset.flush()
+
+        frame_dataset = self.frame_dataset()
+        frame_dataset.insert("replay-a", 1, frame_data(3), METADATA)
+        frame_dataset.flush()
+        frame_dataset.insert("replay-a", 1, frame_data(1), METADATA)
+        frame_dataset.flush()
+
+        self.assertEqual(
+            sorted(frame_dataset.get_all_rows("classic")["frame_id"]), [0, 0, 1, 2]
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()